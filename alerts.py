@@ -0,0 +1,175 @@
+import logging
+import re
+from bisect import bisect_left, bisect_right, insort
+from datetime import datetime
+from typing import Awaitable, Callable, Dict, Iterable, List, NamedTuple, Optional, Tuple
+
+import database
+from db_executor import db_executor
+
+
+logger = logging.getLogger(__name__)
+
+# /alert SBER >= 300   /alert gazp <= 120,5
+ALERT_PATTERN = re.compile(r'^\s*([A-Za-z0-9.\-]+)\s*(>=|<=)\s*(\d+(?:[.,]\d+)?)\s*$')
+
+
+class Alert(NamedTuple):
+    id: int
+    owner_id: int
+    chat_id: int
+    stock_id: str
+    direction: str
+    threshold_minor: int
+
+    @property
+    def threshold(self) -> float:
+        return self.threshold_minor / 100
+
+
+def parse_alert(text: str) -> Optional[Tuple[str, str, int]]:
+    """``'SBER >= 300'`` -> ``('SBER', '>=', 30000)`` or None if the text does not match."""
+    match = ALERT_PATTERN.match(text or '')
+    if match is None:
+        return None
+    stock_id, direction, price = match.groups()
+    return stock_id.upper(), direction, database.to_minor(price.replace(',', '.'))
+
+
+class AlertIndex:
+    """Active alerts ordered by threshold, per ticker.
+
+    ``>=`` alerts are kept ascending, so the alerts crossed by a price are a
+    prefix of the list; ``<=`` alerts crossed by a price are a suffix. Checking a
+    quote costs one binary search plus the number of alerts that fire.
+    """
+
+    def __init__(self):
+        self.alerts: Dict[int, Alert] = {}
+        # stock_id -> sorted [(threshold_minor, alert_id)]
+        self._above: Dict[str, List[Tuple[int, int]]] = {}
+        self._below: Dict[str, List[Tuple[int, int]]] = {}
+
+    def __len__(self) -> int:
+        return len(self.alerts)
+
+    def _side(self, direction: str) -> Dict[str, List[Tuple[int, int]]]:
+        return self._above if direction == '>=' else self._below
+
+    def tickers(self) -> List[str]:
+        return list(self._above.keys() | self._below.keys())
+
+    def add(self, alert: Alert) -> None:
+        self.alerts[alert.id] = alert
+        insort(self._side(alert.direction).setdefault(alert.stock_id, []), (alert.threshold_minor, alert.id))
+
+    def extend(self, alerts: Iterable[Alert]) -> None:
+        """Bulk add: append everything, then sort each touched list once."""
+        touched = []
+        for alert in alerts:
+            self.alerts[alert.id] = alert
+            entries = self._side(alert.direction).setdefault(alert.stock_id, [])
+            entries.append((alert.threshold_minor, alert.id))
+            touched.append(entries)
+        for entries in {id(entries): entries for entries in touched}.values():
+            entries.sort()
+
+    def remove(self, alert_id: int) -> Optional[Alert]:
+        alert = self.alerts.pop(alert_id, None)
+        if alert is None:
+            return None
+        side = self._side(alert.direction)
+        entries = side[alert.stock_id]
+        entries.pop(bisect_left(entries, (alert.threshold_minor, alert.id)))
+        if not entries:
+            del side[alert.stock_id]
+        return alert
+
+    def pop_crossed(self, stock_id: str, price_minor: int) -> List[Alert]:
+        """Remove and return the alerts of ``stock_id`` that ``price_minor`` satisfies."""
+        crossed = []
+        above = self._above.get(stock_id)
+        if above:
+            # Every threshold <= price
+            end = bisect_right(above, (price_minor, float('inf')))
+            crossed.extend(above[:end])
+            del above[:end]
+            if not above:
+                del self._above[stock_id]
+        below = self._below.get(stock_id)
+        if below:
+            # Every threshold >= price
+            start = bisect_left(below, (price_minor, 0))
+            crossed.extend(below[start:])
+            del below[start:]
+            if not below:
+                del self._below[stock_id]
+        return [self.alerts.pop(alert_id) for _, alert_id in crossed]
+
+
+def format_alert(alert: Alert) -> str:
+    return f'#{alert.id}: {alert.stock_id} {alert.direction} {alert.threshold:.2f}'
+
+
+class AlertEngine:
+    """Keeps the alert index in sync with the alerts table and fires alerts on new quotes."""
+
+    def __init__(self, send: Optional[Callable[[int, str], Awaitable]] = None):
+        self.index = AlertIndex()
+        self.send = send
+        self.loaded = False
+
+    async def load(self, owns: Optional[Callable[[int], bool]] = None) -> None:
+        """Load the active alerts; with ``owns`` only those of the users it accepts (one worker's shard)."""
+        rows = await db_executor.read(database.select_active_alerts)
+        index = AlertIndex()
+        index.extend(Alert(*row) for row in rows if owns is None or owns(row[1]))
+        self.index = index
+        self.loaded = True
+        logger.info('Loaded %s active price alerts', len(index))
+
+    def tickers(self) -> List[str]:
+        return self.index.tickers()
+
+    async def create(self, owner_id: int, chat_id: int, stock_id: str, direction: str, threshold_minor: int) -> Alert:
+        alert_id = await db_executor.write(database.insert_alert, owner_id, chat_id, stock_id, direction,
+                                           threshold_minor, datetime.now())
+        alert = Alert(alert_id, owner_id, chat_id, stock_id, direction, threshold_minor)
+        self.index.add(alert)
+        return alert
+
+    async def delete(self, owner_id: int, alert_id: int) -> bool:
+        alert = self.index.alerts.get(alert_id)
+        if alert is None or alert.owner_id != owner_id:
+            return False
+        self.index.remove(alert_id)
+        await db_executor.write(database.delete_alert, alert_id)
+        return True
+
+    async def user_alerts(self, owner_id: int) -> List[Alert]:
+        rows = await db_executor.read(database.select_user_alerts, owner_id)
+        return [Alert(*row) for row in rows]
+
+    async def check(self, prices: Dict[str, Iterable]) -> List[Alert]:
+        """Fire the alerts crossed by ``prices`` (``{ticker: (price, currency, ...)}``)."""
+        fired: List[Tuple[Alert, float, str]] = []
+        for stock_id, (price, currency, *_) in prices.items():
+            if price is None:
+                continue
+            for alert in self.index.pop_crossed(stock_id, database.to_minor(price)):
+                fired.append((alert, price, currency))
+        if not fired:
+            return []
+
+        await db_executor.write(database.mark_alerts_triggered, [alert.id for alert, _, _ in fired], datetime.now())
+        for alert, price, currency in fired:
+            text = (f'🔔 {alert.stock_id}: цена {price:.2f} {currency} '
+                    f'достигла уровня {alert.direction} {alert.threshold:.2f}')
+            try:
+                await self.send(alert.chat_id, text)
+            except Exception:
+                logger.exception('Failed to deliver alert %s', alert.id)
+        return [alert for alert, _, _ in fired]
+
+
+alert_engine = AlertEngine()
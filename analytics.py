@@ -0,0 +1,132 @@
+import sqlite3
+from typing import Dict, Iterable, NamedTuple, Optional, Sequence, Tuple
+
+import numpy as np
+
+import database
+from database import STREAM_CHUNK_SIZE, iter_chunks
+
+
+# Trading days in a year, for annualized volatility
+TRADING_DAYS = 252
+
+
+class Valuation(NamedTuple):
+    """Per-position arrays (aligned with ``Portfolio.stock_ids``) and portfolio totals.
+
+    Positions without a price have NaN value, weight and P&L and are left out of the totals.
+    """
+    price: np.ndarray
+    value: np.ndarray
+    weight: np.ndarray
+    pnl: np.ndarray
+    pnl_percent: np.ndarray
+    total_value: float
+    total_cost: float
+
+    @property
+    def priced(self) -> np.ndarray:
+        return ~np.isnan(self.price)
+
+    @property
+    def total_pnl(self) -> float:
+        return self.total_value - self.total_cost
+
+
+class Risk(NamedTuple):
+    total_return: float
+    volatility: float
+    max_drawdown: float
+
+
+class Portfolio:
+    """Positions of one user as typed arrays, one element per ticker."""
+
+    __slots__ = ('stock_ids', 'quantity', 'cost', 'lot_count')
+
+    def __init__(self, stock_ids: Sequence[str], quantity: Sequence[int], cost_minor: Sequence[int],
+                 lot_count: Sequence[int]):
+        self.stock_ids = list(stock_ids)
+        self.quantity = np.asarray(quantity, dtype=np.int64)
+        self.cost = np.asarray(cost_minor, dtype=np.int64) / 100
+        self.lot_count = np.asarray(lot_count, dtype=np.int64)
+
+    def __len__(self) -> int:
+        return len(self.stock_ids)
+
+    @classmethod
+    def from_positions(cls, rows: Sequence[Tuple[str, int, int, int]]) -> 'Portfolio':
+        """From rows of ``database.select_user_positions``."""
+        return cls(*zip(*rows)) if rows else cls([], [], [], [])
+
+    @classmethod
+    def from_lots(cls, lots: Iterable[Tuple[str, int, int, str]], chunk_size: int = STREAM_CHUNK_SIZE) -> 'Portfolio':
+        """From rows of ``database.iter_user_lots``, aggregated per ticker.
+
+        Lots are folded in ``chunk_size`` at a time, so a streamed cursor is never
+        held in memory as a whole.
+        """
+        # stock_id -> [quantity, cost_minor, lot_count]
+        totals: Dict[str, np.ndarray] = {}
+        for chunk in iter_chunks(lots, chunk_size):
+            stock_ids, quantity, unit_price_minor, _ = zip(*chunk)
+            tickers, index = np.unique(np.array(stock_ids), return_inverse=True)
+            quantity = np.asarray(quantity, dtype=np.int64)
+            cost_minor = quantity * np.asarray(unit_price_minor, dtype=np.int64)
+            sums = np.stack([np.bincount(index, weights=quantity, minlength=len(tickers)),
+                             np.bincount(index, weights=cost_minor, minlength=len(tickers)),
+                             np.bincount(index, minlength=len(tickers))]).astype(np.int64)
+            for column, stock_id in enumerate(tickers.tolist()):
+                if stock_id in totals:
+                    totals[stock_id] += sums[:, column]
+                else:
+                    totals[stock_id] = sums[:, column]
+        if not totals:
+            return cls([], [], [], [])
+        stock_ids = sorted(totals)
+        return cls(stock_ids, *np.stack([totals[stock_id] for stock_id in stock_ids], axis=1))
+
+    @property
+    def average_price(self) -> np.ndarray:
+        """Weighted average purchase price of each position."""
+        return np.divide(self.cost, self.quantity, out=np.zeros(len(self)), where=self.quantity != 0)
+
+    def valuation(self, prices: Dict[str, Optional[float]]) -> Valuation:
+        price = np.array([prices.get(stock_id) for stock_id in self.stock_ids], dtype=np.float64)
+        value = self.quantity * price
+        total_value = float(np.nansum(value))
+        weight = value / total_value if total_value else np.full(len(self), np.nan)
+        pnl = value - self.cost
+        average = self.average_price
+        pnl_percent = np.divide(price - average, average, out=np.zeros(len(self)), where=average != 0) * 100
+        pnl_percent[np.isnan(price)] = np.nan
+        total_cost = float(self.cost[~np.isnan(price)].sum())
+        return Valuation(price, value, weight, pnl, pnl_percent, total_value, total_cost)
+
+
+def user_portfolio(conn: sqlite3.Connection, owner_id: int) -> Portfolio:
+    """``Portfolio.from_lots`` of the user's lots streamed from the cursor; runs on a DB reader thread."""
+    return Portfolio.from_lots(database.iter_user_lots(conn, owner_id))
+
+
+def daily_returns(values: np.ndarray, invested: np.ndarray) -> np.ndarray:
+    """Day-to-day returns of a value series, net of money added on each day.
+
+    Days starting from an empty portfolio are skipped.
+    """
+    flows = np.diff(invested)
+    previous = values[:-1]
+    held = previous > 0
+    return (values[1:][held] - flows[held]) / previous[held] - 1
+
+
+def risk(values: np.ndarray, invested: np.ndarray) -> Optional[Risk]:
+    """Time-weighted return, annualized volatility and maximum drawdown, or None with too little history."""
+    returns = daily_returns(values, invested)
+    if len(returns) < 2:
+        return None
+    growth = np.cumprod(1 + returns)
+    drawdown = growth / np.maximum.accumulate(np.maximum(growth, 1.0)) - 1
+    return Risk(total_return=float(growth[-1] - 1),
+                volatility=float(returns.std(ddof=1) * np.sqrt(TRADING_DAYS)),
+                max_drawdown=float(drawdown.min()))
@@ -0,0 +1,341 @@
+"""Offline load test of the bot.
+
+Synthetic users run 'start', 'AddStock', 'CheckPortfolio' and 'USD_RUB' through
+the real dispatcher, while MOEX ISS, CBR and the Telegram Bot API are replaced by
+local HTTP servers with configurable latency. Reports throughput, per-step
+p50/p99 latency and memory; exits with status 1 when a limit is exceeded.
+
+    python benchmark.py --users 2000 --concurrency 200 --upstream-latency 20 --max-p99 500
+"""
+import argparse
+import asyncio
+import importlib
+import itertools
+import json
+import os
+import random
+import resource
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+from collections import Counter, defaultdict
+from typing import Dict, List, Optional, Tuple
+
+from aiohttp import web
+
+
+TICKERS = [f'BM{i:03d}' for i in range(200)]
+USD_RUB = 92.5
+# CBR quotes CNY per 10 units
+CBR_VALUTE = {'USD': {'CharCode': 'USD', 'Nominal': 1, 'Value': USD_RUB},
+              'EUR': {'CharCode': 'EUR', 'Nominal': 1, 'Value': 100.1},
+              'CNY': {'CharCode': 'CNY', 'Nominal': 10, 'Value': 127.4}}
+
+
+class FakeUpstream:
+    """ISS and CBR endpoints used by the bot, answering after ``latency`` seconds."""
+
+    def __init__(self, latency: float = 0.0, tickers: List[str] = TICKERS):
+        self.latency = latency
+        self.prices = {ticker: round(random.uniform(10, 5000), 2) for ticker in tickers}
+        self.requests: Counter = Counter()
+
+    async def _respond(self, route: str, body: dict) -> web.Response:
+        self.requests[route] += 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        return web.json_response(body)
+
+    async def board_securities(self, request: web.Request) -> web.Response:
+        requested = request.query.get('securities')
+        if requested:
+            data = [[secid, self.prices[secid], 'SUR'] for secid in requested.split(',') if secid in self.prices]
+            body = {'securities': {'data': data}}
+            if 'marketdata' in request.query.get('iss.only', ''):
+                # Intraday LAST for /watch; the fake market does not move
+                body['marketdata'] = {'data': [[secid, price] for secid, price, _ in data]}
+            return await self._respond('iss_prices', body)
+        data = [[secid, f'Company {secid}', price] for secid, price in self.prices.items()]
+        return await self._respond('iss_list', {'securities': {'data': data}})
+
+    async def board_security(self, request: web.Request) -> web.Response:
+        price = self.prices.get(request.match_info['secid'])
+        data = [[price, 'SUR']] if price is not None else []
+        return await self._respond('iss_price', {'securities': {'data': data}})
+
+    async def candles(self, request: web.Request) -> web.Response:
+        return await self._respond('iss_candles', {'candles': {'data': []}})
+
+    async def security(self, request: web.Request) -> web.Response:
+        secid = request.match_info['secid']
+        data = [[secid]] if secid in self.prices else []
+        return await self._respond('iss_security', {'boards': {'data': data}})
+
+    async def cbr(self, request: web.Request) -> web.Response:
+        day = time.strftime('%Y-%m-%d')
+        return await self._respond('cbr', {'Date': f'{day}T11:30:00+03:00', 'Valute': CBR_VALUTE})
+
+    async def cbr_archive(self, request: web.Request) -> web.Response:
+        day = '{year}-{month}-{day}'.format(**request.match_info)
+        return await self._respond('cbr_archive', {'Date': f'{day}T11:30:00+03:00', 'Valute': CBR_VALUTE})
+
+    def app(self) -> web.Application:
+        app = web.Application()
+        board = '/iss/engines/stock/markets/shares/boards/TQBR/securities'
+        app.router.add_get(f'{board}.json', self.board_securities)
+        app.router.add_get(board + '/{secid}/candles.json', self.candles)
+        app.router.add_get(board + '/{secid}.json', self.board_security)
+        app.router.add_get('/iss/securities/{secid}.json', self.security)
+        app.router.add_get('/cbr/daily_json.js', self.cbr)
+        app.router.add_get('/cbr/archive/{year}/{month}/{day}/daily_json.js', self.cbr_archive)
+        return app
+
+
+class FakeTelegram:
+    """Bot API stand-in: every method succeeds, sendMessage echoes a Message."""
+
+    def __init__(self, latency: float = 0.0):
+        self.latency = latency
+        self.calls: Counter = Counter()
+        self._message_ids = itertools.count(1)
+
+    async def handle(self, request: web.Request) -> web.Response:
+        method = request.match_info['method']
+        self.calls[method] += 1
+        form = await request.post()
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        result: object = True
+        if method in ('sendMessage', 'sendDocument', 'editMessageReplyMarkup'):
+            chat_id = int(form.get('chat_id', 0))
+            result = {'message_id': next(self._message_ids), 'date': int(time.time()),
+                      'chat': {'id': chat_id, 'type': 'private'}, 'text': form.get('text', '')}
+        elif method == 'copyMessage':
+            result = {'message_id': next(self._message_ids)}
+        elif method == 'getMe':
+            result = {'id': 1, 'is_bot': True, 'first_name': 'Benchmark', 'username': 'benchmark_bot'}
+        return web.json_response({'ok': True, 'result': result})
+
+    def app(self) -> web.Application:
+        app = web.Application()
+        app.router.add_post('/bot{token}/{method}', self.handle)
+        return app
+
+
+class ServerThread:
+    """Runs the fake servers on their own event loop, so they do not compete with the bot for CPU time."""
+
+    def __init__(self):
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self.loop.run_forever, name='fake-servers', daemon=True)
+        self.runners: List[web.AppRunner] = []
+
+    def start(self) -> None:
+        self.thread.start()
+
+    def serve(self, app: web.Application) -> str:
+        return asyncio.run_coroutine_threadsafe(self._serve(app), self.loop).result()
+
+    async def _serve(self, app: web.Application) -> str:
+        runner = web.AppRunner(app, access_log=None)
+        await runner.setup()
+        site = web.TCPSite(runner, '127.0.0.1', 0)
+        await site.start()
+        self.runners.append(runner)
+        port = site._server.sockets[0].getsockname()[1]
+        return f'http://127.0.0.1:{port}'
+
+    def stop(self) -> None:
+        async def cleanup():
+            for runner in self.runners:
+                await runner.cleanup()
+        asyncio.run_coroutine_threadsafe(cleanup(), self.loop).result()
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+
+
+def percentile(values: List[float], q: float) -> float:
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, round(q * (len(ordered) - 1)))]
+
+
+class LoadTest:
+    def __init__(self, bot_module, users: int, concurrency: int):
+        self.main = bot_module
+        self.users = users
+        self.concurrency = concurrency
+        self.latencies: Dict[str, List[float]] = defaultdict(list)
+        self.failures: Counter = Counter()
+        self._update_ids = itertools.count(1)
+
+    def _user(self, user_id: int) -> dict:
+        return {'id': user_id, 'is_bot': False, 'first_name': f'User {user_id}'}
+
+    def _message(self, user_id: int, text: str) -> dict:
+        return {'message_id': next(self._update_ids), 'date': int(time.time()),
+                'chat': {'id': user_id, 'type': 'private'}, 'from': self._user(user_id), 'text': text}
+
+    def message_update(self, user_id: int, text: str):
+        from aiogram.types import Update
+        return Update.model_validate({'update_id': next(self._update_ids), 'message': self._message(user_id, text)},
+                                     context={'bot': self.main.bot})
+
+    def callback_update(self, user_id: int, data: str):
+        from aiogram.types import Update
+        callback = {'id': str(next(self._update_ids)), 'from': self._user(user_id), 'chat_instance': str(user_id),
+                    'data': data, 'message': self._message(user_id, 'Добавить данную покупку в БД?')}
+        return Update.model_validate({'update_id': next(self._update_ids), 'callback_query': callback},
+                                     context={'bot': self.main.bot})
+
+    def scenario(self, user_id: int) -> List[Tuple[str, object]]:
+        ticker = random.choice(TICKERS)
+        steps = [('start', self.message_update(user_id, 'start'))]
+        for _ in range(random.randint(1, 3)):
+            steps += [('AddStock', self.message_update(user_id, 'AddStock')),
+                      ('AddStock: ticker', self.message_update(user_id, ticker)),
+                      ('AddStock: price', self.message_update(user_id, f'{random.uniform(10, 5000):.2f}')),
+                      ('AddStock: quantity', self.message_update(user_id, str(random.randint(1, 100))))]
+            ticker = random.choice(TICKERS)
+        steps += [('CheckPortfolio', self.message_update(user_id, 'CheckPortfolio')),
+                  ('USD_RUB', self.message_update(user_id, 'USD_RUB')),
+                  ('USD_RUB: amount', self.message_update(user_id, str(random.randint(1000, 100000)))),
+                  ('USD_RUB: confirm', self.callback_update(user_id, 'add_transaction_yes'))]
+        return steps
+
+    async def run_user(self, user_id: int, semaphore: asyncio.Semaphore) -> None:
+        async with semaphore:
+            for step, update in self.scenario(user_id):
+                started = time.perf_counter()
+                try:
+                    await self.main.dp.feed_update(self.main.bot, update)
+                except Exception as error:
+                    self.failures[f'{step}: {type(error).__name__}'] += 1
+                self.latencies[step].append(time.perf_counter() - started)
+
+    async def run(self) -> float:
+        semaphore = asyncio.Semaphore(self.concurrency)
+        started = time.perf_counter()
+        # Telegram ids of the synthetic users do not clash with real ones
+        await asyncio.gather(*(self.run_user(10 ** 12 + user, semaphore) for user in range(self.users)))
+        return time.perf_counter() - started
+
+
+async def benchmark(args) -> dict:
+    upstream, telegram = FakeUpstream(args.upstream_latency / 1000), FakeTelegram(args.telegram_latency / 1000)
+    servers = ServerThread()
+    servers.start()
+    upstream_url = servers.serve(upstream.app())
+    telegram_url = servers.serve(telegram.app())
+
+    # The bot reads its configuration when it is imported
+    work_dir = tempfile.TemporaryDirectory()
+    os.environ.update({
+        'API_TOKEN': '123456:BENCHMARK', 'DB_PATH': os.path.join(work_dir.name, 'benchmark.db'),
+        'ISS_URL': f'{upstream_url}/iss', 'CBR_DAILY_URL': f'{upstream_url}/cbr/daily_json.js',
+        'CBR_ARCHIVE_URL': f'{upstream_url}/cbr/archive/{{day:%Y/%m/%d}}/daily_json.js',
+        'FSM_STORAGE': args.fsm_storage, 'METRICS_PORT': '0',
+    })
+    if not args.rate_limits:
+        os.environ.update({'OUTBOX_GLOBAL_RATE': '1000000', 'OUTBOX_CHAT_RATE': '1000000',
+                           'OUTBOX_CHAT_BURST': '1000000', 'USER_RATE': '1000000', 'USER_BURST': '1000000'})
+    bot_module = importlib.import_module('main')
+    from aiogram.client.telegram import TelegramAPIServer
+    bot_module.bot.session.api = TelegramAPIServer.from_base(telegram_url)
+
+    dp = bot_module.dp
+    dp.startup.register(bot_module.on_startup)
+    dp.shutdown.register(bot_module.on_shutdown)
+    await dp.emit_startup(bot=bot_module.bot)
+
+    if args.tracemalloc:
+        tracemalloc.start()
+    test = LoadTest(bot_module, args.users, args.concurrency)
+    try:
+        elapsed = await test.run()
+    finally:
+        await dp.emit_shutdown(bot=bot_module.bot)
+        await bot_module.bot.session.close()
+        servers.stop()
+        work_dir.cleanup()
+
+    updates = sum(len(values) for values in test.latencies.values())
+    return {
+        'users': args.users,
+        'concurrency': args.concurrency,
+        'updates': updates,
+        'seconds': round(elapsed, 3),
+        'updates_per_second': round(updates / elapsed, 1),
+        'steps': {step: {'count': len(values),
+                         'p50_ms': round(percentile(values, 0.5) * 1000, 2),
+                         'p99_ms': round(percentile(values, 0.99) * 1000, 2),
+                         'max_ms': round(max(values) * 1000, 2)}
+                  for step, values in test.latencies.items()},
+        'failures': dict(test.failures),
+        'upstream_requests': dict(upstream.requests),
+        'telegram_calls': dict(telegram.calls),
+        # ru_maxrss is in KiB on Linux
+        'max_rss_mb': round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+        'traced_peak_mb': round(tracemalloc.get_traced_memory()[1] / 2 ** 20, 1) if args.tracemalloc else None,
+    }
+
+
+def print_report(result: dict) -> None:
+    print(f"{result['updates']} updates from {result['users']} users in {result['seconds']} s: "
+          f"{result['updates_per_second']} updates/s")
+    print(f"{'step':<22}{'count':>8}{'p50 ms':>10}{'p99 ms':>10}{'max ms':>10}")
+    for step, stats in result['steps'].items():
+        print(f"{step:<22}{stats['count']:>8}{stats['p50_ms']:>10}{stats['p99_ms']:>10}{stats['max_ms']:>10}")
+    print(f"upstream requests: {result['upstream_requests']}")
+    print(f"telegram calls: {result['telegram_calls']}")
+    print(f"max RSS: {result['max_rss_mb']} MB" +
+          (f", traced peak: {result['traced_peak_mb']} MB" if result['traced_peak_mb'] is not None else ''))
+    if result['failures']:
+        print(f"failures: {result['failures']}")
+
+
+def check_limits(result: dict, args) -> List[str]:
+    problems = []
+    if result['failures']:
+        problems.append(f"{sum(result['failures'].values())} updates failed")
+    if args.max_p99 is not None:
+        problems += [f"{step}: p99 {stats['p99_ms']} ms > {args.max_p99} ms"
+                     for step, stats in result['steps'].items() if stats['p99_ms'] > args.max_p99]
+    if args.min_throughput is not None and result['updates_per_second'] < args.min_throughput:
+        problems.append(f"throughput {result['updates_per_second']} < {args.min_throughput} updates/s")
+    return problems
+
+
+def parse_args(argv: Optional[List[str]] = None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--users', type=int, default=1000)
+    parser.add_argument('--concurrency', type=int, default=100, help='users active at the same time')
+    parser.add_argument('--upstream-latency', type=float, default=20, help='ISS/CBR response delay, ms')
+    parser.add_argument('--telegram-latency', type=float, default=5, help='Bot API response delay, ms')
+    parser.add_argument('--fsm-storage', default='memory', choices=['memory', 'sqlite'])
+    parser.add_argument('--rate-limits', action='store_true', help='keep the Telegram send and per-user rate limits')
+    parser.add_argument('--tracemalloc', action='store_true', help='trace Python allocations (slower)')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--json', help='also write the results to this file')
+    parser.add_argument('--max-p99', type=float, help='fail when any step has a higher p99, ms')
+    parser.add_argument('--min-throughput', type=float, help='fail below this many updates/s')
+    return parser.parse_args(argv)
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    args = parse_args(argv)
+    random.seed(args.seed)
+    result = asyncio.run(benchmark(args))
+    print_report(result)
+    if args.json:
+        with open(args.json, 'w') as file:
+            json.dump(result, file, indent=2, ensure_ascii=False)
+    problems = check_limits(result, args)
+    for problem in problems:
+        print(f'FAIL: {problem}', file=sys.stderr)
+    return 1 if problems else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,223 @@
+import asyncio
+import logging
+import os
+import sqlite3
+import time
+from datetime import date, timedelta
+from typing import Awaitable, Callable, Dict, Iterable, List, Optional, Sequence, Tuple
+
+import numpy as np
+
+import database
+import market_data
+from db_executor import DatabaseExecutor, db_executor
+
+
+logger = logging.getLogger(__name__)
+
+# How far back the history of a newly seen ticker is downloaded
+CANDLES_HISTORY_DAYS = int(os.getenv('CANDLES_HISTORY_DAYS', 730))
+# Stored candles are topped up from ISS at most this often per ticker
+CANDLES_MAX_AGE = float(os.getenv('CANDLES_MAX_AGE', 3600))
+CANDLES_REFRESH_INTERVAL = float(os.getenv('CANDLES_REFRESH_INTERVAL', 6 * 3600))
+# ISS returns at most 500 candles per page
+ISS_PAGE_SIZE = 500
+# Parallel ISS downloads when many tickers are synced at once
+SYNC_CONCURRENCY = 8
+
+SPARK_BARS = '▁▂▃▄▅▆▇█'
+
+
+class CandleSeries:
+    """Daily closes of one ticker as two parallel arrays ordered by day."""
+
+    __slots__ = ('days', 'close')
+
+    def __init__(self, days: Sequence = (), close: Sequence = ()):
+        self.days = np.asarray(days, dtype='datetime64[D]')
+        self.close = np.asarray(close, dtype=np.float64)
+
+    def __len__(self) -> int:
+        return len(self.days)
+
+    @property
+    def last_day(self) -> Optional[date]:
+        return self.days[-1].astype(date) if len(self.days) else None
+
+    def append(self, days: Sequence, close: Sequence) -> int:
+        """Add candles newer than the last stored one; the last day itself is overwritten.
+
+        Returns the number of new days.
+        """
+        days = np.asarray(days, dtype='datetime64[D]')
+        close = np.asarray(close, dtype=np.float64)
+        if len(self.days):
+            # Today's candle keeps changing until the session closes
+            same = days == self.days[-1]
+            if same.any():
+                self.close[-1] = close[same][-1]
+            newer = days > self.days[-1]
+            days, close = days[newer], close[newer]
+        if len(days):
+            self.days = np.concatenate((self.days, days))
+            self.close = np.concatenate((self.close, close))
+        return len(days)
+
+    def asof(self, days: np.ndarray) -> np.ndarray:
+        """Close on each of ``days``, carried forward over days without trading; NaN before the first candle."""
+        if not len(self.days):
+            return np.full(len(days), np.nan)
+        index = np.searchsorted(self.days, days, side='right') - 1
+        return np.where(index >= 0, self.close[np.maximum(index, 0)], np.nan)
+
+
+async def download_candles(stock_id: str, start: date, till: date) -> Optional[List[Tuple[str, float]]]:
+    """Daily ``(day, close)`` candles of ``stock_id`` from ISS, or None if the download failed."""
+    url = f'{market_data.ISS_URL}/engines/stock/markets/shares/boards/TQBR/securities/{stock_id}/candles.json'
+    candles = []
+    while True:
+        params = {'interval': '24', 'from': start.isoformat(), 'till': till.isoformat(), 'start': str(len(candles)),
+                  'iss.meta': 'off', 'iss.only': 'candles', 'candles.columns': 'begin,close'}
+        data_json = await market_data.client.get_json(url, params)
+        if data_json is None:
+            return None
+        page = data_json.get('candles', {}).get('data', [])
+        # begin is 'YYYY-MM-DD 00:00:00'
+        candles.extend((begin[:10], close) for begin, close in page if close is not None)
+        if len(page) < ISS_PAGE_SIZE:
+            return candles
+
+
+class CandleStore:
+    """Daily candles of the held tickers, persisted in SQLite and kept in memory as arrays.
+
+    A ticker is loaded from the database on first use and then topped up with the
+    candles ISS published since the last stored day.
+    """
+
+    def __init__(self, executor: DatabaseExecutor = db_executor, history_days: int = CANDLES_HISTORY_DAYS,
+                 max_age: float = CANDLES_MAX_AGE, today: Callable[[], date] = date.today):
+        self.executor = executor
+        self.history_days = history_days
+        self.max_age = max_age
+        self.today = today
+        self.series: Dict[str, CandleSeries] = {}
+        # stock_id -> time.monotonic() of the last successful download
+        self._synced: Dict[str, float] = {}
+        self._locks: Dict[str, asyncio.Lock] = {}
+        self._semaphore = asyncio.Semaphore(SYNC_CONCURRENCY)
+
+    async def get(self, stock_id: str) -> CandleSeries:
+        """Stored candles of ``stock_id`` without going to the exchange."""
+        series = self.series.get(stock_id)
+        if series is None:
+            rows = await self.executor.read(database.select_candles, stock_id)
+            series = self.series.setdefault(stock_id, CandleSeries(*zip(*rows)) if rows else CandleSeries())
+        return series
+
+    async def sync(self, stock_id: str, force: bool = False) -> CandleSeries:
+        stock_id = stock_id.upper()
+        lock = self._locks.setdefault(stock_id, asyncio.Lock())
+        # Concurrent requests for the same ticker wait for a single download
+        async with lock:
+            series = await self.get(stock_id)
+            synced = self._synced.get(stock_id)
+            if not force and synced is not None and time.monotonic() - synced < self.max_age:
+                return series
+            today = self.today()
+            start = series.last_day or today - timedelta(days=self.history_days)
+            async with self._semaphore:
+                candles = await download_candles(stock_id, start, today)
+            if candles is None:
+                return series
+            if candles:
+                await self.executor.write(database.upsert_candles, stock_id, candles)
+                days, close = zip(*candles)
+                series.append(days, close)
+            self._synced[stock_id] = time.monotonic()
+            return series
+
+    async def sync_many(self, stock_ids: Iterable[str], force: bool = False) -> Dict[str, CandleSeries]:
+        stock_ids = list(dict.fromkeys(stock_id.upper() for stock_id in stock_ids))
+        series = await asyncio.gather(*(self.sync(stock_id, force) for stock_id in stock_ids))
+        return dict(zip(stock_ids, series))
+
+    async def run_updater(self, tickers: Callable[[], Awaitable[List[str]]],
+                          interval: float = CANDLES_REFRESH_INTERVAL) -> None:
+        """Top up the candles of ``tickers()`` every ``interval`` seconds."""
+        while True:
+            try:
+                await self.sync_many(await tickers(), force=True)
+            except Exception:
+                logger.exception('Failed to update candles')
+            await asyncio.sleep(interval)
+
+
+def trading_days(series: Iterable[CandleSeries], start: date, end: date) -> np.ndarray:
+    """Sorted union of the days any of ``series`` traded within ``[start, end]``."""
+    start, end = np.datetime64(start, 'D'), np.datetime64(end, 'D')
+    chunks = [item.days[(item.days >= start) & (item.days <= end)] for item in series]
+    return np.unique(np.concatenate(chunks)) if chunks else np.array([], dtype='datetime64[D]')
+
+
+def portfolio_history(lots: Iterable[Tuple[str, int, int, str]], series: Dict[str, CandleSeries],
+                      days: np.ndarray, chunk_size: int = database.STREAM_CHUNK_SIZE) -> Tuple[np.ndarray, np.ndarray]:
+    """Market value and invested amount of ``lots`` on each of ``days``.
+
+    ``lots`` are rows of ``database.iter_user_lots``. A lot counts from its
+    purchase day; lots bought before ``days[0]`` or saved without a date are
+    held from the start. The
+    holdings of every ticker over time are built with a scatter-add per chunk of
+    ``chunk_size`` lots and one cumulative sum, so the cost does not grow with a
+    Python loop over lots and memory does not grow with their number.
+    """
+    row_of: Dict[str, int] = {}
+    held = np.zeros((0, len(days) + 1))
+    invested = np.zeros(len(days) + 1)
+    for chunk in database.iter_chunks(lots, chunk_size):
+        stock_ids, quantity, unit_price_minor, purchase_date = zip(*chunk)
+        for stock_id in stock_ids:
+            row_of.setdefault(stock_id, len(row_of))
+        if len(row_of) > len(held):
+            held = np.vstack([held, np.zeros((len(row_of) - len(held), len(days) + 1))])
+
+        rows = np.fromiter((row_of[stock_id] for stock_id in stock_ids), dtype=np.intp, count=len(chunk))
+        quantity = np.asarray(quantity, dtype=np.float64)
+        cost = quantity * np.asarray(unit_price_minor, dtype=np.float64) / 100
+        # purchase_date is ISO 'YYYY-MM-DDTHH:MM:SS' or '' (NaT) for lots of the first bot versions
+        purchased = np.array([moment[:10] for moment in purchase_date], dtype='datetime64[D]')
+        # Index of the first day the lot is held; len(days) for lots bought after the period
+        columns = np.where(np.isnat(purchased), 0, np.searchsorted(days, purchased))
+        np.add.at(held, (rows, columns), quantity)
+        np.add.at(invested, columns, cost)
+
+    if not row_of:
+        return np.zeros(len(days)), np.zeros(len(days))
+    held = held.cumsum(axis=1)[:, :-1]
+    invested = invested.cumsum()[:-1]
+
+    empty = CandleSeries()
+    prices = np.vstack([series.get(stock_id, empty).asof(days) for stock_id in row_of])
+    # Days a ticker has no price yet contribute nothing
+    values = np.where(held > 0, held * prices, 0.0)
+    return np.nan_to_num(values).sum(axis=0), invested
+
+
+def user_portfolio_history(conn: sqlite3.Connection, owner_id: int, series: Dict[str, CandleSeries],
+                           days: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """``portfolio_history`` of the user's lots streamed from the cursor; runs on a DB reader thread."""
+    return portfolio_history(database.iter_user_lots(conn, owner_id), series, days)
+
+
+def sparkline(values: np.ndarray, width: int = 30) -> str:
+    if not len(values):
+        return ''
+    points = values[np.linspace(0, len(values) - 1, min(width, len(values))).round().astype(int)]
+    low, high = points.min(), points.max()
+    if high == low:
+        return SPARK_BARS[0] * len(points)
+    levels = ((points - low) / (high - low) * (len(SPARK_BARS) - 1)).round().astype(int)
+    return ''.join(SPARK_BARS[level] for level in levels)
+
+
+candle_store = CandleStore()
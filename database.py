@@ -0,0 +1,269 @@
+import os
+import sqlite3
+import threading
+from datetime import datetime
+from itertools import islice
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple, Union
+
+from migrations import migrate
+
+
+DB_PATH = os.getenv('DB_PATH', './app_data/database.db')
+
+# WAL lets readers work while a write is in progress; synchronous=NORMAL is safe with WAL
+# and only fsyncs on checkpoints. A negative cache_size is measured in KiB.
+PRAGMAS = (
+    'PRAGMA journal_mode = WAL',
+    'PRAGMA synchronous = NORMAL',
+    'PRAGMA cache_size = -16000',
+    'PRAGMA temp_store = MEMORY',
+    'PRAGMA busy_timeout = 5000',
+    'PRAGMA foreign_keys = ON',
+)
+
+# Rows fetched at a time when a user's lots are streamed
+STREAM_CHUNK_SIZE = 500
+
+# Statements are module constants: sqlite3 keeps a per-connection cache of prepared
+# statements keyed by the SQL text, so every call after the first reuses the compiled one.
+SELECT_USER = 'SELECT * FROM users WHERE telegram_id = ?'
+INSERT_USER = 'INSERT OR IGNORE INTO users (telegram_id) VALUES (?)'
+INSERT_STOCK = ('INSERT INTO stocks (owner_id, stock_id, quantity, unit_price_minor, purchase_date) '
+                'VALUES (?, ?, ?, ?, ?)')
+SELECT_USER_STOCKS = ('SELECT owner_id, stock_id, quantity, unit_price_minor / 100.0, purchase_date '
+                      'FROM stocks WHERE owner_id = ? ORDER BY id')
+SELECT_USER_POSITIONS = ('SELECT stock_id, quantity, cost_minor, lot_count FROM positions '
+                         'WHERE owner_id = ? ORDER BY stock_id')
+SELECT_HELD_TICKERS = 'SELECT DISTINCT stock_id FROM positions ORDER BY stock_id'
+SELECT_SHARD_HELD_TICKERS = 'SELECT DISTINCT stock_id FROM positions WHERE owner_id % ? = ? ORDER BY stock_id'
+SELECT_USER_LOTS = ('SELECT stock_id, quantity, unit_price_minor, purchase_date FROM stocks '
+                    'WHERE owner_id = ? ORDER BY id')
+INSERT_ALERT = ('INSERT INTO alerts (owner_id, chat_id, stock_id, direction, threshold_minor, created_at) '
+                'VALUES (?, ?, ?, ?, ?, ?)')
+SELECT_ACTIVE_ALERTS = ('SELECT id, owner_id, chat_id, stock_id, direction, threshold_minor FROM alerts '
+                        'WHERE triggered_at IS NULL')
+SELECT_USER_ALERTS = ('SELECT id, owner_id, chat_id, stock_id, direction, threshold_minor FROM alerts '
+                      'WHERE owner_id = ? AND triggered_at IS NULL ORDER BY id')
+MARK_ALERT_TRIGGERED = 'UPDATE alerts SET triggered_at = ? WHERE id = ?'
+DELETE_ALERT = 'DELETE FROM alerts WHERE id = ?'
+SELECT_FSM_RECORD = 'SELECT state, data FROM fsm WHERE key = ? AND expires_at > ?'
+# A record that has already expired starts over instead of reviving its old state/data
+SET_FSM_STATE = ('''INSERT INTO fsm (key, state, expires_at) VALUES (?1, ?2, ?4)
+                   ON CONFLICT (key) DO UPDATE SET
+                       state = excluded.state,
+                       data = CASE WHEN fsm.expires_at > ?3 THEN fsm.data ELSE '{}' END,
+                       expires_at = excluded.expires_at''')
+SET_FSM_DATA = ('''INSERT INTO fsm (key, data, expires_at) VALUES (?1, ?2, ?4)
+                  ON CONFLICT (key) DO UPDATE SET
+                      state = CASE WHEN fsm.expires_at > ?3 THEN fsm.state END,
+                      data = excluded.data,
+                      expires_at = excluded.expires_at''')
+DELETE_EMPTY_FSM = "DELETE FROM fsm WHERE key = ? AND state IS NULL AND data = '{}'"
+DELETE_EXPIRED_FSM = 'DELETE FROM fsm WHERE expires_at <= ?'
+# The candle of the current day changes until the session closes
+UPSERT_CANDLE = 'INSERT OR REPLACE INTO candles (stock_id, day, close) VALUES (?, ?, ?)'
+SELECT_CANDLES = 'SELECT day, close FROM candles WHERE stock_id = ? ORDER BY day'
+UPSERT_FX_RATE = 'INSERT OR REPLACE INTO fx_rates (day, currency, rub_per_unit) VALUES (?, ?, ?)'
+SELECT_FX_RATES = 'SELECT currency, rub_per_unit FROM fx_rates WHERE day = ?'
+INSERT_DOLLAR_PURCHASE = 'INSERT INTO currency (owner_id, amount_minor, purchase_date) VALUES (?, ?, ?)'
+SELECT_USER_DOLLAR_PURCHASES = 'SELECT amount_minor, purchase_date FROM currency WHERE owner_id = ? ORDER BY id'
+
+
+def to_minor(amount: Union[str, float, int]) -> int:
+    """Convert a price in roubles/dollars to integer kopecks/cents."""
+    return round(float(amount) * 100)
+
+
+def to_iso(moment: Union[datetime, str]) -> str:
+    if isinstance(moment, datetime):
+        return moment.isoformat()
+    return str(moment).replace(' ', 'T')
+
+
+class Database:
+    """Owner of the long-lived SQLite connection used by the bot."""
+
+    def __init__(self, path: str = DB_PATH):
+        self.path = path
+        self._connection: Optional[sqlite3.Connection] = None
+        self._lock = threading.Lock()
+
+    def connect(self) -> sqlite3.Connection:
+        """Open a new connection configured with the bot's pragmas."""
+        conn = sqlite3.connect(self.path, check_same_thread=False, cached_statements=256)
+        for pragma in PRAGMAS:
+            conn.execute(pragma)
+        return conn
+
+    def init_schema(self, conn: sqlite3.Connection) -> None:
+        migrate(conn)
+
+    @property
+    def connection(self) -> sqlite3.Connection:
+        # The connection is opened and the schema is created once, on first use
+        if self._connection is None:
+            with self._lock:
+                if self._connection is None:
+                    conn = self.connect()
+                    self.init_schema(conn)
+                    self._connection = conn
+        return self._connection
+
+    def close(self) -> None:
+        with self._lock:
+            if self._connection is not None:
+                self._connection.close()
+                self._connection = None
+
+
+db = Database()
+
+
+def get_user(conn: sqlite3.Connection, telegram_id: int) -> Optional[Tuple]:
+    return conn.execute(SELECT_USER, (telegram_id,)).fetchone()
+
+
+def insert_user(conn: sqlite3.Connection, telegram_id: int) -> Optional[int]:
+    cursor = conn.execute(INSERT_USER, (telegram_id,))
+    # rowcount is 0 when the user already exists
+    return cursor.lastrowid if cursor.rowcount else None
+
+
+def insert_stock(conn: sqlite3.Connection, owner_id: int, stock_id: str, quantity: int,
+                 unit_price: Union[str, float], purchase_date: Union[datetime, str]) -> int:
+    # Lots may be added before the user pressed 'start', the owner row has to exist for the foreign key
+    conn.execute(INSERT_USER, (owner_id,))
+    values = (owner_id, stock_id.upper(), int(quantity), to_minor(unit_price), to_iso(purchase_date))
+    cursor = conn.execute(INSERT_STOCK, values)
+    return cursor.lastrowid
+
+
+def insert_stocks(conn: sqlite3.Connection, owner_id: int,
+                  lots: Iterable[Tuple[str, int, Union[str, float], Union[datetime, str]]]) -> int:
+    """Insert ``(stock_id, quantity, unit_price, purchase_date)`` lots with one executemany."""
+    conn.execute(INSERT_USER, (owner_id,))
+    values = ((owner_id, stock_id.upper(), int(quantity), to_minor(unit_price), to_iso(purchase_date))
+              for stock_id, quantity, unit_price, purchase_date in lots)
+    return conn.executemany(INSERT_STOCK, values).rowcount
+
+
+def iter_chunks(rows: Iterable[Tuple], chunk_size: int = STREAM_CHUNK_SIZE) -> Iterator[List[Tuple]]:
+    """Lists of up to ``chunk_size`` rows, e.g. of a streamed ``iter_user_lots``."""
+    rows = iter(rows)
+    while True:
+        chunk = list(islice(rows, chunk_size))
+        if not chunk:
+            return
+        yield chunk
+
+
+def _iter_rows(conn: sqlite3.Connection, sql: str, params: tuple, chunk_size: int) -> Iterator[Tuple]:
+    """Rows of ``sql`` read from the cursor ``chunk_size`` at a time."""
+    cursor = conn.execute(sql, params)
+    try:
+        while True:
+            rows = cursor.fetchmany(chunk_size)
+            if not rows:
+                return
+            yield from rows
+    finally:
+        cursor.close()
+
+
+def iter_user_stocks(conn: sqlite3.Connection, owner_id: int, chunk_size: int = STREAM_CHUNK_SIZE) -> Iterator[Tuple]:
+    """``(owner_id, stock_id, quantity, unit_price, purchase_date)`` of every lot, streamed from the cursor."""
+    return _iter_rows(conn, SELECT_USER_STOCKS, (owner_id,), chunk_size)
+
+
+def iter_user_lots(conn: sqlite3.Connection, owner_id: int, chunk_size: int = STREAM_CHUNK_SIZE) -> Iterator[Tuple]:
+    """``(stock_id, quantity, unit_price_minor, purchase_date)`` of every lot, streamed from the cursor."""
+    return _iter_rows(conn, SELECT_USER_LOTS, (owner_id,), chunk_size)
+
+
+def iter_user_dollar_purchases(conn: sqlite3.Connection, owner_id: int,
+                               chunk_size: int = STREAM_CHUNK_SIZE) -> Iterator[Tuple]:
+    """``(amount_minor, purchase_date)`` of every dollar purchase, streamed from the cursor."""
+    return _iter_rows(conn, SELECT_USER_DOLLAR_PURCHASES, (owner_id,), chunk_size)
+
+
+def select_user_dollar_purchases(conn: sqlite3.Connection, owner_id: int) -> List[Tuple]:
+    """``(amount_minor, purchase_date)`` of every dollar purchase."""
+    return conn.execute(SELECT_USER_DOLLAR_PURCHASES, (owner_id,)).fetchall()
+
+
+def select_user_positions(conn: sqlite3.Connection, owner_id: int) -> List[Tuple]:
+    """Aggregated holdings: ``(stock_id, quantity, cost_minor, lot_count)`` per ticker."""
+    return conn.execute(SELECT_USER_POSITIONS, (owner_id,)).fetchall()
+
+
+def select_held_tickers(conn: sqlite3.Connection, worker_index: int = 0, worker_count: int = 1) -> List[str]:
+    """Tickers anyone holds; with several workers only those of the users of ``worker_index``."""
+    if worker_count > 1:
+        return [stock_id for stock_id, in conn.execute(SELECT_SHARD_HELD_TICKERS, (worker_count, worker_index))]
+    return [stock_id for stock_id, in conn.execute(SELECT_HELD_TICKERS)]
+
+
+def insert_dollar_purchase(conn: sqlite3.Connection, owner_id: int, dollar_purchase: Union[str, float],
+                           purchase_date: Optional[datetime] = None) -> int:
+    conn.execute(INSERT_USER, (owner_id,))
+    values = (owner_id, to_minor(dollar_purchase), to_iso(purchase_date or datetime.now()))
+    cursor = conn.execute(INSERT_DOLLAR_PURCHASE, values)
+    return cursor.lastrowid
+
+
+def insert_alert(conn: sqlite3.Connection, owner_id: int, chat_id: int, stock_id: str, direction: str,
+                 threshold_minor: int, created_at: datetime) -> int:
+    conn.execute(INSERT_USER, (owner_id,))
+    values = (owner_id, chat_id, stock_id, direction, threshold_minor, to_iso(created_at))
+    return conn.execute(INSERT_ALERT, values).lastrowid
+
+
+def select_active_alerts(conn: sqlite3.Connection) -> List[Tuple]:
+    return conn.execute(SELECT_ACTIVE_ALERTS).fetchall()
+
+
+def select_user_alerts(conn: sqlite3.Connection, owner_id: int) -> List[Tuple]:
+    return conn.execute(SELECT_USER_ALERTS, (owner_id,)).fetchall()
+
+
+def mark_alerts_triggered(conn: sqlite3.Connection, alert_ids: List[int], triggered_at: datetime) -> None:
+    triggered_at = to_iso(triggered_at)
+    conn.executemany(MARK_ALERT_TRIGGERED, ((triggered_at, alert_id) for alert_id in alert_ids))
+
+
+def delete_alert(conn: sqlite3.Connection, alert_id: int) -> None:
+    conn.execute(DELETE_ALERT, (alert_id,))
+
+
+def get_fsm_record(conn: sqlite3.Connection, key: str, now: float) -> Optional[Tuple[Optional[str], str]]:
+    return conn.execute(SELECT_FSM_RECORD, (key, now)).fetchone()
+
+
+def set_fsm_state(conn: sqlite3.Connection, key: str, state: Optional[str], now: float, expires_at: float) -> None:
+    conn.execute(SET_FSM_STATE, (key, state, now, expires_at))
+    conn.execute(DELETE_EMPTY_FSM, (key,))
+
+
+def set_fsm_data(conn: sqlite3.Connection, key: str, data: str, now: float, expires_at: float) -> None:
+    conn.execute(SET_FSM_DATA, (key, data, now, expires_at))
+    conn.execute(DELETE_EMPTY_FSM, (key,))
+
+
+def delete_expired_fsm(conn: sqlite3.Connection, now: float) -> int:
+    return conn.execute(DELETE_EXPIRED_FSM, (now,)).rowcount
+
+
+def upsert_candles(conn: sqlite3.Connection, stock_id: str, candles: List[Tuple[str, float]]) -> None:
+    conn.executemany(UPSERT_CANDLE, ((stock_id, day, close) for day, close in candles))
+
+
+def select_candles(conn: sqlite3.Connection, stock_id: str) -> List[Tuple[str, float]]:
+    return conn.execute(SELECT_CANDLES, (stock_id,)).fetchall()
+
+
+def upsert_fx_rates(conn: sqlite3.Connection, day: str, rates: Dict[str, float]) -> None:
+    conn.executemany(UPSERT_FX_RATE, ((day, currency, rate) for currency, rate in rates.items()))
+
+
+def select_fx_rates(conn: sqlite3.Connection, day: str) -> List[Tuple[str, float]]:
+    return conn.execute(SELECT_FX_RATES, (day,)).fetchall()
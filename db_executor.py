@@ -0,0 +1,167 @@
+import asyncio
+import logging
+import queue
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, List, Optional
+
+from database import Database, db
+from metrics import registry
+
+
+logger = logging.getLogger(__name__)
+
+# Sentinel that tells the writer thread to stop
+_STOP = object()
+
+
+def _name(operation: Callable) -> str:
+    return getattr(operation, '__name__', type(operation).__name__)
+
+
+def _resolve(future: asyncio.Future, result: Any = None, error: Optional[BaseException] = None) -> None:
+    # Runs on the event loop; the awaiting handler may have been cancelled meanwhile
+    if future.done():
+        return
+    if error is not None:
+        future.set_exception(error)
+    else:
+        future.set_result(result)
+
+
+class DatabaseExecutor:
+    """Runs SQLite work off the event loop.
+
+    Reads go to a small pool of reader threads, each with its own connection.
+    Writes go through a queue to a single writer thread that takes everything
+    queued at the moment and commits it in one transaction; every operation
+    runs in its own savepoint, so one failing write does not roll back the
+    others.
+
+    Operations are plain functions taking a connection as their first
+    argument, like the ones in ``database.py``.
+    """
+
+    def __init__(self, database: Database = db, readers: int = 2, max_batch: int = 200):
+        self.database = database
+        self.readers = readers
+        self.max_batch = max_batch
+        self._queue: 'queue.Queue' = queue.Queue()
+        self._writer: Optional[threading.Thread] = None
+        self._reader_pool: Optional[ThreadPoolExecutor] = None
+        self._local = threading.local()
+        self._reader_connections: List = []
+        self._lock = threading.Lock()
+
+    @property
+    def started(self) -> bool:
+        return self._writer is not None
+
+    def start(self) -> None:
+        with self._lock:
+            if self._writer is not None:
+                return
+            # Make sure the schema exists before the worker threads open their connections
+            self.database.connection
+            self._reader_pool = ThreadPoolExecutor(max_workers=self.readers, thread_name_prefix='db-reader')
+            self._writer = threading.Thread(target=self._write_loop, name='db-writer', daemon=True)
+            self._writer.start()
+
+    def stop(self) -> None:
+        with self._lock:
+            if self._writer is None:
+                return
+            self._queue.put(_STOP)
+            self._writer.join()
+            self._writer = None
+            self._reader_pool.shutdown(wait=True)
+            self._reader_pool = None
+            for conn in self._reader_connections:
+                conn.close()
+            self._reader_connections.clear()
+            self._local = threading.local()
+
+    def _reader_connection(self):
+        conn = getattr(self._local, 'connection', None)
+        if conn is None:
+            conn = self.database.connect()
+            self._local.connection = conn
+            self._reader_connections.append(conn)
+        return conn
+
+    def _run_read(self, operation: Callable, args: tuple) -> Any:
+        return operation(self._reader_connection(), *args)
+
+    async def read(self, operation: Callable, *args) -> Any:
+        """Run ``operation(conn, *args)`` on a reader thread."""
+        self.start()
+        loop = asyncio.get_running_loop()
+        # Includes the wait for a free reader thread
+        with registry.timer('db_seconds', operation=_name(operation), kind='read'):
+            return await loop.run_in_executor(self._reader_pool, self._run_read, operation, args)
+
+    async def write(self, operation: Callable, *args) -> Any:
+        """Queue ``operation(conn, *args)`` for the writer thread and wait until it is committed."""
+        self.start()
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        # Includes the wait for the batch commit
+        with registry.timer('db_seconds', operation=_name(operation), kind='write'):
+            self._queue.put((operation, args, loop, future))
+            return await future
+
+    def _write_loop(self) -> None:
+        conn = self.database.connect()
+        # Transactions are managed explicitly below
+        conn.isolation_level = None
+        try:
+            while True:
+                item = self._queue.get()
+                if item is _STOP:
+                    return
+                batch = [item]
+                stop = False
+                while len(batch) < self.max_batch:
+                    try:
+                        item = self._queue.get_nowait()
+                    except queue.Empty:
+                        break
+                    if item is _STOP:
+                        stop = True
+                        break
+                    batch.append(item)
+                self._commit_batch(conn, batch)
+                if stop:
+                    return
+        finally:
+            conn.close()
+
+    def _commit_batch(self, conn, batch: list) -> None:
+        results = []
+        try:
+            conn.execute('BEGIN IMMEDIATE')
+            for operation, args, loop, future in batch:
+                conn.execute('SAVEPOINT operation')
+                try:
+                    result = operation(conn, *args)
+                except Exception as error:
+                    conn.execute('ROLLBACK TO operation')
+                    results.append((None, error))
+                else:
+                    results.append((result, None))
+                conn.execute('RELEASE operation')
+            conn.execute('COMMIT')
+        except Exception as error:
+            logger.exception('Failed to commit a batch of %s writes', len(batch))
+            if conn.in_transaction:
+                conn.execute('ROLLBACK')
+            results = [(None, error)] * len(batch)
+        for (operation, args, loop, future), (result, error) in zip(batch, results):
+            try:
+                loop.call_soon_threadsafe(_resolve, future, result, error)
+            except RuntimeError:
+                # The event loop that queued the write is already closed
+                pass
+
+
+db_executor = DatabaseExecutor()
@@ -0,0 +1,43 @@
+import csv
+import os
+import sqlite3
+import tempfile
+from typing import Iterator, List, Optional
+
+import database
+
+
+EXPORT_HEADER = ['type', 'ticker', 'quantity', 'price', 'amount_usd', 'date']
+
+
+def _money(amount_minor: int) -> str:
+    # Exact decimal text, no float rounding
+    sign = '-' if amount_minor < 0 else ''
+    amount_minor = abs(amount_minor)
+    return f'{sign}{amount_minor // 100}.{amount_minor % 100:02d}'
+
+
+def export_rows(conn: sqlite3.Connection, owner_id: int) -> Iterator[List[str]]:
+    """CSV rows of the user's lots followed by their dollar purchases, streamed from the database."""
+    yield EXPORT_HEADER
+    for stock_id, quantity, unit_price_minor, purchase_date in database.iter_user_lots(conn, owner_id):
+        yield ['stock', stock_id, str(quantity), _money(unit_price_minor), '', purchase_date]
+    for amount_minor, purchase_date in database.iter_user_dollar_purchases(conn, owner_id):
+        yield ['usd', '', '', '', _money(amount_minor), purchase_date or '']
+
+
+def write_export(conn: sqlite3.Connection, owner_id: int, directory: Optional[str] = None) -> str:
+    """Write the user's export to a new CSV file and return its path.
+
+    Rows go to the file as they are read, so memory use does not depend on the
+    size of the history. Meant to run on a DB executor reader thread.
+    """
+    handle, path = tempfile.mkstemp(prefix=f'export_{owner_id}_', suffix='.csv', dir=directory)
+    try:
+        # utf-8-sig: Excel opens the file with the right encoding
+        with os.fdopen(handle, 'w', encoding='utf-8-sig', newline='') as file:
+            csv.writer(file).writerows(export_rows(conn, owner_id))
+    except BaseException:
+        os.remove(path)
+        raise
+    return path
@@ -0,0 +1,183 @@
+import asyncio
+import logging
+import os
+import time
+from datetime import date, timedelta
+from typing import Any, Dict, Iterable, List, Optional, Sequence, Tuple
+
+import database
+import market_data
+from db_executor import DatabaseExecutor, db_executor
+
+
+logger = logging.getLogger(__name__)
+
+# Tables of past days, one file per day the CBR published rates
+CBR_ARCHIVE_URL = os.getenv('CBR_ARCHIVE_URL', 'https://www.cbr-xml-daily.ru/archive/{day:%Y/%m/%d}/daily_json.js')
+# The daily table changes once a day
+FX_TTL = float(os.getenv('FX_TTL', 3600))
+# Weekends and holidays have no table of their own: the last published one is in force
+ARCHIVE_LOOKBACK_DAYS = 10
+
+
+class FxTable:
+    """CBR rates in force on ``day`` as rubles per one unit of each currency."""
+
+    __slots__ = ('day', 'rates', 'fetched_at')
+
+    def __init__(self, day: date, rates: Dict[str, float], fetched_at: Optional[float] = None):
+        self.day = day
+        self.rates = dict(rates)
+        self.rates['RUB'] = 1.0
+        self.fetched_at = fetched_at or time.time()
+
+    @property
+    def age(self) -> float:
+        return max(0.0, time.time() - self.fetched_at)
+
+    def rate(self, currency: str) -> Optional[float]:
+        return self.rates.get(currency.upper())
+
+    def cross(self, base: str, quote: str) -> Optional[float]:
+        """Units of ``quote`` per one ``base``, e.g. ``cross('EUR', 'USD')``."""
+        base_rate, quote_rate = self.rate(base), self.rate(quote)
+        if not base_rate or not quote_rate:
+            return None
+        return base_rate / quote_rate
+
+    def convert(self, amount: float, source: str, target: str) -> Optional[float]:
+        rate = self.cross(source, target)
+        return None if rate is None else amount * rate
+
+
+def parse_daily(data: Any, fetched_at: Optional[float] = None) -> Optional[FxTable]:
+    """The whole ``daily_json.js`` table; ``Value`` is quoted per ``Nominal`` units (e.g. 10 CNY)."""
+    if not isinstance(data, dict) or not data.get('Valute'):
+        return None
+    rates = {}
+    for code, item in data['Valute'].items():
+        try:
+            rates[item.get('CharCode', code)] = float(item['Value']) / float(item.get('Nominal') or 1)
+        except (KeyError, TypeError, ValueError):
+            logger.warning('Skipping malformed CBR rate %s: %r', code, item)
+    # Date is '2024-05-17T11:30:00+03:00', the day the rates take effect
+    day = date.fromisoformat(data['Date'][:10]) if data.get('Date') else date.today()
+    return FxTable(day, rates, fetched_at)
+
+
+class FxEngine:
+    """Current and historical CBR tables; conversions are answered from memory.
+
+    The current table is downloaded once per ``ttl`` and every table is archived
+    in SQLite under the day it was used for, so revaluing an old purchase never
+    asks the CBR twice for the same day.
+    """
+
+    def __init__(self, executor: DatabaseExecutor = db_executor, ttl: float = FX_TTL,
+                 lookback: int = ARCHIVE_LOOKBACK_DAYS):
+        self.executor = executor
+        self.ttl = ttl
+        self.lookback = lookback
+        self.current: Optional[FxTable] = None
+        # day -> table in force on that day
+        self.tables: Dict[date, FxTable] = {}
+        self._current_lock = asyncio.Lock()
+        self._locks: Dict[date, asyncio.Lock] = {}
+
+    async def latest(self, force: bool = False) -> Optional[FxTable]:
+        """The newest table; a stale one is returned if the CBR is unavailable."""
+        if not force and self.current is not None and self.current.age < self.ttl:
+            return self.current
+        async with self._current_lock:
+            # Another request could have downloaded it while we waited
+            if not force and self.current is not None and self.current.age < self.ttl:
+                return self.current
+            table = parse_daily(await market_data.client.get_json(market_data.CBR_DAILY_URL))
+            if table is None:
+                logger.error('Failed to fetch CBR daily rates')
+                return self.current
+            if table.day not in self.tables:
+                await self._archive(table.day, table)
+            self.current = table
+            return table
+
+    async def on(self, day: date) -> Optional[FxTable]:
+        """Table in force on ``day``: from memory, then the local archive, then the CBR archive."""
+        latest = await self.latest()
+        if latest is not None and day >= latest.day:
+            return latest
+        table = self.tables.get(day)
+        if table is not None:
+            return table
+        lock = self._locks.setdefault(day, asyncio.Lock())
+        async with lock:
+            table = self.tables.get(day)
+            if table is not None:
+                return table
+            rows = await self.executor.read(database.select_fx_rates, day.isoformat())
+            if rows:
+                table = self.tables[day] = FxTable(day, dict(rows))
+                return table
+            table = await self._download(day)
+            if table is not None:
+                await self._archive(day, table)
+            return table
+
+    async def _download(self, day: date) -> Optional[FxTable]:
+        for offset in range(self.lookback):
+            published = day - timedelta(days=offset)
+            table = parse_daily(await market_data.client.get_json(CBR_ARCHIVE_URL.format(day=published)))
+            if table is not None:
+                return FxTable(day, table.rates, table.fetched_at)
+        logger.error('No CBR rates found for %s', day)
+        return None
+
+    async def _archive(self, day: date, table: FxTable) -> None:
+        self.tables[day] = table
+        await self.executor.write(database.upsert_fx_rates, day.isoformat(), table.rates)
+
+    async def convert(self, amount: float, source: str, target: str, day: Optional[date] = None) -> Optional[float]:
+        table = await (self.latest() if day is None else self.on(day))
+        return None if table is None else table.convert(amount, source, target)
+
+    async def tables_on(self, days: Iterable[date]) -> Dict[date, Optional[FxTable]]:
+        days = list(dict.fromkeys(days))
+        return dict(zip(days, await asyncio.gather(*(self.on(day) for day in days))))
+
+    async def purchase_costs(self, purchases: Sequence[Tuple[int, Optional[str]]],
+                             currency: str = 'USD') -> List[Optional[float]]:
+        """Ruble cost of each ``(amount_minor, purchase_date)`` at the rate of its purchase day.
+
+        ``None`` for purchases without a date or a known rate.
+        """
+        days = [date.fromisoformat(moment[:10]) if moment else None for _, moment in purchases]
+        tables = await self.tables_on(day for day in days if day is not None)
+        costs = []
+        for (amount_minor, _), day in zip(purchases, days):
+            table = tables.get(day) if day is not None else None
+            costs.append(None if table is None else table.convert(amount_minor / 100, currency, 'RUB'))
+        return costs
+
+
+fx_engine = FxEngine()
+
+
+#Получение текущего курса доллара
+async def get_current_usd_rub() -> Optional[float]:
+    table = await fx_engine.latest()
+    return None if table is None else table.rate('USD')
+
+
+def parse_conversion(args: str) -> Optional[Tuple[float, str, str, Optional[date]]]:
+    """``'100 EUR CNY'`` or ``'100 usd rub 2024-05-17'`` -> ``(100.0, 'EUR', 'CNY', None)``."""
+    parts = args.split()
+    if len(parts) not in (3, 4):
+        return None
+    try:
+        amount = float(parts[0].replace(',', '.'))
+        day = date.fromisoformat(parts[3]) if len(parts) == 4 else None
+    except ValueError:
+        return None
+    if not amount > 0 or amount == float('inf'):
+        return None
+    return amount, parts[1].upper(), parts[2].upper(), day
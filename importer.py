@@ -0,0 +1,217 @@
+import asyncio
+import csv
+import io
+import logging
+import os
+import re
+from datetime import datetime
+from decimal import Decimal, InvalidOperation
+from typing import BinaryIO, Dict, Iterator, List, NamedTuple, Optional, Tuple, Union
+from xml.etree import ElementTree
+
+import database
+from db_executor import db_executor
+from securities import check_stocks_existence
+
+
+logger = logging.getLogger(__name__)
+
+# Telegram does not let bots download files larger than 20 MB
+IMPORT_MAX_BYTES = int(os.getenv('IMPORT_MAX_BYTES', 20 * 1024 * 1024))
+# How many row errors are listed in the reply
+IMPORT_ERRORS_SHOWN = 20
+# Larger quantities are typos; lot cost in kopecks has to fit an SQLite INTEGER
+IMPORT_MAX_QUANTITY = 10 ** 9
+MAX_COST_MINOR = 2 ** 63 - 1
+
+# Column names used by brokers and spreadsheets -> field
+COLUMNS = {
+    'ticker': 'stock_id', 'secid': 'stock_id', 'stock_id': 'stock_id', 'security': 'stock_id',
+    'symbol': 'stock_id', 'тикер': 'stock_id', 'код': 'stock_id',
+    'quantity': 'quantity', 'qty': 'quantity', 'amount': 'quantity', 'количество': 'quantity',
+    'кол-во': 'quantity',
+    'price': 'unit_price', 'unit_price': 'unit_price', 'цена': 'unit_price',
+    'date': 'purchase_date', 'purchase_date': 'purchase_date', 'trade_date': 'purchase_date',
+    'datetime': 'purchase_date', 'дата': 'purchase_date', 'дата сделки': 'purchase_date',
+    # /export files also hold dollar purchases, only their 'stock' rows are lots
+    'type': 'kind',
+}
+REQUIRED = ('stock_id', 'quantity', 'unit_price')
+DATE_FORMATS = ('%d.%m.%Y %H:%M:%S', '%d.%m.%Y %H:%M', '%d.%m.%Y')
+TICKER_PATTERN = re.compile(r'^[A-Z0-9.\-]{1,12}$')
+
+
+class ImportedLot(NamedTuple):
+    line: int
+    stock_id: str
+    quantity: int
+    unit_price: str
+    purchase_date: datetime
+
+
+class RowError(NamedTuple):
+    line: int
+    message: str
+
+
+class ImportReport(NamedTuple):
+    imported: int
+    errors: List[RowError]
+    # Set when the lots could not be saved; nothing is imported then
+    failure: Optional[str] = None
+
+
+def _field(name: str) -> Optional[str]:
+    return COLUMNS.get(name.strip().lower().lstrip('﻿'))
+
+
+def _parse_date(value: str) -> datetime:
+    value = value.strip()
+    try:
+        return datetime.fromisoformat(value)
+    except ValueError:
+        pass
+    for date_format in DATE_FORMATS:
+        try:
+            return datetime.strptime(value, date_format)
+        except ValueError:
+            continue
+    raise ValueError(value)
+
+
+def parse_lot(line: int, record: Dict[str, str], now: datetime) -> Union[ImportedLot, RowError]:
+    """Validate one report row given as ``{field: text}``."""
+    missing = [field for field in REQUIRED if not (record.get(field) or '').strip()]
+    if missing:
+        return RowError(line, f'нет значения: {", ".join(missing)}')
+    stock_id = record['stock_id'].strip().upper()
+    if not TICKER_PATTERN.match(stock_id):
+        return RowError(line, f'некорректный тикер {stock_id}')
+    try:
+        quantity = Decimal(record['quantity'].strip().replace(' ', '').replace(',', '.'))
+    except InvalidOperation:
+        return RowError(line, f'некорректное количество {record["quantity"]}')
+    if not quantity.is_finite() or quantity <= 0 or quantity != quantity.to_integral_value():
+        return RowError(line, f'количество должно быть целым положительным числом: {record["quantity"]}')
+    if quantity > IMPORT_MAX_QUANTITY:
+        return RowError(line, f'слишком большое количество {record["quantity"]}')
+    try:
+        unit_price = Decimal(record['unit_price'].strip().replace(' ', '').replace(',', '.'))
+    except InvalidOperation:
+        return RowError(line, f'некорректная цена {record["unit_price"]}')
+    if not unit_price.is_finite() or unit_price <= 0:
+        return RowError(line, f'цена должна быть положительной: {record["unit_price"]}')
+    if quantity * (unit_price * 100).to_integral_value() > MAX_COST_MINOR:
+        return RowError(line, f'слишком большая сумма сделки: {record["quantity"]} × {record["unit_price"]}')
+    purchase_date = now
+    if (record.get('purchase_date') or '').strip():
+        try:
+            purchase_date = _parse_date(record['purchase_date'])
+        except ValueError:
+            return RowError(line, f'некорректная дата {record["purchase_date"]}')
+    return ImportedLot(line, stock_id, int(quantity), str(unit_price), purchase_date)
+
+
+def parse_csv(stream: BinaryIO, now: datetime) -> Iterator[Union[ImportedLot, RowError]]:
+    """Lots of a CSV report, read row by row; ``,`` and ``;`` separated files are accepted."""
+    text = io.TextIOWrapper(stream, encoding='utf-8-sig', errors='replace', newline='')
+    header_line = text.readline()
+    dialect = csv.excel if header_line.count(',') > header_line.count(';') else _Semicolon
+    header = next(csv.reader([header_line], dialect))
+    fields = [_field(name) for name in header]
+    if not set(REQUIRED) <= set(fields):
+        yield RowError(1, 'в заголовке нужны колонки ticker, quantity, price (и необязательно date)')
+        return
+    for line, row in enumerate(csv.reader(text, dialect), start=2):
+        if not any(cell.strip() for cell in row):
+            continue
+        record = {field: value for field, value in zip(fields, row) if field}
+        if record.get('kind', 'stock').strip().lower() not in ('stock', ''):
+            continue
+        yield parse_lot(line, record, now)
+
+
+class _Semicolon(csv.excel):
+    delimiter = ';'
+
+
+def parse_xml(stream: BinaryIO, now: datetime) -> Iterator[Union[ImportedLot, RowError]]:
+    """Lots of an XML report, read with iterparse.
+
+    Every element whose attributes or child elements name a ticker, quantity and
+    price is one trade, e.g. ``<trade ticker="SBER" quantity="10" price="250.5" date="2024-01-10"/>``.
+    Elements are dropped as soon as they are read, so the whole tree is never in memory.
+    """
+    number = 0
+    try:
+        for _, element in ElementTree.iterparse(stream, events=('end',)):
+            record = {}
+            for name, value in element.attrib.items():
+                field = _field(name)
+                if field:
+                    record[field] = value
+            for child in element:
+                field = _field(child.tag)
+                if field and child.text:
+                    record.setdefault(field, child.text)
+            if set(REQUIRED) <= record.keys():
+                number += 1
+                yield parse_lot(number, record, now)
+                element.clear()
+            elif not _field(element.tag):
+                # Field elements like <ticker> are read and cleared together with their trade
+                element.clear()
+    except ElementTree.ParseError as error:
+        yield RowError(number + 1, f'файл поврежден: {error}')
+
+
+def parse_report(stream: BinaryIO, file_name: str, now: Optional[datetime] = None
+                 ) -> Tuple[List[ImportedLot], List[RowError]]:
+    now = now or datetime.now()
+    parse = parse_xml if file_name.lower().endswith('.xml') else parse_csv
+    lots, errors = [], []
+    for item in parse(stream, now):
+        (lots if isinstance(item, ImportedLot) else errors).append(item)
+    return lots, errors
+
+
+async def import_report(owner_id: int, stream: BinaryIO, file_name: str) -> ImportReport:
+    """Parse a broker report and add every valid lot of it to the user's portfolio.
+
+    Tickers are validated in one batch and all lots are inserted in one
+    transaction; rows that fail are reported by line (trade number for XML).
+    """
+    # Parsing is CPU work, it runs off the event loop
+    lots, errors = await asyncio.to_thread(parse_report, stream, file_name)
+    known = await check_stocks_existence({lot.stock_id for lot in lots})
+    valid = []
+    for lot in lots:
+        if lot.stock_id in known:
+            valid.append(lot)
+        else:
+            errors.append(RowError(lot.line, f'тикер {lot.stock_id} не найден на Московской бирже'))
+    imported = 0
+    errors.sort()
+    if valid:
+        try:
+            imported = await db_executor.write(database.insert_stocks, owner_id,
+                                               [(lot.stock_id, lot.quantity, lot.unit_price, lot.purchase_date)
+                                                for lot in valid])
+        except Exception as error:
+            # The transaction is rolled back as a whole, the user can fix the file and send it again
+            logger.exception('Failed to save %s imported lots for %s', len(valid), owner_id)
+            return ImportReport(0, errors, f'{type(error).__name__}: {error}')
+    logger.info('Imported %s lots for %s, %s rows rejected', imported, owner_id, len(errors))
+    return ImportReport(imported, errors)
+
+
+def format_report(report: ImportReport) -> str:
+    text = f'Импортировано лотов: {report.imported}'
+    if report.failure:
+        text += f'\nНе удалось сохранить сделки, портфель не изменен ({report.failure})'
+    if report.errors:
+        text += f'\nОшибки ({len(report.errors)}):\n'
+        text += '\n'.join(f'строка {error.line}: {error.message}' for error in report.errors[:IMPORT_ERRORS_SHOWN])
+        if len(report.errors) > IMPORT_ERRORS_SHOWN:
+            text += f'\n... и еще {len(report.errors) - IMPORT_ERRORS_SHOWN}'
+    return text
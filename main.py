@@ -1,94 +1,141 @@
 import asyncio
+import logging
 from aiogram import Bot, Dispatcher, types, Router
-from aiogram.filters.command import Command
+from aiogram.filters.command import Command, CommandObject
 from aiogram.filters.state import State, StatesGroup
 from aiogram.fsm.context import FSMContext
-from aiogram.fsm.storage.memory import MemoryStorage
 from aiogram.types import ReplyKeyboardMarkup, KeyboardButton
 from aiogram.utils.keyboard import ReplyKeyboardBuilder
 from aiogram import F
 # from telegram import InlineKeyboardButton, InlineKeyboardMarkup, Update
 # from telegram.ext import Updater, CommandHandler, CallbackQueryHandler
-from aiogram.types import InlineKeyboardButton, InlineKeyboardMarkup
-import sqlite3
+from aiogram.types import (InlineKeyboardButton, InlineKeyboardMarkup, FSInputFile, InlineQueryResultArticle,
+                           InputTextMessageContent)
 import os
-from datetime import datetime
-import requests
-from typing import List, Tuple, Optional
+from functools import partial
+from datetime import date, datetime, timedelta
+from typing import Iterator, List, NamedTuple, Tuple, Optional
 from dotenv import load_dotenv
+import numpy as np
+import database
+import market_data
+from database import db
+from db_executor import db_executor
+from market_data import get_stock_price
+from fx import fx_engine, get_current_usd_rub, parse_conversion
+from securities import check_stock_existence, security_index
+from webhook import BOT_MODE, run_webhook
+from refresher import format_age, refresher, snapshot
+from alerts import alert_engine, format_alert, parse_alert
+from watch import format_quote, watch_hub
+from storage import build_storage, run_sweeper
+import analytics
+from analytics import Portfolio, user_portfolio
+from exporter import write_export
+from importer import IMPORT_MAX_BYTES, format_report, import_report
+from candles import CANDLES_HISTORY_DAYS, candle_store, sparkline, trading_days, user_portfolio_history
+from outbox import outbox, rate_limit_middleware, metrics as outbox_metrics
+from throttling import ThrottlingMiddleware
+from workers import WORKER_COUNT, WORKER_INDEX, owns_user
+from metrics import (HandlerMetricsMiddleware, TelegramMetricsMiddleware, registry, setup_logging,
+                     start_metrics_server)
 
 
 load_dotenv()
 #  Создание экземпляра бота
 api_token = os.getenv('API_TOKEN')
 bot = Bot(token=api_token)
-storage = MemoryStorage()
+# Все исходящие запросы к Telegram проходят через общие лимиты (30 сообщений/с, 1/с на чат)
+bot.session.middleware(rate_limit_middleware)
+# Время ответа Telegram по методам API (без ожидания в очереди лимитов)
+bot.session.middleware(TelegramMetricsMiddleware())
+# Хранилище состояний выбирается переменной окружения FSM_STORAGE
+storage = build_storage()
 #  Создание экземпляра диспетчера
 dp = Dispatcher(bot=bot, storage=storage)
+# Лимит запросов на пользователя; обновления одного пользователя обрабатываются по очереди,
+# повторные нажатия тяжелых кнопок ждут уже запущенный запрос
+# Обработчики этих команд возвращают отправленное сообщение, повторные нажатия получают его копию
+throttling = ThrottlingMiddleware(coalesce=('CheckPortfolio', '/stats', '/history', '/export'))
+# Состояние FSM читается уже после очереди пользователя, поэтому FSM-middleware ставится после нее
+dp.update.outer_middleware.unregister(dp.fsm)
+dp.update.outer_middleware(throttling)
+dp.update.outer_middleware(dp.fsm)
 router = Router()
 dp.include_router(router)
+# Время выполнения и ошибки каждого обработчика; внутренние middleware диспетчера
+# действуют и на обработчики, зарегистрированные в router
+dp.message.middleware(HandlerMetricsMiddleware())
+dp.callback_query.middleware(HandlerMetricsMiddleware())
+dp.inline_query.middleware(HandlerMetricsMiddleware())
+registry.gauge('outbox', outbox_metrics.snapshot, label='stat')
+registry.gauge('throttling', lambda: throttling.stats, label='stat')
+logger = logging.getLogger(__name__)
 
 
 #Создание класса с пользователем
 class User:
+    __slots__ = ('telegram_id',)
+
     def __init__(self, telegram_id):
         self.telegram_id = telegram_id
 
+    @registry.timed('model_seconds')
     def check_user_data(self):
-        conn = sqlite3.connect('./app_data/database.db')
-        cursor = conn.cursor()
-        cursor.execute("SELECT name FROM sqlite_master WHERE type = 'table' AND name='users'")
-        result = cursor.fetchone()
-        if result is None:
-            conn.close()
-            return None
-        cursor.execute('SELECT * FROM users WHERE telegram_id = ?', (self.telegram_id,))
-        result = cursor.fetchone()
-        conn.close()
-        return result
+        return database.get_user(db.connection, self.telegram_id)
 
+    @registry.timed('model_seconds')
     def create_user_record(self):
-        inserted_id = None
-        if not self.check_user_data():
-            conn = sqlite3.connect('./app_data/database.db')
-            cursor = conn.cursor()
-            cursor.execute('''CREATE TABLE IF NOT EXISTS users (telegram_id INTEGER PRIMARY KEY)''')
-            cursor.execute('INSERT INTO users (telegram_id) VALUES (?)', (self.telegram_id,))
-            inserted_id = cursor.lastrowid
-            conn.commit()
-            conn.close()
-        return inserted_id
+        conn = db.connection
+        with conn:
+            return database.insert_user(conn, self.telegram_id)
+
+    # Async variants run on the DB executor threads and do not block the event loop
+    @registry.timed('model_seconds')
+    async def check_user_data_async(self):
+        return await db_executor.read(database.get_user, self.telegram_id)
+
+    @registry.timed('model_seconds')
+    async def create_user_record_async(self):
+        return await db_executor.write(database.insert_user, self.telegram_id)
 
 
 class Currency:
+    __slots__ = ('owner_id', 'dollar_purchase')
+
     def __init__(self, owner_id, dollar_purchase):
         self.owner_id: int = owner_id
         self.dollar_purchase: float = dollar_purchase
 
+    @registry.timed('model_seconds')
     def add_dollar_purchase(self):
-        conn = sqlite3.connect('database.db')
-        cursor = conn.cursor()
-        cursor.execute('''CREATE TABLE IF NOT EXISTS currency (
-                          owner_id INTEGER,
-                          dollar_purchase REAL,
-                          FOREIGN KEY (owner_id) REFERENCES users(telegram_id) ON DELETE CASCADE)  
-                      ''')
-        values = (self.owner_id, self.dollar_purchase)
-        cursor.execute('INSERT INTO currency (owner_id, dollar_purchase) VALUES (?, ?)', values)
-        inserted_id: int = cursor.lastrowid
-        conn.commit()
-        conn.close()
+        conn = db.connection
+        with conn:
+            inserted_id: int = database.insert_dollar_purchase(conn, self.owner_id, self.dollar_purchase)
         return inserted_id
 
+    @registry.timed('model_seconds')
+    async def add_dollar_purchase_async(self) -> int:
+        return await db_executor.write(database.insert_dollar_purchase, self.owner_id, self.dollar_purchase)
+
 
 #Создаем класс для работы с акциями
 class Stock:
-    def __init__(self, owner_id, stock_id, quantity, unit_price, purchase_date):
+    # Без __dict__: тысячи лотов пользователя занимают в несколько раз меньше памяти
+    __slots__ = ('owner_id', 'stock_id', 'quantity', 'unit_price', 'purchase_date')
+
+    def __init__(self, owner_id, stock_id, quantity, unit_price, purchase_date=None):
         self.owner_id = owner_id
         self.stock_id = stock_id
         self.quantity = quantity
         self.unit_price = unit_price
-        self.purchase_date = datetime.now()
+        # The stored date is kept; the database returns it as an ISO string,
+        # '' for lots of the first bot versions that were saved without a date
+        if purchase_date is None:
+            purchase_date = datetime.now()
+        elif isinstance(purchase_date, str):
+            purchase_date = datetime.fromisoformat(purchase_date) if purchase_date else None
+        self.purchase_date: Optional[datetime] = purchase_date
 
     def __eq__(self, other):
         if isinstance(other, Stock):
@@ -101,46 +148,60 @@ class Stock:
             )
         return False
 
+    def __repr__(self):
+        return (f'Stock({self.owner_id!r}, {self.stock_id!r}, {self.quantity!r}, {self.unit_price!r}, '
+                f'{self.purchase_date.isoformat() if self.purchase_date else ""!r})')
+
     # Function to add stock
+    @registry.timed('model_seconds')
     def add_stock(self):
-        conn = sqlite3.connect('./app_data/database.db')
-        cursor = conn.cursor()
-        cursor.execute('''CREATE TABLE IF NOT EXISTS stocks
-                          (owner_id INTEGER, 
-                          stock_id TEXT, 
-                          quantity INTEGER, 
-                          unit_price REAL, 
-                          purchase_date TEXT,
-                          FOREIGN KEY (owner_id) REFERENCES users(telegram_id) ON DELETE CASCADE)''')
-        purchase_date_str = self.purchase_date.isoformat()
-        values = (self.owner_id, self.stock_id, self.quantity, self.unit_price, self.purchase_date)
-        cursor.execute('INSERT INTO stocks VALUES (?, ?, ?, ?, ?)', values)
-        inserted_id = cursor.lastrowid
-        conn.commit()
-        conn.close()
+        conn = db.connection
+        with conn:
+            inserted_id = database.insert_stock(conn, self.owner_id, self.stock_id, self.quantity,
+                                                self.unit_price, self.purchase_date)
         return inserted_id
 
+    @registry.timed('model_seconds')
+    async def add_stock_async(self):
+        return await db_executor.write(database.insert_stock, self.owner_id, self.stock_id, self.quantity,
+                                       self.unit_price, self.purchase_date)
+
     # Function to get user's stocks
     @classmethod
+    @registry.timed('model_seconds')
     def get_user_stocks(cls, owner_id: int) -> List:
-        stocks = []
-        conn = sqlite3.connect('./app_data/database.db')
-        cursor = conn.cursor()
-        cursor.execute("SELECT name FROM sqlite_master WHERE type='table' AND name='stocks'")
-        result = cursor.fetchone()
-        if result is None:
-            conn.close()
-            return stocks
-        cursor.execute('SELECT * FROM stocks where owner_id = ?', (owner_id,))
-        result: List[Tuple] = cursor.fetchall()
-        conn.close()
-
-        for row in result:
-            owner_id, stock_id, quantity, unit_price, purchase_date = row
-            stock = cls(owner_id, stock_id, quantity, unit_price, purchase_date)
-            stocks.append(stock)
-
-        return stocks
+        return list(cls.iter_user_stocks(owner_id))
+
+    # Лоты читаются порциями, в памяти одновременно не больше chunk_size строк
+    @classmethod
+    def iter_user_stocks(cls, owner_id: int, chunk_size: int = database.STREAM_CHUNK_SIZE) -> Iterator:
+        for row in database.iter_user_stocks(db.connection, owner_id, chunk_size):
+            yield cls(*row)
+
+
+#Позиция пользователя: все лоты одной акции, сведенные в одну запись
+class Position(NamedTuple):
+    stock_id: str
+    quantity: int
+    cost_minor: int
+    lot_count: int
+
+    # Weighted average purchase price of the lots
+    @property
+    def average_price(self) -> float:
+        return self.cost_minor / self.quantity / 100 if self.quantity else 0.0
+
+    @classmethod
+    @registry.timed('model_seconds')
+    def get_user_positions(cls, owner_id: int) -> List:
+        result: List[Tuple] = database.select_user_positions(db.connection, owner_id)
+        return [cls(*row) for row in result]
+
+    @classmethod
+    @registry.timed('model_seconds')
+    async def get_user_positions_async(cls, owner_id: int) -> List:
+        result: List[Tuple] = await db_executor.read(database.select_user_positions, owner_id)
+        return [cls(*row) for row in result]
 
 
 # ———————— РАБОТА С СОСТОЯНИЯМИ ————————
@@ -157,63 +218,10 @@ class AddStockStates(StatesGroup):
     StockQuantity = State()
 
 
-#Функция проверки существования акции на бирже
-def check_stock_existence(stock_id: str) -> bool:
-    # Обращаемся к МосБирже
-    url = f'https://iss.moex.com/iss/securities/{stock_id}.json'
-    response = requests.get(url)
-    if response.status_code == 200:
-        data = response.json()
-        exist = data.get('boards',{}).get('data',[])
-        if exist != []:
-            return bool(exist)
-        else:
-            return False
-    else:
-        return False
-
-
-#Функция для получения цены акции
-def get_stock_price(stock_id: str) -> Tuple[float, str]:
-    url = f'https://iss.moex.com/iss/engines/stock/markets/shares/boards/TQBR/securities/{stock_id}.json?iss.only=securities&securities.columns=PREVPRICE,CURRENCYID'
-    response = requests.get(url)
-    stock_price: Optional[float] = None
-    stock_currency: Optional[str] = None
-    if response.status_code == 200:
-        data_json = response.json()
-        data: List = data_json.get('securities').get('data')
-        if len(data) != 0:
-            stock_price = data[0][0]
-            stock_currency = data[0][1]
-            if stock_currency == 'SUR':
-                stock_currency = 'RUB'
-
-    return stock_price, stock_currency
-
-
-#Получение текущего курса доллара
-def get_current_usd_rub() -> float:
-    # URL to fetch the current value of USD/RUB
-    url = 'https://www.cbr-xml-daily.ru/daily_json.js'
-    response = requests.get(url)
-    if response.status_code == 200:
-        data = response.json()
-        # Extract the current exchange rate
-        current_value = data.get('Valute', {}).get('USD', {})
-        if current_value:
-            return current_value["Value"]
-        else:
-            print("No data found for USD/RUB.")
-            return None
-    else:
-        print(f"Error: {response.status_code}")
-        return None
-
-
-def convert_rub_to_dol(amount_rub: int) -> float:
-    current_dollar_value = get_current_usd_rub()
+async def convert_rub_to_dol(amount_rub: int) -> float:
+    current_dollar_value = await get_current_usd_rub()
     if current_dollar_value is None or current_dollar_value == 0:
-        print("Не удалось определить текущий курс.")
+        logger.error("Не удалось определить текущий курс.")
     return amount_rub / current_dollar_value
 
 
@@ -232,7 +240,7 @@ keyboard = keyboard_builder.as_markup(resize_keyboard=True)
 @router.message(F.text == 'start')
 async def reg_user(message: types.Message):
     new_user = User(message.from_user.id)
-    new_user.create_user_record()
+    await new_user.create_user_record_async()
     await message.reply('Добро пожаловать!', reply_markup=keyboard)
 
 # -----------------------------------------------------------------------------
@@ -247,20 +255,37 @@ async def check_stock_command(message: types.Message, state: FSMContext):
 @dp.message(CheckStockStates.StockID)
 async def check_stock_id(message: types.Message, state: FSMContext):
     stock_id = message.text.upper()
-    stock_existence = check_stock_existence(stock_id)
+    stock_existence = await check_stock_existence(stock_id)
     await message.reply(f"Вы запросили курс для тикера: {stock_id}")
     if stock_existence == True:
-        stock_price, stock_currency = get_stock_price(stock_id)
-        await message.reply(f'Стоимость {stock_price} {stock_currency}')
+        quote = await snapshot.get_quote(stock_id)
+        await message.reply(f'Стоимость {quote.price} {quote.currency} (данные {format_age(quote)})')
     else:
         await message.reply('Ценная бумага не существует')
     await state.clear()
+
+
+@router.inline_query()
+async def search_tickers(inline_query: types.InlineQuery):
+    # Поиск по локальному индексу TQBR, к бирже на каждое нажатие клавиши не обращаемся
+    results = []
+    for security in security_index.search(inline_query.query):
+        quote = snapshot.get(security.secid)
+        price = quote.price if quote is not None else security.price
+        results.append(InlineQueryResultArticle(
+            id=security.secid,
+            title=f'{security.secid} — {security.shortname}' if security.shortname else security.secid,
+            description=f'{price} RUB' if price is not None else 'нет цены',
+            input_message_content=InputTextMessageContent(message_text=security.secid),
+        ))
+    await inline_query.answer(results, cache_time=60)
 # ------------------------------------------------------------------
 
 
 @router.message(F.text =='AddStock')
 async def check_stock_start(message: types.Message, state: FSMContext):
-    await message.reply('Введите идентификатор приобретенного инструмента')
+    await message.reply('Введите идентификатор приобретенного инструмента '
+                        '(для поиска наберите в поле ввода имя бота через @ и начало тикера или названия)')
     # await bot.send_message(message.chat.id, '')
     await state.set_state(AddStockStates.StockID)
 
@@ -269,7 +294,7 @@ async def check_stock_start(message: types.Message, state: FSMContext):
 async def add_stock_id(message: types.Message, state: FSMContext):
     # Check if the user is trying to stop the process
     if message.text.lower() != "/stop":
-        stock_exists = check_stock_existence(message.text)
+        stock_exists = await check_stock_existence(message.text)
 
         if stock_exists:
             await message.answer('Введите стоимость единицы ценной бумаги')
@@ -332,7 +357,7 @@ async def add_stock_quantity(message: types.Message, state: FSMContext):
             # Create a Stock record and save it
             stock_record = Stock(data['StockOwnerID'], data['StockID'], data['StockQuantity'], data['StockPrice'],
                                  data['StockPurchaseDate'])
-            stock_record.add_stock()
+            await stock_record.add_stock_async()
 
             # Clear the state and notify the user
             await state.clear()
@@ -350,7 +375,7 @@ async def add_stock_quantity(message: types.Message, state: FSMContext):
 
 
 @router.message(F.text == 'USD_RUB')
-async def check_stock_command(message: types.Message, state: FSMContext):
+async def usd_rub_command(message: types.Message, state: FSMContext):
     await message.reply("Назовите сумму в рублях, которую хотите перевести в доллары")
     await state.set_state(CheckStockStates.Rub_Amount)
 
@@ -358,9 +383,14 @@ async def check_stock_command(message: types.Message, state: FSMContext):
 @dp.message(CheckStockStates.Rub_Amount)
 async def check_rub_usd(message: types.Message, state: FSMContext):
     rub_amount = float(message.text)
-    current_dollar_value = get_current_usd_rub()
-    usd_amount = rub_amount / current_dollar_value
-    await message.reply(f"На {rub_amount} RUB вы сможете купить {usd_amount:.2f} USD.")
+    usd_rub = await snapshot.get_usd_rub()
+    if usd_rub is None:
+        await message.reply("Не удалось определить текущий курс.")
+        await state.clear()
+        return
+    usd_amount = rub_amount / usd_rub.price
+    await message.reply(f"На {rub_amount} RUB вы сможете купить {usd_amount:.2f} USD. "
+                        f"(курс {usd_rub.price:.4f}, данные {format_age(usd_rub)})")
     await state.update_data(usd_amount=usd_amount)
     yes_button = InlineKeyboardButton(text="Да", callback_data='add_transaction_yes')
     no_button = InlineKeyboardButton(text="Нет", callback_data='add_transaction_no')
@@ -386,7 +416,7 @@ async def process_transaction_confirmation(callback_query: types.CallbackQuery,
     formatted_dollar_amount = "{:.2f}".format(dollar_amount)
     if callback_query.data == 'add_transaction_yes':
         new_currency_record = Currency(user_id, formatted_dollar_amount)
-        new_currency_record.add_dollar_purchase()
+        await new_currency_record.add_dollar_purchase_async()
         await bot.answer_callback_query(callback_query.id, text="Транзакция добавлена в БД.")
         await state.clear()
         # Implement your transaction adding logic here
@@ -399,48 +429,320 @@ async def process_transaction_confirmation(callback_query: types.CallbackQuery,
 
 @router.message(F.text == 'CheckPortfolio')
 async def check_portfolio(message: types.Message):
-    user_stocks = Stock.get_user_stocks(message.from_user.id)
-    portfolio_price = 0
-    portfolio_stocks_count = 0
+    rows = await db_executor.read(database.select_user_positions, message.from_user.id)
+    portfolio = Portfolio.from_positions(rows)
+    # Получение текущих цен всех акций в портфеле пользователя одним запросом
+    quotes = await snapshot.get_quotes(portfolio.stock_ids)
+    # Стоимость, средняя цена и изменение цены считаются сразу для всех позиций
+    valuation = portfolio.valuation({stock_id: quote.price for stock_id, quote in quotes.items()})
+    average_prices = portfolio.average_price
     portfolio_details: List = []
 
-    for stock in user_stocks:
-        # Получение текущий цены по каждой акции в портфеле пользователя
-        current_price, currency = get_stock_price(stock.stock_id)
-        if current_price:
-            # Текущая цена акции
-            stock_value: float = int(stock.quantity) * float(current_price)
-            portfolio_price += stock_value
-            portfolio_stocks_count += 1
-
-            # Подсчет изменения цены
-            price_change = float(current_price) - float(stock.unit_price)  # Change in price
-            price_change_percent = (price_change / float(stock.unit_price)) * 100  # Percent change
-
-            # Collect detailed info for the reply
+    for i, stock_id in enumerate(portfolio.stock_ids):
+        quantity = portfolio.quantity[i]
+        if valuation.priced[i]:
+            currency = quotes[stock_id].currency
+            current_price, stock_value, average_price = valuation.price[i], valuation.value[i], average_prices[i]
             portfolio_details.append(
-                f"{stock.stock_id}: {stock.quantity} units × {current_price:.2f} {currency} = {stock_value:.2f} {currency}\n"
-                f"  • Куплено по {float(stock.unit_price):.2f} {currency}, разница: {price_change:.2f} {currency} "
-                f"({price_change_percent:.2f}%)"
+                f"{stock_id}: {quantity} units × {current_price:.2f} {currency} = {stock_value:.2f} {currency}\n"
+                f"  • Средняя цена покупки {average_price:.2f} {currency} ({portfolio.lot_count[i]} лот.), "
+                f"разница: {current_price - average_price:.2f} {currency} ({valuation.pnl_percent[i]:.2f}%)"
             )
         else:
-            portfolio_details.append(f"{stock.stock_id}: {stock.quantity} units, current price unavailable")
+            portfolio_details.append(f"{stock_id}: {quantity} units, current price unavailable")
 
+    portfolio_stocks_count = int(valuation.priced.sum())
     if portfolio_stocks_count == 0:
         response_message = "Ваш портфель пуст."
     else:
-        response_message = f'Вы приобрели {portfolio_stocks_count} инструментов, на общую сумму {portfolio_price:.2f} RUB\n\n'
+        oldest_quote = min((quotes[stock_id] for stock_id, priced in zip(portfolio.stock_ids, valuation.priced)
+                            if priced), key=lambda quote: quote.fetched_at)
+        response_message = f'Вы приобрели {portfolio_stocks_count} инструментов, на общую сумму {valuation.total_value:.2f} RUB\n\n'
         response_message += "\n".join(portfolio_details)
+        response_message += f"\n\nКотировки обновлены {format_age(oldest_quote)}"
+
+    return await message.reply(response_message)
+
+
+@router.message(Command('stats'))
+async def portfolio_stats(message: types.Message):
+    # Лоты читаются из БД порциями и сразу сворачиваются в массивы по тикерам
+    portfolio = await db_executor.read(user_portfolio, message.from_user.id)
+    quotes = await snapshot.get_quotes(portfolio.stock_ids)
+    valuation = portfolio.valuation({stock_id: quote.price for stock_id, quote in quotes.items()})
+    if not valuation.priced.any():
+        return await message.reply("Ваш портфель пуст.")
+
+    lines = []
+    for i in np.argsort(-np.nan_to_num(valuation.value)):
+        if valuation.priced[i]:
+            lines.append(f'{portfolio.stock_ids[i]}: {valuation.weight[i] * 100:.1f}% портфеля, '
+                         f'{valuation.value[i]:.2f} RUB, результат {valuation.pnl[i]:+.2f} RUB '
+                         f'({valuation.pnl_percent[i]:+.2f}%)')
+        else:
+            lines.append(f'{portfolio.stock_ids[i]}: нет котировки')
+    total_percent = valuation.total_pnl / valuation.total_cost * 100 if valuation.total_cost else 0.0
+    lines.append(f'\nСтоимость {valuation.total_value:.2f} RUB, вложено {valuation.total_cost:.2f} RUB, '
+                 f'результат {valuation.total_pnl:+.2f} RUB ({total_percent:+.2f}%)')
+
+    # Риск считается по дневным свечам за последний год
+    series = await candle_store.sync_many(portfolio.stock_ids)
+    end = date.today()
+    days = trading_days(series.values(), end - timedelta(days=365), end)
+    values, invested = await db_executor.read(user_portfolio_history, message.from_user.id, series, days)
+    portfolio_risk = analytics.risk(values, invested)
+    if portfolio_risk is not None:
+        lines.append(f'За год: доходность {portfolio_risk.total_return * 100:+.2f}%, '
+                     f'волатильность {portfolio_risk.volatility * 100:.2f}%, '
+                     f'макс. просадка {portfolio_risk.max_drawdown * 100:.2f}%')
+
+    return await message.reply('\n'.join(lines))
+
+
+@router.message(Command('alert'))
+async def price_alert(message: types.Message, command: CommandObject):
+    args = (command.args or '').strip()
+    owner_id = message.from_user.id
+    if not args:
+        user_alerts = await alert_engine.user_alerts(owner_id)
+        if user_alerts:
+            await message.reply('Ваши оповещения:\n' + '\n'.join(format_alert(alert) for alert in user_alerts))
+        else:
+            await message.reply('У вас нет оповещений. Пример: /alert SBER >= 300')
+        return
+
+    if args.lower().startswith('del'):
+        alert_id = args[3:].strip().lstrip('#')
+        if alert_id.isdigit() and await alert_engine.delete(owner_id, int(alert_id)):
+            await message.reply(f'Оповещение #{alert_id} удалено')
+        else:
+            await message.reply('Оповещение не найдено')
+        return
+
+    parsed = parse_alert(args)
+    if parsed is None:
+        await message.reply('Формат: /alert ТИКЕР >= ЦЕНА или /alert ТИКЕР <= ЦЕНА, удаление: /alert del НОМЕР')
+        return
+    stock_id, direction, threshold_minor = parsed
+    if not await check_stock_existence(stock_id):
+        await message.reply('Указанный идентификатор ценной бумаги не найден на Московской бирже')
+        return
+    alert = await alert_engine.create(owner_id, message.chat.id, stock_id, direction, threshold_minor)
+    await message.reply(f'Оповещение {format_alert(alert)} создано')
+
+
+@router.message(Command('watch'))
+async def watch_quote(message: types.Message, command: CommandObject):
+    args = (command.args or '').split()
+    if not args:
+        watching = watch_hub.chat_watches(message.chat.id)
+        if watching:
+            await message.reply('Вы следите за: ' + ', '.join(watch.stock_id for watch in watching) +
+                                '\nОстановить: /unwatch ТИКЕР')
+        else:
+            await message.reply('Пример: /watch SBER - сообщение с ценой будет обновляться само')
+        return
+    stock_id = args[0].upper()
+    if not await check_stock_existence(stock_id):
+        await message.reply('Указанный идентификатор ценной бумаги не найден на Московской бирже')
+        return
+    if not watch_hub.can_watch(message.chat.id, stock_id):
+        await message.reply(f'Можно следить не более чем за {watch_hub.max_per_chat} бумагами, '
+                            f'остановите одну командой /unwatch ТИКЕР')
+        return
+    # Цена последней сделки, а не закрытие прошлой сессии: иначе сообщение не менялось бы весь день
+    price, currency = await market_data.get_last_price(stock_id)
+    if price is None:
+        await message.reply('Не удалось получить котировку')
+        return
+    sent = await message.answer(format_quote(stock_id, price, currency, price))
+    # Все наблюдающие за тикером получают одну порцию котировок от фонового обновления
+    watch_hub.watch(message.chat.id, sent.message_id, stock_id, price, currency)
+
 
-    await message.reply(response_message)
+@router.message(Command('unwatch'))
+async def unwatch_quote(message: types.Message, command: CommandObject):
+    stock_id = (command.args or '').strip().upper() or None
+    stopped = watch_hub.unwatch(message.chat.id, stock_id)
+    if stopped:
+        await message.reply('Наблюдение остановлено: ' + ', '.join(watch.stock_id for watch in stopped))
+    else:
+        await message.reply('Наблюдение не найдено')
+
+
+@router.message(Command('history'))
+async def portfolio_history_command(message: types.Message, command: CommandObject):
+    args = (command.args or '').strip()
+    # Свечи хранятся не глубже CANDLES_HISTORY_DAYS, больший период ничего не добавит
+    try:
+        period = int(args) if args else min(365, CANDLES_HISTORY_DAYS)
+    except ValueError:
+        period = 0
+    if not 1 <= period <= CANDLES_HISTORY_DAYS:
+        return await message.reply(f'Период - число дней от 1 до {CANDLES_HISTORY_DAYS}, например /history 90')
+    # Тикеры берутся из агрегатов позиций, сами лоты читаются порциями при расчете истории
+    positions = await db_executor.read(database.select_user_positions, message.from_user.id)
+    if not positions:
+        return await message.reply("Ваш портфель пуст.")
+
+    series = await candle_store.sync_many(position[0] for position in positions)
+    end = date.today()
+    days = trading_days(series.values(), end - timedelta(days=period), end)
+    if not len(days):
+        return await message.reply('История котировок пока недоступна, попробуйте позже')
+    values, invested = await db_executor.read(user_portfolio_history, message.from_user.id, series, days)
+
+    low, high = values.argmin(), values.argmax()
+    profit = values[-1] - invested[-1]
+    response_message = (
+        f'Стоимость портфеля за {period} дн.: {values[0]:.2f} → {values[-1]:.2f} RUB\n'
+        f'{sparkline(values)}\n'
+        f'Минимум {values[low]:.2f} RUB ({days[low]}), максимум {values[high]:.2f} RUB ({days[high]})\n'
+        f'Вложено {invested[-1]:.2f} RUB, результат {profit:+.2f} RUB'
+    )
+    return await message.reply(response_message)
+
+
+@router.message(Command('fx'))
+async def convert_currency(message: types.Message, command: CommandObject):
+    parsed = parse_conversion(command.args or '')
+    if parsed is None:
+        await message.reply('Формат: /fx СУММА ИЗ В [ГГГГ-ММ-ДД], например /fx 100 EUR CNY')
+        return
+    amount, source, target, day = parsed
+    # Курсы берутся из таблицы ЦБ в памяти, прошлые дни - из локального архива
+    table = await (fx_engine.latest() if day is None else fx_engine.on(day))
+    if table is None:
+        await message.reply('Не удалось получить курсы ЦБ')
+        return
+    result = table.convert(amount, source, target)
+    if result is None:
+        await message.reply(f'Нет курса ЦБ для {source if table.rate(source) is None else target}')
+        return
+    await message.reply(f'{amount:.2f} {source} = {result:.2f} {target} '
+                        f'(курс {table.cross(source, target):.4f}, ЦБ на {table.day:%d.%m.%Y})')
+
+
+@router.message(Command('dollars'))
+async def dollar_purchases(message: types.Message):
+    purchases = await db_executor.read(database.select_user_dollar_purchases, message.from_user.id)
+    if not purchases:
+        await message.reply('Вы еще не покупали доллары')
+        return
+    # Каждая покупка оценивается по курсу ЦБ на день покупки, архив курсов хранится в БД
+    costs = await fx_engine.purchase_costs(purchases)
+    usd_rub = await get_current_usd_rub()
+    if usd_rub is None:
+        await message.reply('Не удалось определить текущий курс.')
+        return
+    total_usd = sum(amount_minor for amount_minor, _ in purchases) / 100
+    lines = [f'Куплено {total_usd:.2f} USD, по текущему курсу {total_usd * usd_rub:.2f} RUB']
+    known = [(amount_minor / 100, cost) for (amount_minor, _), cost in zip(purchases, costs) if cost is not None]
+    if known:
+        amount = sum(usd for usd, _ in known)
+        cost = sum(cost for _, cost in known)
+        lines.append(f'{amount:.2f} USD по курсу на дату покупки стоили {cost:.2f} RUB '
+                     f'(средний курс {cost / amount:.4f}), переоценка {amount * usd_rub - cost:+.2f} RUB')
+    if len(known) < len(purchases):
+        lines.append(f'Без даты или курса ЦБ: {len(purchases) - len(known)} покуп.')
+    await message.reply('\n'.join(lines))
+
+
+@router.message(F.document)
+async def import_trades(message: types.Message):
+    document = message.document
+    file_name = document.file_name or ''
+    if not file_name.lower().endswith(('.csv', '.xml')):
+        await message.reply('Для импорта сделок пришлите отчет брокера в формате CSV или XML')
+        return
+    if document.file_size and document.file_size > IMPORT_MAX_BYTES:
+        await message.reply('Файл слишком большой')
+        return
+    # Все строки проверяются одним пакетом и сохраняются одной транзакцией
+    report = await import_report(message.from_user.id, await bot.download(document), file_name)
+    await message.reply(format_report(report))
+
+
+@router.message(Command('export'))
+async def export_portfolio(message: types.Message):
+    owner_id = message.from_user.id
+    # Файл пишется построчно в потоке чтения БД и отправляется с диска частями
+    path = await db_executor.read(write_export, owner_id)
+    try:
+        # Повторное нажатие /export получит копию этого же документа
+        return await bot.send_document(message.chat.id, FSInputFile(path, filename=f'portfolio_{owner_id}.csv'),
+                                       caption='Ваши акции и покупки долларов')
+    finally:
+        os.remove(path)
+
+
+background_tasks = set()
+# HTTP-сервер с /metrics, если он включен
+metrics_runner = None
+
+
+async def on_startup():
+    global metrics_runner
+    metrics_runner = await start_metrics_server()
+    # Открываем соединение с БД, создаем схему и запускаем потоки для работы с БД
+    db_executor.start()
+    # Периодически загружаем список бумаг TQBR для локальной проверки тикеров
+    # (индекс в памяти нужен каждому процессу, это один запрос раз в несколько часов)
+    background_tasks.add(asyncio.create_task(security_index.run_refresher()))
+    # Массовые рассылки уходят через очередь с низким приоритетом, не задерживая ответы
+    outbox.start(bot)
+    # Оповещения о ценах проверяются на каждой порции внутридневных котировок от фонового обновления
+    alert_engine.send = outbox.send
+    # В режиме нескольких процессов каждый обслуживает оповещения только своих пользователей
+    await alert_engine.load(owns_user)
+    # Цены последних сделок: по закрытию прошлой сессии оповещение сработало бы только на следующий день
+    refresher.live_ticker_sources.append(alert_engine.tickers)
+    refresher.live_listeners.append(alert_engine.check)
+    # Живые котировки /watch: один опрос на тикер, правки сообщений через ту же очередь
+    watch_hub.edit = outbox.edit
+    refresher.live_ticker_sources.append(watch_hub.tickers)
+    refresher.live_listeners.append(watch_hub.check)
+    # Обновляем котировки акций из портфелей и курс доллара в фоне; каждый процесс - только своих пользователей
+    refresher.worker_index, refresher.worker_count = WORKER_INDEX, WORKER_COUNT
+    background_tasks.add(asyncio.create_task(refresher.run()))
+    # Дневные свечи по акциям из портфелей для /history; общая БД обновляется одним процессом
+    if WORKER_INDEX == 0:
+        held_tickers = partial(db_executor.read, database.select_held_tickers)
+        background_tasks.add(asyncio.create_task(candle_store.run_updater(held_tickers)))
+    # Удаляем брошенные диалоги (Redis удаляет их сам по TTL)
+    if hasattr(storage, 'sweep'):
+        background_tasks.add(asyncio.create_task(run_sweeper(storage)))
+
+
+async def on_shutdown():
+    for task in background_tasks:
+        task.cancel()
+    await asyncio.gather(*background_tasks, return_exceptions=True)
+    background_tasks.clear()
+    await outbox.stop()
+    # Закрываем общую HTTP-сессию для запросов к МосБирже и ЦБ
+    await market_data.client.close()
+    await storage.close()
+    db_executor.stop()
+    db.close()
+    if metrics_runner is not None:
+        await metrics_runner.cleanup()
 
 
 async def main():
 # далее используется await вместо executor
-    await dp.start_polling(bot)
+    dp.startup.register(on_startup)
+    dp.shutdown.register(on_shutdown)
+    if BOT_MODE == 'webhook':
+        await run_webhook(dp, bot)
+    else:
+        # Telegram does not deliver updates to getUpdates while a webhook is set
+        await bot.delete_webhook()
+        await dp.start_polling(bot)
 
 
 #  Запуск бота
 if __name__ == '__main__':
+     setup_logging()
      asyncio.run(main())
 
@@ -0,0 +1,217 @@
+import asyncio
+import logging
+import os
+from typing import Any, Dict, List, Optional, Tuple
+
+import aiohttp
+
+from metrics import registry
+from quote_cache import QuoteCache
+
+
+logger = logging.getLogger(__name__)
+
+ISS_URL = os.getenv('ISS_URL', 'https://iss.moex.com/iss')
+CBR_DAILY_URL = os.getenv('CBR_DAILY_URL', 'https://www.cbr-xml-daily.ru/daily_json.js')
+
+# PREVPRICE changes once per trading session; CBR rates are cached by fx.FxEngine
+PRICE_TTL = float(os.getenv('PRICE_TTL', 300))
+# LAST moves with every trade, so intraday prices for /watch are kept briefly
+LAST_PRICE_TTL = float(os.getenv('LAST_PRICE_TTL', 15))
+QUOTE_CACHE_SIZE = int(os.getenv('QUOTE_CACHE_SIZE', 4096))
+
+# How many tickers are requested in one multi-ticker ISS call
+QUOTES_CHUNK_SIZE = 100
+
+# Statuses worth retrying: the upstream is overloaded or temporarily unavailable
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+
+
+def _upstream(url: str) -> str:
+    # Metric label: which service the request went to
+    if url.startswith(ISS_URL):
+        return 'iss'
+    if url.startswith(CBR_DAILY_URL):
+        return 'cbr'
+    return 'other'
+
+
+class MarketDataClient:
+    """Shared async HTTP client for MOEX ISS and CBR requests.
+
+    One ``aiohttp.ClientSession`` is reused for every lookup so connections are
+    kept alive between requests; a slow upstream reply only suspends the
+    coroutine that is waiting for it.
+    """
+
+    def __init__(self, limit: int = 100, limit_per_host: int = 20, timeout: float = 10.0,
+                 retries: int = 3, backoff: float = 0.5):
+        self.limit = limit
+        self.limit_per_host = limit_per_host
+        self.timeout = aiohttp.ClientTimeout(total=timeout, connect=min(timeout, 5.0))
+        self.retries = retries
+        self.backoff = backoff
+        self._session: Optional[aiohttp.ClientSession] = None
+
+    @property
+    def session(self) -> aiohttp.ClientSession:
+        # The session is created lazily, because it has to be bound to the running event loop
+        if self._session is None or self._session.closed:
+            connector = aiohttp.TCPConnector(limit=self.limit, limit_per_host=self.limit_per_host,
+                                             keepalive_timeout=30, ttl_dns_cache=300)
+            self._session = aiohttp.ClientSession(connector=connector, timeout=self.timeout)
+        return self._session
+
+    async def get_json(self, url: str, params: Optional[Dict[str, str]] = None) -> Optional[Any]:
+        """Return the decoded JSON body of ``url`` or None if it could not be fetched."""
+        upstream = _upstream(url)
+        with registry.timer('upstream_seconds', upstream=upstream):
+            for attempt in range(self.retries + 1):
+                try:
+                    async with self.session.get(url, params=params) as response:
+                        if response.status == 200:
+                            # CBR serves its JSON as application/javascript
+                            return await response.json(content_type=None)
+                        registry.inc('upstream_errors_total', upstream=upstream, error=response.status)
+                        if response.status not in RETRY_STATUSES:
+                            logger.warning('GET %s failed with status %s', url, response.status)
+                            return None
+                        logger.warning('GET %s returned %s, attempt %s', url, response.status, attempt + 1)
+                except (aiohttp.ClientError, asyncio.TimeoutError) as error:
+                    registry.inc('upstream_errors_total', upstream=upstream, error=type(error).__name__)
+                    logger.warning('GET %s raised %r, attempt %s', url, error, attempt + 1)
+                if attempt < self.retries:
+                    await asyncio.sleep(self.backoff * 2 ** attempt)
+            return None
+
+    async def close(self) -> None:
+        if self._session is not None and not self._session.closed:
+            await self._session.close()
+        self._session = None
+
+
+client = MarketDataClient()
+quote_cache = QuoteCache(maxsize=QUOTE_CACHE_SIZE)
+# Hit/miss/coalesced counters of the cache, read on every scrape
+registry.gauge('quote_cache', quote_cache.stats, label='stat')
+
+
+def _has_price(quote: Tuple[Optional[float], Optional[str]]) -> bool:
+    # Failed lookups are not cached, so the next request retries the upstream
+    return quote is not None and quote[0] is not None
+
+
+#Функция для получения цены акции
+async def get_stock_price(stock_id: str) -> Tuple[Optional[float], Optional[str]]:
+    stock_id = stock_id.upper()
+    return await quote_cache.get_or_fetch(('price', stock_id), lambda: _fetch_stock_price(stock_id),
+                                          PRICE_TTL, cacheable=_has_price)
+
+
+async def _fetch_stock_price(stock_id: str) -> Tuple[Optional[float], Optional[str]]:
+    url = f'{ISS_URL}/engines/stock/markets/shares/boards/TQBR/securities/{stock_id}.json'
+    params = {'iss.only': 'securities', 'securities.columns': 'PREVPRICE,CURRENCYID'}
+    data_json = await client.get_json(url, params)
+    stock_price: Optional[float] = None
+    stock_currency: Optional[str] = None
+    if data_json:
+        data: List = data_json.get('securities', {}).get('data', [])
+        if len(data) != 0:
+            stock_price = data[0][0]
+            stock_currency = data[0][1]
+            if stock_currency == 'SUR':
+                stock_currency = 'RUB'
+
+    return stock_price, stock_currency
+
+
+async def _fetch_quotes_chunk(stock_ids: List[str]) -> Dict[str, Tuple[Optional[float], Optional[str]]]:
+    url = f'{ISS_URL}/engines/stock/markets/shares/boards/TQBR/securities.json'
+    params = {'securities': ','.join(stock_ids), 'iss.only': 'securities',
+              'securities.columns': 'SECID,PREVPRICE,CURRENCYID'}
+    data_json = await client.get_json(url, params)
+    quotes = {}
+    if data_json:
+        for secid, stock_price, stock_currency in data_json.get('securities', {}).get('data', []):
+            if stock_currency == 'SUR':
+                stock_currency = 'RUB'
+            quotes[secid] = (stock_price, stock_currency)
+    return quotes
+
+
+#Получение цен сразу для нескольких акций
+async def get_stock_prices(stock_ids) -> Dict[str, Tuple[Optional[float], Optional[str]]]:
+    """Return ``{ticker: (price, currency)}`` for every requested ticker.
+
+    Cached quotes are served from ``quote_cache``; the rest are deduplicated and
+    fetched with multi-ticker ISS calls, chunks of ``QUOTES_CHUNK_SIZE`` go out
+    concurrently. Unknown tickers map to ``(None, None)``.
+    """
+    keys = [('price', stock_id.upper()) for stock_id in stock_ids]
+    quotes = await quote_cache.get_many_or_fetch(keys, _fetch_stock_prices, PRICE_TTL, cacheable=_has_price)
+    return {stock_id: quote for (_, stock_id), quote in quotes.items()}
+
+
+async def _fetch_stock_prices(keys: List[Tuple[str, str]]) -> Dict[Tuple[str, str], Tuple[Optional[float], Optional[str]]]:
+    quotes = await _download_stock_prices([stock_id for _, stock_id in keys])
+    return {('price', stock_id): quote for stock_id, quote in quotes.items()}
+
+
+async def _download_stock_prices(unique_ids: List[str], fetch_chunk=_fetch_quotes_chunk
+                                 ) -> Dict[str, Tuple[Optional[float], Optional[str]]]:
+    chunks = [unique_ids[i:i + QUOTES_CHUNK_SIZE] for i in range(0, len(unique_ids), QUOTES_CHUNK_SIZE)]
+    quotes: Dict[str, Tuple[Optional[float], Optional[str]]] = {}
+    for chunk_quotes in await asyncio.gather(*(fetch_chunk(chunk) for chunk in chunks)):
+        quotes.update(chunk_quotes)
+    return {stock_id: quotes.get(stock_id, (None, None)) for stock_id in unique_ids}
+
+
+async def fetch_stock_prices(stock_ids) -> Dict[str, Tuple[Optional[float], Optional[str]]]:
+    """Like ``get_stock_prices`` but always asks the exchange; fresh quotes replace cached ones."""
+    unique_ids = list(dict.fromkeys(stock_id.upper() for stock_id in stock_ids))
+    quotes = await _download_stock_prices(unique_ids)
+    for stock_id, quote in quotes.items():
+        if _has_price(quote):
+            quote_cache.set(('price', stock_id), quote, PRICE_TTL)
+    return quotes
+
+
+async def _fetch_last_prices_chunk(stock_ids: List[str]) -> Dict[str, Tuple[Optional[float], Optional[str]]]:
+    url = f'{ISS_URL}/engines/stock/markets/shares/boards/TQBR/securities.json'
+    params = {'securities': ','.join(stock_ids), 'iss.only': 'securities,marketdata',
+              'securities.columns': 'SECID,PREVPRICE,CURRENCYID', 'marketdata.columns': 'SECID,LAST'}
+    data_json = await client.get_json(url, params)
+    quotes = {}
+    if data_json:
+        last_prices = dict(data_json.get('marketdata', {}).get('data', []))
+        for secid, prev_price, stock_currency in data_json.get('securities', {}).get('data', []):
+            if stock_currency == 'SUR':
+                stock_currency = 'RUB'
+            # Before the first trade of the session there is no LAST yet
+            last_price = last_prices.get(secid)
+            quotes[secid] = (last_price if last_price is not None else prev_price, stock_currency)
+    return quotes
+
+
+#Текущие цены внутри торговой сессии (последняя сделка) для живых котировок
+async def get_last_price(stock_id: str) -> Tuple[Optional[float], Optional[str]]:
+    stock_id = stock_id.upper()
+    return await quote_cache.get_or_fetch(('last', stock_id), lambda: _fetch_last_price(stock_id),
+                                          LAST_PRICE_TTL, cacheable=_has_price)
+
+
+async def _fetch_last_price(stock_id: str) -> Tuple[Optional[float], Optional[str]]:
+    return (await _fetch_last_prices_chunk([stock_id])).get(stock_id, (None, None))
+
+
+async def fetch_last_prices(stock_ids) -> Dict[str, Tuple[Optional[float], Optional[str]]]:
+    """``{ticker: (price, currency)}`` at the last trade; PREVPRICE until the session has one.
+
+    Always asks the exchange with multi-ticker calls, like ``fetch_stock_prices``.
+    """
+    unique_ids = list(dict.fromkeys(stock_id.upper() for stock_id in stock_ids))
+    quotes = await _download_stock_prices(unique_ids, _fetch_last_prices_chunk)
+    for stock_id, quote in quotes.items():
+        if _has_price(quote):
+            quote_cache.set(('last', stock_id), quote, LAST_PRICE_TTL)
+    return quotes
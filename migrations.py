@@ -0,0 +1,200 @@
+import logging
+import sqlite3
+from typing import Iterator, List, Tuple
+
+
+logger = logging.getLogger(__name__)
+
+# Versioned schema migrations. The version of a database is kept in PRAGMA user_version;
+# every migration runs in its own transaction together with the version bump.
+# Never edit a migration that has been released, add a new one instead.
+MIGRATIONS: List[Tuple[int, str]] = [
+    # 1: the tables as they were created ad hoc by the first versions of the bot
+    (1, '''
+        CREATE TABLE IF NOT EXISTS users (telegram_id INTEGER PRIMARY KEY);
+        CREATE TABLE IF NOT EXISTS stocks
+            (owner_id INTEGER,
+            stock_id TEXT,
+            quantity INTEGER,
+            unit_price REAL,
+            purchase_date TEXT,
+            FOREIGN KEY (owner_id) REFERENCES users(telegram_id) ON DELETE CASCADE);
+        CREATE TABLE IF NOT EXISTS currency (
+            owner_id INTEGER,
+            dollar_purchase REAL,
+            FOREIGN KEY (owner_id) REFERENCES users(telegram_id) ON DELETE CASCADE);
+    '''),
+    # 2: typed columns, prices in integer minor units (kopecks/cents), ISO 8601 dates
+    # and owner_id indexes for per-user lookups
+    (2, '''
+        INSERT OR IGNORE INTO users (telegram_id)
+            SELECT owner_id FROM stocks WHERE owner_id IS NOT NULL
+            UNION SELECT owner_id FROM currency WHERE owner_id IS NOT NULL;
+
+        CREATE TABLE stocks_v2 (
+            id INTEGER PRIMARY KEY,
+            owner_id INTEGER NOT NULL REFERENCES users(telegram_id) ON DELETE CASCADE,
+            stock_id TEXT NOT NULL,
+            quantity INTEGER NOT NULL,
+            unit_price_minor INTEGER NOT NULL,
+            purchase_date TEXT NOT NULL
+        );
+        INSERT INTO stocks_v2 (owner_id, stock_id, quantity, unit_price_minor, purchase_date)
+            SELECT owner_id, UPPER(stock_id), CAST(quantity AS INTEGER),
+                   CAST(ROUND(unit_price * 100) AS INTEGER),
+                   REPLACE(COALESCE(purchase_date, ''), ' ', 'T')
+            FROM stocks WHERE owner_id IS NOT NULL;
+        DROP TABLE stocks;
+        ALTER TABLE stocks_v2 RENAME TO stocks;
+        CREATE INDEX stocks_owner_id ON stocks (owner_id, stock_id);
+
+        CREATE TABLE currency_v2 (
+            id INTEGER PRIMARY KEY,
+            owner_id INTEGER NOT NULL REFERENCES users(telegram_id) ON DELETE CASCADE,
+            amount_minor INTEGER NOT NULL,
+            purchase_date TEXT
+        );
+        INSERT INTO currency_v2 (owner_id, amount_minor)
+            SELECT owner_id, CAST(ROUND(dollar_purchase * 100) AS INTEGER)
+            FROM currency WHERE owner_id IS NOT NULL;
+        DROP TABLE currency;
+        ALTER TABLE currency_v2 RENAME TO currency;
+        CREATE INDEX currency_owner_id ON currency (owner_id);
+    '''),
+    # 3: per-owner, per-ticker aggregates of the stocks lots, maintained by triggers
+    (3, '''
+        CREATE TABLE positions (
+            owner_id INTEGER NOT NULL REFERENCES users(telegram_id) ON DELETE CASCADE,
+            stock_id TEXT NOT NULL,
+            quantity INTEGER NOT NULL,
+            cost_minor INTEGER NOT NULL,
+            lot_count INTEGER NOT NULL,
+            PRIMARY KEY (owner_id, stock_id)
+        ) WITHOUT ROWID;
+        INSERT INTO positions (owner_id, stock_id, quantity, cost_minor, lot_count)
+            SELECT owner_id, stock_id, SUM(quantity), SUM(quantity * unit_price_minor), COUNT(*)
+            FROM stocks GROUP BY owner_id, stock_id;
+
+        CREATE TRIGGER stocks_positions_insert AFTER INSERT ON stocks
+        BEGIN
+            INSERT INTO positions (owner_id, stock_id, quantity, cost_minor, lot_count)
+                VALUES (NEW.owner_id, NEW.stock_id, NEW.quantity, NEW.quantity * NEW.unit_price_minor, 1)
+                ON CONFLICT (owner_id, stock_id) DO UPDATE SET
+                    quantity = quantity + excluded.quantity,
+                    cost_minor = cost_minor + excluded.cost_minor,
+                    lot_count = lot_count + 1;
+        END;
+
+        CREATE TRIGGER stocks_positions_delete AFTER DELETE ON stocks
+        BEGIN
+            UPDATE positions SET
+                quantity = quantity - OLD.quantity,
+                cost_minor = cost_minor - OLD.quantity * OLD.unit_price_minor,
+                lot_count = lot_count - 1
+            WHERE owner_id = OLD.owner_id AND stock_id = OLD.stock_id;
+            DELETE FROM positions WHERE owner_id = OLD.owner_id AND stock_id = OLD.stock_id AND lot_count <= 0;
+        END;
+
+        CREATE TRIGGER stocks_positions_update AFTER UPDATE ON stocks
+        BEGIN
+            UPDATE positions SET
+                quantity = quantity - OLD.quantity,
+                cost_minor = cost_minor - OLD.quantity * OLD.unit_price_minor,
+                lot_count = lot_count - 1
+            WHERE owner_id = OLD.owner_id AND stock_id = OLD.stock_id;
+            DELETE FROM positions WHERE owner_id = OLD.owner_id AND stock_id = OLD.stock_id AND lot_count <= 0;
+            INSERT INTO positions (owner_id, stock_id, quantity, cost_minor, lot_count)
+                VALUES (NEW.owner_id, NEW.stock_id, NEW.quantity, NEW.quantity * NEW.unit_price_minor, 1)
+                ON CONFLICT (owner_id, stock_id) DO UPDATE SET
+                    quantity = quantity + excluded.quantity,
+                    cost_minor = cost_minor + excluded.cost_minor,
+                    lot_count = lot_count + 1;
+        END;
+    '''),
+    # 4: FSM dialogue state shared by bot replicas (FSM_STORAGE=sqlite)
+    (4, '''
+        CREATE TABLE fsm (
+            key TEXT PRIMARY KEY,
+            state TEXT,
+            data TEXT NOT NULL DEFAULT '{}',
+            expires_at REAL NOT NULL
+        ) WITHOUT ROWID;
+        CREATE INDEX fsm_expires_at ON fsm (expires_at);
+    '''),
+    # 5: price alerts; triggered ones are kept for history
+    (5, '''
+        CREATE TABLE alerts (
+            id INTEGER PRIMARY KEY,
+            owner_id INTEGER NOT NULL REFERENCES users(telegram_id) ON DELETE CASCADE,
+            chat_id INTEGER NOT NULL,
+            stock_id TEXT NOT NULL,
+            direction TEXT NOT NULL CHECK (direction IN ('>=', '<=')),
+            threshold_minor INTEGER NOT NULL,
+            created_at TEXT NOT NULL,
+            triggered_at TEXT
+        );
+        CREATE INDEX alerts_active ON alerts (owner_id) WHERE triggered_at IS NULL;
+    '''),
+    # 6: daily closes from ISS candles, one row per ticker and trading day
+    (6, '''
+        CREATE TABLE candles (
+            stock_id TEXT NOT NULL,
+            day TEXT NOT NULL,
+            close REAL NOT NULL,
+            PRIMARY KEY (stock_id, day)
+        ) WITHOUT ROWID;
+    '''),
+    # 7: CBR rates archive, rubles per unit in force on each day
+    (7, '''
+        CREATE TABLE fx_rates (
+            day TEXT NOT NULL,
+            currency TEXT NOT NULL,
+            rub_per_unit REAL NOT NULL,
+            PRIMARY KEY (day, currency)
+        ) WITHOUT ROWID;
+    '''),
+]
+
+
+def schema_version(conn: sqlite3.Connection) -> int:
+    return conn.execute('PRAGMA user_version').fetchone()[0]
+
+
+def _statements(script: str) -> Iterator[str]:
+    statement = ''
+    for line in script.splitlines(keepends=True):
+        statement += line
+        if sqlite3.complete_statement(statement):
+            yield statement.strip()
+            statement = ''
+
+
+def migrate(conn: sqlite3.Connection) -> int:
+    """Apply all pending migrations and return the resulting schema version.
+
+    The version is re-read under the write lock, so several processes starting
+    at once apply every migration exactly once.
+    """
+    isolation_level = conn.isolation_level
+    conn.isolation_level = None
+    try:
+        version = schema_version(conn)
+        for target, script in MIGRATIONS:
+            if target <= version:
+                continue
+            conn.execute('BEGIN IMMEDIATE')
+            try:
+                version = schema_version(conn)
+                if target > version:
+                    logger.info('Migrating database schema to version %s', target)
+                    for statement in _statements(script):
+                        conn.execute(statement)
+                    conn.execute(f'PRAGMA user_version = {target}')
+                    version = target
+                conn.execute('COMMIT')
+            except BaseException:
+                conn.execute('ROLLBACK')
+                raise
+        return version
+    finally:
+        conn.isolation_level = isolation_level
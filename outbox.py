@@ -0,0 +1,262 @@
+import asyncio
+import contextvars
+import logging
+import os
+import time
+from collections import deque
+from contextlib import contextmanager
+from typing import Any, Callable, Deque, Dict, Optional
+
+from aiogram import Bot
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware
+from aiogram.exceptions import TelegramNetworkError, TelegramRetryAfter
+
+
+logger = logging.getLogger(__name__)
+
+# Priority lanes: replies to users go ahead of notifications
+INTERACTIVE = 0
+BULK = 1
+
+# Telegram allows about 30 messages per second overall and about one per second per chat
+GLOBAL_RATE = float(os.getenv('OUTBOX_GLOBAL_RATE', 30))
+CHAT_RATE = float(os.getenv('OUTBOX_CHAT_RATE', 1))
+# Replies of one handler (e.g. 'stock price' sends two messages) may go out back to back
+CHAT_BURST = float(os.getenv('OUTBOX_CHAT_BURST', 3))
+MAX_RETRIES = int(os.getenv('OUTBOX_MAX_RETRIES', 5))
+OUTBOX_WORKERS = int(os.getenv('OUTBOX_WORKERS', 8))
+
+_priority: contextvars.ContextVar[int] = contextvars.ContextVar('outbox_priority', default=INTERACTIVE)
+
+
+@contextmanager
+def priority(lane: int):
+    """Requests made to Telegram inside this block are paced as ``lane``."""
+    token = _priority.set(lane)
+    try:
+        yield
+    finally:
+        _priority.reset(token)
+
+
+class TokenBucket:
+    def __init__(self, rate: float, capacity: float, now: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = now
+
+    def refill(self, now: float) -> None:
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self, now: float) -> float:
+        """Seconds until a token is available; 0 when one can be taken right away."""
+        self.refill(now)
+        return 0.0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+    def take(self) -> None:
+        self.tokens -= 1
+
+
+class RateLimiter:
+    """Global and per-chat token buckets shared by every outgoing Telegram request.
+
+    While an interactive request is waiting, bulk requests hold back, so replies
+    to users are never stuck behind a notification fan-out.
+    """
+
+    def __init__(self, global_rate: float = GLOBAL_RATE, chat_rate: float = CHAT_RATE,
+                 chat_burst: float = CHAT_BURST, clock: Callable[[], float] = time.monotonic):
+        self.clock = clock
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.global_bucket = TokenBucket(global_rate, global_rate, clock())
+        self.chat_buckets: Dict[Any, TokenBucket] = {}
+        self.paused_until = 0.0
+        self.interactive_waiting = 0
+
+    def pause(self, seconds: float) -> None:
+        """Stop all sending for ``seconds`` (Telegram answered with retry_after)."""
+        self.paused_until = max(self.paused_until, self.clock() + seconds)
+
+    def _chat_bucket(self, chat_id: Any, now: float) -> TokenBucket:
+        bucket = self.chat_buckets.get(chat_id)
+        if bucket is None:
+            if len(self.chat_buckets) > 10000:
+                self._forget_idle_chats(now)
+            bucket = self.chat_buckets[chat_id] = TokenBucket(self.chat_rate, self.chat_burst, now)
+        return bucket
+
+    def _forget_idle_chats(self, now: float) -> None:
+        # A bucket that has refilled completely behaves exactly like a new one
+        for chat_id, bucket in list(self.chat_buckets.items()):
+            bucket.refill(now)
+            if bucket.tokens >= bucket.capacity:
+                del self.chat_buckets[chat_id]
+
+    async def acquire(self, chat_id: Any, lane: int = INTERACTIVE) -> float:
+        """Wait for a send slot in ``chat_id`` and return how long it took."""
+        started = self.clock()
+        interactive = lane == INTERACTIVE
+        if interactive:
+            self.interactive_waiting += 1
+        try:
+            while True:
+                now = self.clock()
+                wait = max(self.paused_until - now,
+                           self.global_bucket.wait_time(now),
+                           self._chat_bucket(chat_id, now).wait_time(now))
+                if not interactive and self.interactive_waiting:
+                    wait = max(wait, 1 / self.global_bucket.rate)
+                if wait <= 0:
+                    self.global_bucket.take()
+                    self.chat_buckets[chat_id].take()
+                    return now - started
+                await asyncio.sleep(wait)
+        finally:
+            if interactive:
+                self.interactive_waiting -= 1
+
+
+class OutboxMetrics:
+    def __init__(self, window: float = 60.0, clock: Callable[[], float] = time.monotonic):
+        self.window = window
+        self.clock = clock
+        self.sent = {INTERACTIVE: 0, BULK: 0}
+        self.failed = 0
+        self.retried = 0
+        self.throttled_seconds = 0.0
+        self._recent: Deque[float] = deque()
+
+    def record_sent(self, lane: int) -> None:
+        self.sent[lane] += 1
+        now = self.clock()
+        self._recent.append(now)
+        while self._recent and self._recent[0] < now - self.window:
+            self._recent.popleft()
+
+    def throughput(self) -> float:
+        """Messages per second over the last ``window`` seconds."""
+        now = self.clock()
+        while self._recent and self._recent[0] < now - self.window:
+            self._recent.popleft()
+        return len(self._recent) / self.window
+
+    def snapshot(self) -> Dict[str, float]:
+        return {
+            'sent_interactive': self.sent[INTERACTIVE],
+            'sent_bulk': self.sent[BULK],
+            'failed': self.failed,
+            'retried': self.retried,
+            'throttled_seconds': round(self.throttled_seconds, 3),
+            'throughput_per_second': round(self.throughput(), 3),
+        }
+
+
+class RateLimitMiddleware(BaseRequestMiddleware):
+    """Bot session middleware pacing every request addressed to a chat.
+
+    Requests without a chat (getUpdates, answerCallbackQuery...) pass through.
+    A 429 answer pauses all sending for retry_after seconds and the request is
+    repeated.
+    """
+
+    def __init__(self, limiter: RateLimiter, metrics: OutboxMetrics, max_retries: int = MAX_RETRIES):
+        self.limiter = limiter
+        self.metrics = metrics
+        self.max_retries = max_retries
+
+    async def __call__(self, make_request, bot: Bot, method):
+        chat_id = getattr(method, 'chat_id', None)
+        if chat_id is None:
+            return await make_request(bot, method)
+
+        lane = _priority.get()
+        for attempt in range(self.max_retries + 1):
+            self.metrics.throttled_seconds += await self.limiter.acquire(chat_id, lane)
+            try:
+                response = await make_request(bot, method)
+            except TelegramRetryAfter as error:
+                if attempt == self.max_retries:
+                    self.metrics.failed += 1
+                    raise
+                logger.warning('Flood control, pausing outgoing messages for %s s', error.retry_after)
+                self.metrics.retried += 1
+                self.limiter.pause(error.retry_after)
+            except Exception:
+                self.metrics.failed += 1
+                raise
+            else:
+                self.metrics.record_sent(lane)
+                return response
+
+
+class Outbox:
+    """Background queue for bulk notifications (alerts, broadcasts, live quote edits).
+
+    ``submit`` and ``submit_edit`` return immediately; workers send the requests
+    in the bulk lane, so the rate limiter serves interactive replies first.
+    """
+
+    def __init__(self, workers: int = OUTBOX_WORKERS):
+        self.workers = workers
+        self.bot: Optional[Bot] = None
+        self._queue: 'asyncio.Queue' = asyncio.Queue()
+        self._tasks = []
+
+    @property
+    def pending(self) -> int:
+        return self._queue.qsize()
+
+    def start(self, bot: Bot) -> None:
+        self.bot = bot
+        if not self._tasks:
+            self._tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+
+    async def stop(self, timeout: float = 5.0) -> None:
+        # Give queued notifications a chance to go out
+        if self._tasks and not self._queue.empty():
+            try:
+                await asyncio.wait_for(self._queue.join(), timeout)
+            except asyncio.TimeoutError:
+                logger.warning('Dropping %s undelivered notifications', self._queue.qsize())
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+    def submit(self, chat_id: int, text: str, **kwargs) -> None:
+        self._queue.put_nowait(('send_message', chat_id, dict(kwargs, text=text)))
+
+    def submit_edit(self, chat_id: int, message_id: int, text: str, **kwargs) -> None:
+        self._queue.put_nowait(('edit_message_text', chat_id, dict(kwargs, message_id=message_id, text=text)))
+
+    async def send(self, chat_id: int, text: str, **kwargs) -> None:
+        """Same as ``submit``, usable where an async callback is expected."""
+        self.submit(chat_id, text, **kwargs)
+
+    async def edit(self, chat_id: int, message_id: int, text: str, **kwargs) -> None:
+        """Same as ``submit_edit``, usable where an async callback is expected."""
+        self.submit_edit(chat_id, message_id, text, **kwargs)
+
+    async def _worker(self) -> None:
+        while True:
+            method, chat_id, kwargs = await self._queue.get()
+            try:
+                with priority(BULK):
+                    await getattr(self.bot, method)(chat_id=chat_id, **kwargs)
+            except TelegramNetworkError:
+                logger.warning('Network error, requeueing notification for chat %s', chat_id)
+                await asyncio.sleep(1)
+                self._queue.put_nowait((method, chat_id, kwargs))
+            except Exception:
+                logger.exception('Failed to deliver notification to chat %s', chat_id)
+            finally:
+                self._queue.task_done()
+
+
+limiter = RateLimiter()
+metrics = OutboxMetrics()
+rate_limit_middleware = RateLimitMiddleware(limiter, metrics)
+outbox = Outbox()
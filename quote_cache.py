@@ -0,0 +1,148 @@
+import asyncio
+import time
+from collections import OrderedDict
+from typing import Any, Awaitable, Callable, Dict, Hashable, Iterable, Optional
+
+
+def _is_cacheable(value: Any) -> bool:
+    return value is not None
+
+
+class QuoteCache:
+    """In-process TTL cache for market quotes with LRU eviction and single-flight.
+
+    Concurrent requests for a key that is not cached share one upstream call:
+    the first caller starts the fetch, the others await the same future. The
+    fetch runs in a task of its own, so a caller that is cancelled (e.g. by a
+    timeout) stops waiting without cancelling it for everybody else.
+    """
+
+    def __init__(self, maxsize: int = 1024, clock: Callable[[], float] = time.monotonic):
+        self.maxsize = maxsize
+        self.clock = clock
+        self._entries: 'OrderedDict[Hashable, tuple]' = OrderedDict()
+        self._inflight: Dict[Hashable, asyncio.Future] = {}
+        # The event loop keeps only weak references to tasks
+        self._fetches = set()
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+        self.evictions = 0
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def get(self, key: Hashable) -> Optional[Any]:
+        """Return the cached value or None if it is missing or expired."""
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        value, expires_at = entry
+        if expires_at <= self.clock():
+            del self._entries[key]
+            return None
+        self._entries.move_to_end(key)
+        return value
+
+    def set(self, key: Hashable, value: Any, ttl: float) -> None:
+        self._entries[key] = (value, self.clock() + ttl)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+    def clear(self) -> None:
+        self._entries.clear()
+
+    async def get_or_fetch(self, key: Hashable, fetch: Callable[[], Awaitable[Any]], ttl: float,
+                           cacheable: Callable[[Any], bool] = _is_cacheable) -> Any:
+        """Return the cached value for ``key`` or fetch it once for all concurrent callers."""
+        value = self.get(key)
+        if value is not None:
+            self.hits += 1
+            return value
+        future = self._inflight.get(key)
+        if future is not None:
+            self.coalesced += 1
+        else:
+            self.misses += 1
+
+            async def fetch_one(keys: list) -> Dict[Hashable, Any]:
+                return {key: await fetch()}
+
+            future = self._start_fetch([key], fetch_one, ttl, cacheable)[key]
+        return await asyncio.shield(future)
+
+    async def get_many_or_fetch(self, keys: Iterable[Hashable],
+                                fetch_many: Callable[[list], Awaitable[Dict[Hashable, Any]]], ttl: float,
+                                cacheable: Callable[[Any], bool] = _is_cacheable) -> Dict[Hashable, Any]:
+        """Batch variant of ``get_or_fetch``: all missing keys go to one ``fetch_many`` call.
+
+        ``fetch_many`` receives the list of missing keys and returns a dict with a value
+        for each of them.
+        """
+        result: Dict[Hashable, Any] = {}
+        waiting: Dict[Hashable, asyncio.Future] = {}
+        missing = []
+        for key in dict.fromkeys(keys):
+            value = self.get(key)
+            if value is not None:
+                self.hits += 1
+                result[key] = value
+            elif key in self._inflight:
+                self.coalesced += 1
+                waiting[key] = self._inflight[key]
+            else:
+                self.misses += 1
+                missing.append(key)
+
+        if missing:
+            waiting.update(self._start_fetch(missing, fetch_many, ttl, cacheable))
+        for key, future in waiting.items():
+            result[key] = await asyncio.shield(future)
+        return result
+
+    def _start_fetch(self, keys: list, fetch_many: Callable[[list], Awaitable[Dict[Hashable, Any]]], ttl: float,
+                     cacheable: Callable[[Any], bool]) -> Dict[Hashable, asyncio.Future]:
+        loop = asyncio.get_running_loop()
+        futures = {key: loop.create_future() for key in keys}
+        self._inflight.update(futures)
+        task = loop.create_task(self._fetch(futures, fetch_many, ttl, cacheable))
+        self._fetches.add(task)
+        task.add_done_callback(self._fetches.discard)
+        return futures
+
+    async def _fetch(self, futures: Dict[Hashable, asyncio.Future],
+                     fetch_many: Callable[[list], Awaitable[Dict[Hashable, Any]]], ttl: float,
+                     cacheable: Callable[[Any], bool]) -> None:
+        try:
+            fetched = await fetch_many(list(futures))
+        except BaseException as error:
+            for future in futures.values():
+                if isinstance(error, asyncio.CancelledError):
+                    future.cancel()
+                else:
+                    future.set_exception(error)
+                    # Mark the exception as retrieved when nobody is waiting any more
+                    future.exception()
+            if not isinstance(error, Exception):
+                raise
+        else:
+            for key, future in futures.items():
+                value = fetched.get(key)
+                if cacheable(value):
+                    self.set(key, value, ttl)
+                future.set_result(value)
+        finally:
+            for key in futures:
+                del self._inflight[key]
+
+    def stats(self) -> Dict[str, int]:
+        """Counters for monitoring."""
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'coalesced': self.coalesced,
+            'evictions': self.evictions,
+            'size': len(self._entries),
+        }
@@ -0,0 +1,181 @@
+import asyncio
+import logging
+import os
+import time
+from datetime import datetime, time as day_time, timedelta, timezone
+from typing import Awaitable, Callable, Dict, Iterable, List, NamedTuple, Optional
+
+import database
+import market_data
+from db_executor import db_executor
+from fx import FxEngine, fx_engine
+
+
+logger = logging.getLogger(__name__)
+
+MOSCOW_TZ = timezone(timedelta(hours=3))
+# MOEX equities: pre-open auction, main and evening sessions on weekdays
+TRADING_START = day_time(9, 50)
+TRADING_END = day_time(23, 50)
+
+# How often quotes are refreshed while the exchange is open and while it is closed
+REFRESH_INTERVAL = float(os.getenv('REFRESH_INTERVAL', 30))
+OFF_HOURS_REFRESH_INTERVAL = float(os.getenv('OFF_HOURS_REFRESH_INTERVAL', 1800))
+# Older snapshot entries (e.g. tickers nobody holds) are looked up again on demand
+SNAPSHOT_MAX_AGE = float(os.getenv('SNAPSHOT_MAX_AGE', 600))
+
+
+class Quote(NamedTuple):
+    price: Optional[float]
+    currency: Optional[str]
+    fetched_at: float
+
+    @property
+    def age(self) -> float:
+        return max(0.0, time.time() - self.fetched_at)
+
+
+def format_age(quote: Quote) -> str:
+    seconds = int(quote.age)
+    if seconds < 60:
+        return f'{seconds} сек. назад'
+    if seconds < 3600:
+        return f'{seconds // 60} мин. назад'
+    return f'{seconds // 3600} ч. назад'
+
+
+def is_trading_time(moment: Optional[datetime] = None) -> bool:
+    moment = (moment or datetime.now(timezone.utc)).astimezone(MOSCOW_TZ)
+    return moment.weekday() < 5 and TRADING_START <= moment.time() <= TRADING_END
+
+
+class MarketSnapshot:
+    """Latest known quotes, shared by all handlers.
+
+    Filled by ``QuoteRefresher`` in the background and by on-demand lookups for
+    tickers it does not track, so a lookup of a tracked ticker never waits for
+    the exchange.
+    """
+
+    def __init__(self, max_age: float = SNAPSHOT_MAX_AGE, fx: FxEngine = fx_engine):
+        self.max_age = max_age
+        self.quotes: Dict[str, Quote] = {}
+        self.fx = fx
+
+    def get(self, stock_id: str) -> Optional[Quote]:
+        """Snapshot entry for ``stock_id`` unless it is missing or older than ``max_age``."""
+        quote = self.quotes.get(stock_id.upper())
+        if quote is None or quote.age > self.max_age:
+            return None
+        return quote
+
+    def update(self, prices: Dict[str, tuple], fetched_at: Optional[float] = None) -> None:
+        fetched_at = fetched_at or time.time()
+        for stock_id, (price, currency) in prices.items():
+            if price is not None:
+                self.quotes[stock_id] = Quote(price, currency, fetched_at)
+
+    async def get_quotes(self, stock_ids: Iterable[str]) -> Dict[str, Quote]:
+        """Quotes for ``stock_ids``; tickers missing from the snapshot are fetched in one batch."""
+        stock_ids = list(dict.fromkeys(stock_id.upper() for stock_id in stock_ids))
+        quotes = {stock_id: self.get(stock_id) for stock_id in stock_ids}
+        missing = [stock_id for stock_id, quote in quotes.items() if quote is None]
+        if missing:
+            fetched_at = time.time()
+            prices = await market_data.get_stock_prices(missing)
+            self.update(prices, fetched_at)
+            for stock_id in missing:
+                price, currency = prices[stock_id]
+                quotes[stock_id] = Quote(price, currency, fetched_at)
+        return quotes
+
+    async def get_quote(self, stock_id: str) -> Quote:
+        stock_id = stock_id.upper()
+        quote = self.get(stock_id)
+        if quote is None:
+            fetched_at = time.time()
+            price, currency = await market_data.get_stock_price(stock_id)
+            quote = Quote(price, currency, fetched_at)
+            if price is not None:
+                self.quotes[stock_id] = quote
+        return quote
+
+    async def get_usd_rub(self) -> Optional[Quote]:
+        # The whole CBR table is kept by the FX engine, USD/RUB is read from it
+        table = await self.fx.latest()
+        rate = table.rate('USD') if table is not None else None
+        if rate is None:
+            return None
+        return Quote(rate, 'RUB', table.fetched_at)
+
+
+class QuoteRefresher:
+    """Background task that keeps ``snapshot`` fresh for every held ticker and the CBR rates."""
+
+    def __init__(self, snapshot: MarketSnapshot, interval: float = REFRESH_INTERVAL,
+                 off_hours_interval: float = OFF_HOURS_REFRESH_INTERVAL,
+                 is_open: Callable[[], bool] = is_trading_time, worker_index: int = 0, worker_count: int = 1):
+        self.snapshot = snapshot
+        self.interval = interval
+        self.off_hours_interval = off_hours_interval
+        self.is_open = is_open
+        # Each worker process refreshes the tickers of its own users; worker 0 also keeps the CBR table fresh
+        self.worker_index = worker_index
+        self.worker_count = worker_count
+        # Other features add the tickers they need and get every batch of fresh quotes
+        self.ticker_sources: List[Callable[[], Iterable[str]]] = []
+        self.listeners: List[Callable[[Dict[str, Quote]], Awaitable]] = []
+        # Same for intraday prices (last trade) instead of the previous close, e.g. for alerts and /watch
+        self.live_ticker_sources: List[Callable[[], Iterable[str]]] = []
+        self.live_listeners: List[Callable[[Dict[str, Quote]], Awaitable]] = []
+
+    async def tracked_tickers(self) -> List[str]:
+        tickers = await db_executor.read(database.select_held_tickers, self.worker_index, self.worker_count)
+        for source in self.ticker_sources:
+            tickers.extend(source())
+        return list(dict.fromkeys(tickers))
+
+    def live_tickers(self) -> List[str]:
+        return list(dict.fromkeys(ticker for source in self.live_ticker_sources for ticker in source()))
+
+    async def _fetch_live_prices(self) -> Dict[str, tuple]:
+        tickers = self.live_tickers()
+        return await market_data.fetch_last_prices(tickers) if tickers else {}
+
+    async def refresh_once(self) -> None:
+        tickers = await self.tracked_tickers()
+        fetched_at = time.time()
+        # All bypass the caches: the refresher is what keeps the data fresh; other workers reuse the FX_TTL cache
+        prices, live_prices, _ = await asyncio.gather(market_data.fetch_stock_prices(tickers),
+                                                      self._fetch_live_prices(),
+                                                      self.snapshot.fx.latest(force=self.worker_index == 0))
+        self.snapshot.update(prices, fetched_at)
+        logger.debug('Refreshed %s quotes and %s live prices', len(tickers), len(live_prices))
+
+        await self._notify(self.listeners, prices, fetched_at)
+        await self._notify(self.live_listeners, live_prices, fetched_at)
+
+    @staticmethod
+    async def _notify(listeners: List[Callable[[Dict[str, Quote]], Awaitable]], prices: Dict[str, tuple],
+                      fetched_at: float) -> None:
+        if not listeners:
+            return
+        quotes = {stock_id: Quote(price, currency, fetched_at)
+                  for stock_id, (price, currency) in prices.items() if price is not None}
+        for listener in listeners:
+            try:
+                await listener(quotes)
+            except Exception:
+                logger.exception('Quote listener %r failed', listener)
+
+    async def run(self) -> None:
+        while True:
+            try:
+                await self.refresh_once()
+            except Exception:
+                logger.exception('Failed to refresh market data')
+            await asyncio.sleep(self.interval if self.is_open() else self.off_hours_interval)
+
+
+snapshot = MarketSnapshot()
+refresher = QuoteRefresher(snapshot)
@@ -0,0 +1,178 @@
+import asyncio
+import logging
+import os
+import time
+from bisect import bisect_left
+from typing import Dict, Iterable, Iterator, List, NamedTuple, Optional, Sequence, Set, Tuple
+
+import market_data
+
+
+logger = logging.getLogger(__name__)
+
+# How often the TQBR securities list is downloaded again
+SECURITIES_REFRESH_INTERVAL = float(os.getenv('SECURITIES_REFRESH_INTERVAL', 6 * 3600))
+# Retry delay when the download failed
+SECURITIES_RETRY_INTERVAL = 60.0
+# How long a negative network answer for an unknown ticker is remembered
+SECURITY_MISS_TTL = float(os.getenv('SECURITY_MISS_TTL', 600))
+# Inline query answers at most this many securities
+SEARCH_LIMIT = 20
+
+
+class Security(NamedTuple):
+    secid: str
+    shortname: str
+    # PREVPRICE from the last download of the list
+    price: Optional[float]
+
+
+def _name_keys(secid: str, shortname: str) -> List[Tuple[str, str]]:
+    # The whole issuer name and each of its words, so 'газ' finds GAZP by 'ГАЗПРОМ ао'
+    name = shortname.casefold()
+    return [(key, secid) for key in {name, *name.split()} if key]
+
+
+def _prefix_range(keys: List[Tuple[str, str]], prefix: str) -> Iterator[Tuple[str, str]]:
+    for i in range(bisect_left(keys, (prefix,)), len(keys)):
+        if not keys[i][0].startswith(prefix):
+            return
+        yield keys[i]
+
+
+class SecurityIndex:
+    """Local copy of the MOEX TQBR securities list.
+
+    Existence checks are plain set lookups and ticker search is a binary search
+    over the sorted search keys; the list is replaced as a whole on every
+    refresh, so readers never see a half-built index.
+    """
+
+    def __init__(self):
+        self._names: Dict[str, str] = {}
+        self._prices: Dict[str, float] = {}
+        self._tickers = frozenset()
+        # Sorted (key, secid) pairs: all keys starting with a prefix are one contiguous slice
+        self._ticker_keys: List[Tuple[str, str]] = []
+        self._name_keys: List[Tuple[str, str]] = []
+        self.updated_at: Optional[float] = None
+
+    def __contains__(self, stock_id: str) -> bool:
+        return stock_id.upper() in self._tickers
+
+    def __len__(self) -> int:
+        return len(self._tickers)
+
+    def name(self, stock_id: str) -> Optional[str]:
+        return self._names.get(stock_id.upper())
+
+    def price(self, stock_id: str) -> Optional[float]:
+        return self._prices.get(stock_id.upper())
+
+    def load(self, rows: Iterable[Sequence]) -> None:
+        """Replace the index with ``(SECID, SHORTNAME[, PREVPRICE])`` rows."""
+        names, prices = {}, {}
+        for secid, shortname, *rest in rows:
+            secid = secid.upper()
+            names[secid] = shortname or ''
+            if rest and rest[0] is not None:
+                prices[secid] = rest[0]
+        ticker_keys = sorted((secid.casefold(), secid) for secid in names)
+        name_keys = sorted(key for secid, shortname in names.items() for key in _name_keys(secid, shortname))
+        self._names, self._prices, self._ticker_keys, self._name_keys = names, prices, ticker_keys, name_keys
+        self._tickers = frozenset(names)
+        self.updated_at = time.time()
+
+    def add(self, stock_id: str, shortname: str = '') -> None:
+        """Remember a ticker confirmed by the network until the next refresh."""
+        stock_id = stock_id.upper()
+        if stock_id in self._tickers:
+            return
+        self._names[stock_id] = shortname
+        self._ticker_keys = sorted(self._ticker_keys + [(stock_id.casefold(), stock_id)])
+        self._name_keys = sorted(self._name_keys + _name_keys(stock_id, shortname))
+        self._tickers = self._tickers | {stock_id}
+
+    def search(self, query: str, limit: int = SEARCH_LIMIT) -> List[Security]:
+        """Securities whose ticker or a word of the name starts with ``query``.
+
+        Ticker matches come first (the exact ticker is the shortest, so it leads),
+        then name matches; both scans stop after ``limit`` securities.
+        """
+        prefix = query.strip().casefold()
+        found: Dict[str, None] = {}
+        for keys in (self._ticker_keys, self._name_keys):
+            for _, secid in _prefix_range(keys, prefix):
+                if len(found) >= limit:
+                    break
+                found.setdefault(secid)
+        return [self._security(secid) for secid in found]
+
+    def _security(self, secid: str) -> Security:
+        return Security(secid, self._names.get(secid, ''), self._prices.get(secid))
+
+    def clear(self) -> None:
+        self.load([])
+        self.updated_at = None
+
+    async def refresh(self) -> bool:
+        url = f'{market_data.ISS_URL}/engines/stock/markets/shares/boards/TQBR/securities.json'
+        params = {'iss.only': 'securities', 'securities.columns': 'SECID,SHORTNAME,PREVPRICE'}
+        data_json = await market_data.client.get_json(url, params)
+        if not data_json:
+            logger.warning('Failed to download the TQBR securities list')
+            return False
+        rows = data_json.get('securities', {}).get('data', [])
+        if not rows:
+            logger.warning('TQBR securities list is empty, keeping %s cached tickers', len(self))
+            return False
+        self.load(rows)
+        logger.info('Loaded %s TQBR securities', len(self))
+        return True
+
+    async def run_refresher(self, interval: float = SECURITIES_REFRESH_INTERVAL) -> None:
+        """Refresh the index forever; meant to run as a background task."""
+        while True:
+            refreshed = await self.refresh()
+            await asyncio.sleep(interval if refreshed else SECURITIES_RETRY_INTERVAL)
+
+
+security_index = SecurityIndex()
+
+
+async def _fetch_stock_existence(stock_id: str) -> Optional[bool]:
+    # Обращаемся к МосБирже; None means the exchange could not be reached and is not cached
+    data = await market_data.client.get_json(f'{market_data.ISS_URL}/securities/{stock_id}.json')
+    if data is None:
+        return None
+    exist = data.get('boards', {}).get('data', [])
+    return bool(exist)
+
+
+#Функция проверки существования акции на бирже
+async def check_stock_existence(stock_id: str) -> bool:
+    stock_id = stock_id.upper()
+    if stock_id in security_index:
+        return True
+    # Tickers that are not in the TQBR list yet are checked on the exchange
+    exists = await market_data.quote_cache.get_or_fetch(('exists', stock_id),
+                                                        lambda: _fetch_stock_existence(stock_id),
+                                                        SECURITY_MISS_TTL)
+    if exists:
+        security_index.add(stock_id)
+    return bool(exists)
+
+
+async def check_stocks_existence(stock_ids: Iterable[str]) -> Set[str]:
+    """Subset of ``stock_ids`` that exist on MOEX.
+
+    Answered from the TQBR index (downloaded first if it is still empty); only
+    tickers missing from it go to the exchange, each one once.
+    """
+    stock_ids = {stock_id.upper() for stock_id in stock_ids}
+    if not len(security_index):
+        await security_index.refresh()
+    known = {stock_id for stock_id in stock_ids if stock_id in security_index}
+    missing = list(stock_ids - known)
+    found = await asyncio.gather(*(check_stock_existence(stock_id) for stock_id in missing))
+    return known | {stock_id for stock_id, exists in zip(missing, found) if exists}
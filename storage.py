@@ -0,0 +1,144 @@
+import asyncio
+import json
+import logging
+import os
+import time
+from typing import Any, Callable, Dict, Optional, Tuple
+
+from aiogram.fsm.state import State
+from aiogram.fsm.storage.base import BaseStorage, DefaultKeyBuilder, StateType, StorageKey
+
+import database
+from db_executor import DatabaseExecutor, db_executor
+
+
+logger = logging.getLogger(__name__)
+
+# memory | sqlite | redis
+FSM_STORAGE = os.getenv('FSM_STORAGE', 'memory')
+# Dialogues that have not moved for this many seconds are forgotten
+FSM_TTL = int(os.getenv('FSM_TTL', 3600))
+FSM_REDIS_URL = os.getenv('FSM_REDIS_URL', 'redis://localhost:6379/0')
+# How often expired dialogues are removed from the memory and SQLite storages
+FSM_SWEEP_INTERVAL = float(os.getenv('FSM_SWEEP_INTERVAL', 300))
+
+
+def _state_name(state: StateType) -> Optional[str]:
+    return state.state if isinstance(state, State) else state
+
+
+class TTLMemoryStorage(BaseStorage):
+    """In-process storage that forgets dialogues ``ttl`` seconds after their last change.
+
+    Unlike aiogram's ``MemoryStorage`` it does not create a record when a state is
+    read and drops records as soon as they are cleared, so memory only holds
+    dialogues that are actually in progress.
+    """
+
+    def __init__(self, ttl: float = FSM_TTL, clock: Callable[[], float] = time.monotonic):
+        self.ttl = ttl
+        self.clock = clock
+        # key -> (state, data, expires_at)
+        self.records: Dict[StorageKey, Tuple[Optional[str], Dict[str, Any], float]] = {}
+
+    def _get(self, key: StorageKey) -> Tuple[Optional[str], Dict[str, Any]]:
+        record = self.records.get(key)
+        if record is None:
+            return None, {}
+        state, data, expires_at = record
+        if expires_at <= self.clock():
+            del self.records[key]
+            return None, {}
+        return state, data
+
+    def _put(self, key: StorageKey, state: Optional[str], data: Dict[str, Any]) -> None:
+        if state is None and not data:
+            self.records.pop(key, None)
+        else:
+            self.records[key] = (state, data, self.clock() + self.ttl)
+
+    async def set_state(self, key: StorageKey, state: StateType = None) -> None:
+        _, data = self._get(key)
+        self._put(key, _state_name(state), data)
+
+    async def get_state(self, key: StorageKey) -> Optional[str]:
+        return self._get(key)[0]
+
+    async def set_data(self, key: StorageKey, data: Dict[str, Any]) -> None:
+        state, _ = self._get(key)
+        self._put(key, state, data.copy())
+
+    async def get_data(self, key: StorageKey) -> Dict[str, Any]:
+        return self._get(key)[1].copy()
+
+    async def sweep(self) -> int:
+        now = self.clock()
+        expired = [key for key, (_, _, expires_at) in self.records.items() if expires_at <= now]
+        for key in expired:
+            del self.records[key]
+        return len(expired)
+
+    async def close(self) -> None:
+        self.records.clear()
+
+
+class SQLiteStorage(BaseStorage):
+    """Storage in the bot's SQLite database, shared by all processes using the same file."""
+
+    def __init__(self, executor: DatabaseExecutor = db_executor, ttl: float = FSM_TTL,
+                 clock: Callable[[], float] = time.time):
+        self.executor = executor
+        self.ttl = ttl
+        self.clock = clock
+        self.key_builder = DefaultKeyBuilder(with_bot_id=True, with_destiny=True)
+
+    def _key(self, key: StorageKey) -> str:
+        return self.key_builder.build(key)
+
+    async def set_state(self, key: StorageKey, state: StateType = None) -> None:
+        now = self.clock()
+        await self.executor.write(database.set_fsm_state, self._key(key), _state_name(state), now, now + self.ttl)
+
+    async def get_state(self, key: StorageKey) -> Optional[str]:
+        record = await self.executor.read(database.get_fsm_record, self._key(key), self.clock())
+        return record[0] if record else None
+
+    async def set_data(self, key: StorageKey, data: Dict[str, Any]) -> None:
+        now = self.clock()
+        await self.executor.write(database.set_fsm_data, self._key(key), json.dumps(data), now, now + self.ttl)
+
+    async def get_data(self, key: StorageKey) -> Dict[str, Any]:
+        record = await self.executor.read(database.get_fsm_record, self._key(key), self.clock())
+        return json.loads(record[1]) if record else {}
+
+    async def sweep(self) -> int:
+        return await self.executor.write(database.delete_expired_fsm, self.clock())
+
+    async def close(self) -> None:
+        pass
+
+
+def build_storage(kind: str = FSM_STORAGE) -> BaseStorage:
+    """FSM storage selected by the FSM_STORAGE environment variable."""
+    if kind == 'memory':
+        return TTLMemoryStorage(FSM_TTL)
+    if kind == 'sqlite':
+        return SQLiteStorage(db_executor, FSM_TTL)
+    if kind == 'redis':
+        # Imported here so the redis client is only needed when it is used
+        from aiogram.fsm.storage.redis import RedisStorage
+        return RedisStorage.from_url(FSM_REDIS_URL, state_ttl=FSM_TTL, data_ttl=FSM_TTL)
+    raise ValueError(f'Unknown FSM_STORAGE: {kind}')
+
+
+async def run_sweeper(storage: BaseStorage, interval: float = FSM_SWEEP_INTERVAL) -> None:
+    """Periodically drop expired dialogues; Redis expires keys by itself."""
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            removed = await storage.sweep()
+        except Exception:
+            logger.exception('Failed to remove expired FSM records')
+        else:
+            if removed:
+                logger.info('Removed %s expired FSM records', removed)
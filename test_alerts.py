@@ -0,0 +1,61 @@
+import unittest
+from unittest.mock import AsyncMock
+from unittest.mock import patch
+
+from alerts import Alert, AlertEngine, AlertIndex, parse_alert
+
+
+class ParseAlertTestCase(unittest.TestCase):
+
+    def test_parse_alert(self):
+        self.assertEqual(parse_alert('sber >= 300'), ('SBER', '>=', 30000))
+        self.assertEqual(parse_alert('GAZP<=120,5'), ('GAZP', '<=', 12050))
+        self.assertIsNone(parse_alert('SBER > 300'))
+        self.assertIsNone(parse_alert('SBER >= abc'))
+
+
+class AlertIndexTestCase(unittest.TestCase):
+
+    def setUp(self) -> None:
+        self.index = AlertIndex()
+        for alert_id, direction, threshold in [(1, '>=', 30000), (2, '>=', 31000), (3, '>=', 29000),
+                                               (4, '<=', 25000), (5, '<=', 24000)]:
+            self.index.add(Alert(alert_id, 1, 1, 'SBER', direction, threshold))
+
+    def test_only_crossed_alerts_fire(self):
+        crossed = self.index.pop_crossed('SBER', 30000)
+        self.assertEqual(sorted(alert.id for alert in crossed), [1, 3])
+        self.assertEqual(len(self.index), 3)
+        # Fired alerts are gone, the same price does not fire them again
+        self.assertEqual(self.index.pop_crossed('SBER', 30000), [])
+
+    def test_below_thresholds(self):
+        crossed = self.index.pop_crossed('SBER', 24500)
+        self.assertEqual([alert.id for alert in crossed], [4])
+
+    def test_remove(self):
+        self.index.remove(2)
+        self.assertEqual(sorted(alert.id for alert in self.index.pop_crossed('SBER', 40000)), [1, 3])
+        self.assertEqual(self.index.tickers(), ['SBER'])
+        self.index.remove(4)
+        self.index.remove(5)
+        self.assertEqual(self.index.tickers(), [])
+
+
+class AlertEngineTestCase(unittest.IsolatedAsyncioTestCase):
+
+    @patch('db_executor.db_executor.write', new_callable=AsyncMock)
+    async def test_check_delivers_and_persists_fired_alerts(self, mock_write):
+        send = AsyncMock()
+        engine = AlertEngine(send)
+        engine.index.add(Alert(7, 1, 100, 'SBER', '>=', 30000))
+        engine.index.add(Alert(8, 1, 100, 'GAZP', '<=', 12000))
+        fired = await engine.check({'SBER': (301.2, 'RUB', 0.0), 'GAZP': (130.0, 'RUB', 0.0)})
+        self.assertEqual([alert.id for alert in fired], [7])
+        self.assertEqual(mock_write.await_args.args[1], [7])
+        send.assert_awaited_once()
+        self.assertEqual(send.await_args.args[0], 100)
+
+
+if __name__ == '__main__':
+    unittest.main()
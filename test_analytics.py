@@ -0,0 +1,77 @@
+import unittest
+
+import numpy as np
+
+from analytics import Portfolio, daily_returns, risk
+
+
+class PortfolioTestCase(unittest.TestCase):
+
+    def setUp(self) -> None:
+        lots = [('SBER', 10, 25000, '2024-01-10T10:00:00'),
+                ('GAZP', 20, 15000, '2024-01-11T10:00:00'),
+                ('SBER', 30, 27000, '2024-01-12T10:00:00'),
+                ('YNDX', 1, 400000, '2024-01-12T10:00:00')]
+        self.portfolio = Portfolio.from_lots(lots)
+
+    def test_lots_are_aggregated(self):
+        self.assertEqual(self.portfolio.stock_ids, ['GAZP', 'SBER', 'YNDX'])
+        self.assertEqual(self.portfolio.quantity.tolist(), [20, 40, 1])
+        self.assertEqual(self.portfolio.lot_count.tolist(), [1, 2, 1])
+        self.assertEqual(self.portfolio.average_price.tolist(), [150.0, 265.0, 4000.0])
+
+    def test_streamed_lots_are_folded_in_chunks(self):
+        lots = [('SBER', 10, 25000, '2024-01-10T10:00:00'),
+                ('GAZP', 20, 15000, '2024-01-11T10:00:00'),
+                ('SBER', 30, 27000, '2024-01-12T10:00:00'),
+                ('YNDX', 1, 400000, '2024-01-12T10:00:00')]
+        # A generator, as database.iter_user_lots returns, two lots at a time
+        portfolio = Portfolio.from_lots(iter(lots), chunk_size=2)
+        self.assertEqual(portfolio.stock_ids, self.portfolio.stock_ids)
+        self.assertEqual(portfolio.quantity.tolist(), self.portfolio.quantity.tolist())
+        self.assertEqual(portfolio.cost.tolist(), self.portfolio.cost.tolist())
+        self.assertEqual(portfolio.lot_count.tolist(), self.portfolio.lot_count.tolist())
+        self.assertEqual(len(Portfolio.from_lots(iter([]))), 0)
+
+    def test_same_as_positions(self):
+        positions = Portfolio.from_positions([('GAZP', 20, 300000, 1), ('SBER', 40, 1060000, 2),
+                                              ('YNDX', 1, 400000, 1)])
+        self.assertEqual(positions.cost.tolist(), self.portfolio.cost.tolist())
+
+    def test_valuation(self):
+        valuation = self.portfolio.valuation({'GAZP': 120.0, 'SBER': 300.0, 'YNDX': None})
+        self.assertEqual(valuation.priced.tolist(), [True, True, False])
+        self.assertEqual(valuation.value[:2].tolist(), [2400.0, 12000.0])
+        self.assertEqual(valuation.total_value, 14400.0)
+        # The position without a price is not part of the totals
+        self.assertEqual(valuation.total_cost, 3000.0 + 10600.0)
+        self.assertAlmostEqual(valuation.weight[1], 12000 / 14400)
+        self.assertEqual(valuation.pnl[:2].tolist(), [-600.0, 1400.0])
+        self.assertAlmostEqual(valuation.pnl_percent[0], -20.0)
+        self.assertTrue(np.isnan(valuation.pnl_percent[2]))
+
+    def test_empty(self):
+        valuation = Portfolio.from_positions([]).valuation({})
+        self.assertEqual(valuation.total_value, 0.0)
+        self.assertFalse(valuation.priced.any())
+
+
+class RiskTestCase(unittest.TestCase):
+
+    def test_purchases_are_not_returns(self):
+        values = np.array([0.0, 100.0, 110.0, 210.0, 189.0])
+        invested = np.array([0.0, 100.0, 100.0, 200.0, 200.0])
+        self.assertTrue(np.allclose(daily_returns(values, invested), [0.1, 0.0, -0.1]))
+
+    def test_drawdown_and_volatility(self):
+        values = np.array([100.0, 120.0, 90.0, 99.0])
+        result = risk(values, np.full(4, 100.0))
+        self.assertAlmostEqual(result.total_return, -0.01)
+        self.assertAlmostEqual(result.max_drawdown, -0.25)
+        returns = np.array([0.2, -0.25, 0.1])
+        self.assertAlmostEqual(result.volatility, returns.std(ddof=1) * np.sqrt(252))
+        self.assertIsNone(risk(values[:2], np.full(2, 100.0)))
+
+
+if __name__ == '__main__':
+    unittest.main()
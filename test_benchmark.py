@@ -0,0 +1,54 @@
+import unittest
+from argparse import Namespace
+
+from aiohttp.test_utils import TestClient, TestServer
+
+from benchmark import FakeTelegram, FakeUpstream, check_limits, percentile
+
+
+class FakeServersTestCase(unittest.IsolatedAsyncioTestCase):
+
+    async def test_upstream_speaks_iss_and_cbr(self):
+        upstream = FakeUpstream(tickers=['BM001', 'BM002'])
+        async with TestClient(TestServer(upstream.app())) as client:
+            board = '/iss/engines/stock/markets/shares/boards/TQBR/securities'
+            listing = await (await client.get(f'{board}.json')).json()
+            self.assertEqual([row[0] for row in listing['securities']['data']], ['BM001', 'BM002'])
+            prices = await (await client.get(f'{board}.json', params={'securities': 'BM002,XXXX'})).json()
+            self.assertEqual(prices['securities']['data'], [['BM002', upstream.prices['BM002'], 'SUR']])
+            price = await (await client.get(f'{board}/BM001.json')).json()
+            self.assertEqual(price['securities']['data'], [[upstream.prices['BM001'], 'SUR']])
+            missing = await (await client.get('/iss/securities/XXXX.json')).json()
+            self.assertEqual(missing['boards']['data'], [])
+            rates = await (await client.get('/cbr/daily_json.js')).json()
+            self.assertIn('USD', rates['Valute'])
+        self.assertEqual(upstream.requests['iss_list'], 1)
+
+    async def test_telegram_echoes_messages(self):
+        telegram = FakeTelegram()
+        async with TestClient(TestServer(telegram.app())) as client:
+            response = await client.post('/bot123:abc/sendMessage', data={'chat_id': '42', 'text': 'hi'})
+            body = await response.json()
+        self.assertTrue(body['ok'])
+        self.assertEqual((body['result']['chat']['id'], body['result']['text']), (42, 'hi'))
+        self.assertEqual(telegram.calls['sendMessage'], 1)
+
+
+class ReportTestCase(unittest.TestCase):
+
+    def test_percentile(self):
+        values = [i / 100 for i in range(1, 101)]
+        self.assertEqual(percentile(values, 0.5), 0.51)
+        self.assertEqual(percentile(values, 0.99), 0.99)
+
+    def test_limits(self):
+        result = {'failures': {}, 'updates_per_second': 300.0,
+                  'steps': {'CheckPortfolio': {'p99_ms': 120.0}, 'start': {'p99_ms': 10.0}}}
+        self.assertEqual(check_limits(result, Namespace(max_p99=None, min_throughput=None)), [])
+        problems = check_limits(result, Namespace(max_p99=100, min_throughput=500))
+        self.assertEqual(len(problems), 2)
+        self.assertTrue(problems[0].startswith('CheckPortfolio'))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,121 @@
+import time
+import unittest
+from datetime import date
+from unittest.mock import AsyncMock
+from unittest.mock import patch
+
+import numpy as np
+
+from candles import CandleSeries, CandleStore, download_candles, portfolio_history, sparkline, trading_days
+from test_db_executor import TemporaryDatabase
+
+
+def days(*values):
+    return np.array(values, dtype='datetime64[D]')
+
+
+class CandleSeriesTestCase(unittest.TestCase):
+
+    def test_append_only_newer_days(self):
+        series = CandleSeries(['2024-01-09', '2024-01-10'], [100.0, 101.0])
+        added = series.append(['2024-01-09', '2024-01-10', '2024-01-11'], [1.0, 102.0, 103.0])
+        self.assertEqual(added, 1)
+        # The last stored day is overwritten with the final close
+        self.assertEqual(series.close.tolist(), [100.0, 102.0, 103.0])
+        self.assertEqual(series.last_day, date(2024, 1, 11))
+
+    def test_asof_carries_prices_forward(self):
+        series = CandleSeries(['2024-01-10', '2024-01-12'], [100.0, 110.0])
+        prices = series.asof(days('2024-01-09', '2024-01-10', '2024-01-11', '2024-01-12'))
+        self.assertTrue(np.isnan(prices[0]))
+        self.assertEqual(prices[1:].tolist(), [100.0, 100.0, 110.0])
+        self.assertTrue(np.isnan(CandleSeries().asof(days('2024-01-10'))).all())
+
+
+class PortfolioHistoryTestCase(unittest.TestCase):
+
+    def test_lots_count_from_purchase_day(self):
+        series = {'SBER': CandleSeries(['2024-01-10', '2024-01-11', '2024-01-12'], [100.0, 110.0, 120.0]),
+                  'GAZP': CandleSeries(['2024-01-11', '2024-01-12'], [50.0, 40.0])}
+        lots = [('SBER', 10, 9000, '2023-12-01T10:00:00'),
+                ('SBER', 5, 11000, '2024-01-11T15:30:00'),
+                ('GAZP', 2, 5500, '2024-01-12T12:00:00'),
+                ('GAZP', 7, 5500, '2024-02-01T12:00:00')]
+        axis = trading_days(series.values(), date(2024, 1, 1), date(2024, 1, 31))
+        self.assertEqual(axis.tolist(), days('2024-01-10', '2024-01-11', '2024-01-12').tolist())
+        values, invested = portfolio_history(lots, series, axis)
+        self.assertEqual(values.tolist(), [1000.0, 1650.0, 1880.0])
+        self.assertEqual(invested.tolist(), [900.0, 1450.0, 1560.0])
+        # Streamed lots, one at a time, give the same history
+        values, invested = portfolio_history(iter(lots), series, axis, chunk_size=1)
+        self.assertEqual(values.tolist(), [1000.0, 1650.0, 1880.0])
+        self.assertEqual(invested.tolist(), [900.0, 1450.0, 1560.0])
+        values, invested = portfolio_history(iter([]), series, axis)
+        self.assertEqual((values.tolist(), invested.tolist()), ([0.0] * 3, [0.0] * 3))
+
+    def test_lots_without_date_are_held_from_the_start(self):
+        series = {'SBER': CandleSeries(['2024-01-10', '2024-01-11'], [100.0, 110.0])}
+        axis = days('2024-01-10', '2024-01-11')
+        values, invested = portfolio_history([('SBER', 10, 9000, ''), ('SBER', 1, 11000, '2024-01-11T10:00:00')],
+                                             series, axis)
+        self.assertEqual(values.tolist(), [1000.0, 1210.0])
+        self.assertEqual(invested.tolist(), [900.0, 1010.0])
+
+    def test_hundred_lots_over_a_year(self):
+        axis = np.arange(np.datetime64('2024-01-01'), np.datetime64('2024-12-31'))
+        series = {f'T{i}': CandleSeries(axis, np.linspace(100, 200, len(axis))) for i in range(10)}
+        lots = [(f'T{i % 10}', 1, 10000, str(axis[i * 3]) + 'T10:00:00') for i in range(100)]
+        started = time.perf_counter()
+        values, _ = portfolio_history(lots, series, axis)
+        self.assertLess(time.perf_counter() - started, 0.1)
+        self.assertAlmostEqual(values[-1], 100 * 200.0)
+
+    def test_sparkline(self):
+        self.assertEqual(sparkline(np.array([1.0, 2.0, 3.0])), '▁▅█')
+        self.assertEqual(sparkline(np.array([5.0, 5.0])), '▁▁')
+
+
+class DownloadCandlesTestCase(unittest.IsolatedAsyncioTestCase):
+
+    @patch('candles.ISS_PAGE_SIZE', 2)
+    @patch('market_data.client.get_json', new_callable=AsyncMock)
+    async def test_pages_are_followed(self, mock_get_json):
+        mock_get_json.side_effect = [
+            {'candles': {'data': [['2024-01-10 00:00:00', 100.0], ['2024-01-11 00:00:00', 101.0]]}},
+            {'candles': {'data': [['2024-01-12 00:00:00', 102.0]]}},
+        ]
+        candles = await download_candles('SBER', date(2024, 1, 1), date(2024, 1, 12))
+        self.assertEqual(candles, [('2024-01-10', 100.0), ('2024-01-11', 101.0), ('2024-01-12', 102.0)])
+        self.assertEqual(mock_get_json.await_args.args[1]['start'], '2')
+
+    @patch('market_data.client.get_json', new_callable=AsyncMock, return_value=None)
+    async def test_failure(self, mock_get_json):
+        self.assertIsNone(await download_candles('SBER', date(2024, 1, 1), date(2024, 1, 12)))
+
+
+class CandleStoreTestCase(TemporaryDatabase, unittest.IsolatedAsyncioTestCase):
+
+    def setUp(self) -> None:
+        super().setUp()
+        self.store = CandleStore(self.executor, history_days=30, today=lambda: date(2024, 1, 31))
+
+    @patch('candles.download_candles', new_callable=AsyncMock)
+    async def test_sync_persists_and_tops_up(self, mock_download):
+        mock_download.return_value = [('2024-01-10', 100.0), ('2024-01-11', 101.0)]
+        series = await self.store.sync('sber')
+        mock_download.assert_awaited_once_with('SBER', date(2024, 1, 1), date(2024, 1, 31))
+        self.assertEqual(len(series), 2)
+        # Fresh enough: no second download
+        await self.store.sync('SBER')
+        self.assertEqual(mock_download.await_count, 1)
+
+        # A new process reads the stored candles and only asks for the days after them
+        store = CandleStore(self.executor, history_days=30, today=lambda: date(2024, 1, 31))
+        mock_download.return_value = [('2024-01-11', 101.5), ('2024-01-12', 102.0)]
+        series = await store.sync('SBER')
+        self.assertEqual(mock_download.await_args.args, ('SBER', date(2024, 1, 11), date(2024, 1, 31)))
+        self.assertEqual(series.close.tolist(), [100.0, 101.5, 102.0])
+
+
+if __name__ == '__main__':
+    unittest.main()
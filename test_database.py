@@ -0,0 +1,57 @@
+import unittest
+
+import database
+from test_db_executor import TemporaryDatabase
+
+
+class DatabaseTestCase(TemporaryDatabase, unittest.TestCase):
+
+    def test_connection_is_reused(self):
+        self.assertIs(self.db.connection, self.db.connection)
+
+    def test_connection_uses_wal(self):
+        journal_mode = self.db.connection.execute('PRAGMA journal_mode').fetchone()[0]
+        self.assertEqual(journal_mode, 'wal')
+
+    def test_insert_user_is_idempotent(self):
+        conn = self.db.connection
+        with conn:
+            self.assertEqual(database.insert_user(conn, 42), 42)
+            self.assertIsNone(database.insert_user(conn, 42))
+        self.assertEqual(database.get_user(conn, 42), (42,))
+
+    def test_iter_user_stocks(self):
+        conn = self.db.connection
+        with conn:
+            database.insert_stock(conn, 42, 'SBER', 10, 250.5, '2024-10-10T03:09:21')
+            database.insert_stock(conn, 43, 'GAZP', 5, 130.0, '2024-10-10T03:09:21')
+        self.assertEqual(list(database.iter_user_stocks(conn, 42)), [(42, 'SBER', 10, 250.5, '2024-10-10T03:09:21')])
+
+    def test_select_user_positions(self):
+        conn = self.db.connection
+        with conn:
+            database.insert_stock(conn, 42, 'sber', 10, 250, '2024-10-10T03:09:21')
+            database.insert_stock(conn, 42, 'SBER', 30, '270.0', '2024-10-11T03:09:21')
+            database.insert_stock(conn, 42, 'GAZP', 5, 130.0, '2024-10-10T03:09:21')
+        self.assertEqual(database.select_user_positions(conn, 42),
+                         [('GAZP', 5, 65000, 1), ('SBER', 40, 1060000, 2)])
+        self.assertEqual(database.select_held_tickers(conn), ['GAZP', 'SBER'])
+        database.insert_stock(conn, 43, 'LKOH', 1, 7000, '2024-10-10T03:09:21')
+        # Workers only see the tickers of their own users
+        self.assertEqual(database.select_held_tickers(conn, 0, 2), ['GAZP', 'SBER'])
+        self.assertEqual(database.select_held_tickers(conn, 1, 2), ['LKOH'])
+
+    def test_user_stocks_are_streamed_in_chunks(self):
+        conn = self.db.connection
+        with conn:
+            for quantity in range(1, 6):
+                database.insert_stock(conn, 42, 'SBER', quantity, 250, '2024-10-10T03:09:21')
+            database.insert_stock(conn, 43, 'GAZP', 5, 130.0, '2024-10-10T03:09:21')
+        streamed = database.iter_user_stocks(conn, 42, chunk_size=2)
+        self.assertEqual([row[2] for row in streamed], [1, 2, 3, 4, 5])
+        chunks = database.iter_chunks(database.iter_user_lots(conn, 42, chunk_size=2), 2)
+        self.assertEqual([[row[1] for row in chunk] for chunk in chunks], [[1, 2], [3, 4], [5]])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,54 @@
+import asyncio
+import os
+import tempfile
+import unittest
+
+import database
+from database import Database
+from db_executor import DatabaseExecutor
+
+
+def failing_insert(conn, telegram_id):
+    conn.execute('INSERT INTO users (telegram_id) VALUES (?)', (telegram_id,))
+    raise ValueError('broken write')
+
+
+class TemporaryDatabase:
+    """Test case mixin: a migrated database in a temporary directory and an executor over it."""
+
+    def setUp(self) -> None:
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.db = Database(os.path.join(self.tmp_dir.name, 'test.db'))
+        self.executor = DatabaseExecutor(self.db)
+        # Cleanups run in reverse order: the executor stops before the database closes
+        self.addCleanup(self.tmp_dir.cleanup)
+        self.addCleanup(self.db.close)
+        self.addCleanup(self.executor.stop)
+
+
+class DatabaseExecutorTestCase(TemporaryDatabase, unittest.IsolatedAsyncioTestCase):
+
+    async def test_concurrent_writes_are_committed(self):
+        results = await asyncio.gather(*(self.executor.write(database.insert_user, telegram_id)
+                                         for telegram_id in range(1, 101)))
+        self.assertEqual(results, list(range(1, 101)))
+        count = self.db.connection.execute('SELECT COUNT(*) FROM users').fetchone()[0]
+        self.assertEqual(count, 100)
+
+    async def test_failed_write_does_not_roll_back_others(self):
+        results = await asyncio.gather(self.executor.write(database.insert_user, 1),
+                                       self.executor.write(failing_insert, 2),
+                                       self.executor.write(database.insert_user, 3),
+                                       return_exceptions=True)
+        self.assertEqual(results[0], 1)
+        self.assertIsInstance(results[1], ValueError)
+        self.assertEqual(results[2], 3)
+        self.assertIsNone(await self.executor.read(database.get_user, 2))
+
+    async def test_read_runs_on_reader_thread(self):
+        await self.executor.write(database.insert_user, 42)
+        self.assertEqual(await self.executor.read(database.get_user, 42), (42,))
+
+
+if __name__ == '__main__':
+    unittest.main()
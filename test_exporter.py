@@ -0,0 +1,41 @@
+import io
+import unittest
+
+import database
+from exporter import EXPORT_HEADER, write_export
+from importer import parse_report
+from test_db_executor import TemporaryDatabase
+
+
+class ExportTestCase(TemporaryDatabase, unittest.TestCase):
+
+    def setUp(self) -> None:
+        super().setUp()
+        conn = self.db.connection
+        with conn:
+            database.insert_stock(conn, 42, 'SBER', 10, '250.5', '2024-01-10T10:00:00')
+            database.insert_stock(conn, 42, 'GAZP', 3, 130, '2024-01-11T10:00:00')
+            database.insert_stock(conn, 43, 'LKOH', 1, 7000, '2024-01-11T10:00:00')
+            database.insert_dollar_purchase(conn, 42, '450.98')
+
+    def test_write_export(self):
+        path = write_export(self.db.connection, 42, self.tmp_dir.name)
+        with open(path, encoding='utf-8-sig') as file:
+            lines = file.read().splitlines()
+        self.assertEqual(lines[0], ','.join(EXPORT_HEADER))
+        self.assertEqual(lines[1:3], ['stock,SBER,10,250.50,,2024-01-10T10:00:00',
+                                      'stock,GAZP,3,130.00,,2024-01-11T10:00:00'])
+        self.assertTrue(lines[3].startswith('usd,,,,450.98,'))
+        self.assertEqual(len(lines), 4)
+
+    def test_export_can_be_imported_back(self):
+        path = write_export(self.db.connection, 42, self.tmp_dir.name)
+        with open(path, 'rb') as file:
+            lots, errors = parse_report(io.BytesIO(file.read()), 'portfolio.csv')
+        self.assertEqual(errors, [])
+        self.assertEqual([(lot.stock_id, lot.quantity, lot.unit_price) for lot in lots],
+                         [('SBER', 10, '250.50'), ('GAZP', 3, '130.00')])
+
+
+if __name__ == '__main__':
+    unittest.main()
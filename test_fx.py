@@ -0,0 +1,82 @@
+import unittest
+from datetime import date
+from unittest.mock import AsyncMock, patch
+
+from fx import FxEngine, FxTable, parse_conversion, parse_daily
+from test_db_executor import TemporaryDatabase
+
+
+def daily(day, usd=90.0, eur=99.0, cny=125.0):
+    return {'Date': f'{day}T11:30:00+03:00',
+            'Valute': {'USD': {'CharCode': 'USD', 'Nominal': 1, 'Value': usd},
+                       'EUR': {'CharCode': 'EUR', 'Nominal': 1, 'Value': eur},
+                       'CNY': {'CharCode': 'CNY', 'Nominal': 10, 'Value': cny}}}
+
+
+class FxTableTestCase(unittest.TestCase):
+
+    def test_parse_and_cross(self):
+        table = parse_daily(daily('2024-05-17'))
+        self.assertEqual(table.day, date(2024, 5, 17))
+        self.assertEqual(table.rate('cny'), 12.5)
+        self.assertEqual(table.convert(10, 'USD', 'RUB'), 900.0)
+        self.assertAlmostEqual(table.convert(100, 'EUR', 'CNY'), 792.0)
+        self.assertAlmostEqual(table.cross('EUR', 'USD'), 1.1)
+        self.assertIsNone(table.convert(1, 'USD', 'XXX'))
+        self.assertIsNone(parse_daily(None))
+
+    def test_parse_conversion(self):
+        self.assertEqual(parse_conversion('100 eur cny'), (100.0, 'EUR', 'CNY', None))
+        self.assertEqual(parse_conversion('1,5 USD RUB 2024-05-17'), (1.5, 'USD', 'RUB', date(2024, 5, 17)))
+        self.assertIsNone(parse_conversion('USD RUB'))
+        self.assertIsNone(parse_conversion('-1 USD RUB'))
+        self.assertIsNone(parse_conversion('1 USD RUB yesterday'))
+
+
+class FxEngineTestCase(TemporaryDatabase, unittest.IsolatedAsyncioTestCase):
+
+    def setUp(self) -> None:
+        super().setUp()
+        self.engine = FxEngine(self.executor)
+
+    @patch('market_data.client.get_json', new_callable=AsyncMock)
+    async def test_latest_is_downloaded_once(self, mock_get_json):
+        mock_get_json.return_value = daily('2024-05-17')
+        self.assertAlmostEqual(await self.engine.convert(10, 'USD', 'EUR'), 10 * 90 / 99)
+        self.assertEqual(await self.engine.convert(1, 'CNY', 'RUB'), 12.5)
+        self.assertEqual(mock_get_json.await_count, 1)
+
+        # The CBR is down: the last table is still used
+        mock_get_json.return_value = None
+        table = await self.engine.latest(force=True)
+        self.assertEqual(table.rate('USD'), 90.0)
+
+    @patch('market_data.client.get_json', new_callable=AsyncMock)
+    async def test_history_is_archived(self, mock_get_json):
+        archive = {'2024-05-11': daily('2024-05-11', usd=91.0)}
+        current = daily('2024-05-17')
+
+        async def get_json(url, params=None):
+            if 'archive' not in url:
+                return current
+            return archive.get(url.split('/archive/')[1][:10].replace('/', '-'))
+
+        mock_get_json.side_effect = get_json
+        # Sunday: the Saturday table is in force
+        table = await self.engine.on(date(2024, 5, 12))
+        self.assertEqual((table.day, table.rate('USD')), (date(2024, 5, 12), 91.0))
+        self.assertEqual(await self.engine.on(date(2024, 5, 20)), self.engine.current)
+        costs = await self.engine.purchase_costs([(10000, '2024-05-12T10:00:00'), (500, None)])
+        self.assertEqual(costs, [9100.0, None])
+
+        # Another process finds the rates in the database
+        mock_get_json.reset_mock()
+        engine = FxEngine(self.executor)
+        engine.current = FxTable(date(2024, 5, 17), {'USD': 90.0})
+        table = await engine.on(date(2024, 5, 12))
+        self.assertEqual(table.rate('EUR'), 99.0)
+        mock_get_json.assert_not_awaited()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,105 @@
+import io
+import time
+import unittest
+from datetime import datetime
+from unittest.mock import AsyncMock
+from unittest.mock import patch
+
+import database
+from importer import ImportedLot, RowError, format_report, import_report, parse_report
+from test_db_executor import TemporaryDatabase
+
+
+NOW = datetime(2024, 10, 10, 12, 0)
+
+
+class ParseReportTestCase(unittest.TestCase):
+
+    def test_csv(self):
+        report = ('Тикер;Количество;Цена;Дата\n'
+                  'sber;10;250,5;10.01.2024\n'
+                  '\n'
+                  'GAZP;1.5;130;2024-01-11\n'
+                  'LKOH;2;abc;\n'
+                  'YNDX;3;4000;\n').encode('utf-8-sig')
+        lots, errors = parse_report(io.BytesIO(report), 'report.csv', NOW)
+        self.assertEqual(lots, [ImportedLot(2, 'SBER', 10, '250.5', datetime(2024, 1, 10)),
+                                ImportedLot(6, 'YNDX', 3, '4000', NOW)])
+        self.assertEqual([error.line for error in errors], [4, 5])
+
+    def test_out_of_range_rows(self):
+        report = ('ticker,quantity,price\n'
+                  'SBER,1e30,250\n'
+                  'SBER,10,1e300\n'
+                  'SBER,1000000000,1e10\n'
+                  'SBER,1000000000,250\n').encode()
+        lots, errors = parse_report(io.BytesIO(report), 'report.csv', NOW)
+        self.assertEqual([lot.line for lot in lots], [5])
+        self.assertEqual([error.line for error in errors], [2, 3, 4])
+
+    def test_csv_without_columns(self):
+        lots, errors = parse_report(io.BytesIO(b'a,b,c\n1,2,3\n'), 'report.csv', NOW)
+        self.assertEqual((lots, len(errors)), ([], 1))
+
+    def test_xml(self):
+        report = b'''<?xml version="1.0" encoding="UTF-8"?>
+            <report>
+              <trades>
+                <trade ticker="SBER" quantity="10" price="250.5" date="2024-01-10T10:00:00"/>
+                <trade><ticker>GAZP</ticker><quantity>5</quantity><price>130</price></trade>
+                <trade ticker="LKOH" quantity="-1" price="7000"/>
+              </trades>
+            </report>'''
+        lots, errors = parse_report(io.BytesIO(report), 'REPORT.XML', NOW)
+        self.assertEqual([(lot.stock_id, lot.quantity) for lot in lots], [('SBER', 10), ('GAZP', 5)])
+        self.assertEqual(errors[0].line, 3)
+
+    def test_broken_xml(self):
+        lots, errors = parse_report(io.BytesIO(b'<report><trade ticker="SBER" quantity="1" price="1"/>'),
+                                    'r.xml', NOW)
+        self.assertEqual(len(lots), 1)
+        self.assertEqual(len(errors), 1)
+
+
+class ImportReportTestCase(TemporaryDatabase, unittest.IsolatedAsyncioTestCase):
+
+    def setUp(self) -> None:
+        super().setUp()
+        patcher = patch('importer.db_executor', self.executor)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    @patch('importer.check_stocks_existence', new_callable=AsyncMock)
+    async def test_ten_thousand_rows(self, mock_check):
+        mock_check.return_value = {'SBER', 'GAZP'}
+        rows = ''.join(f'{"SBER" if i % 2 else "GAZP"},{i % 50 + 1},{100 + i % 7}.25,2024-01-10\n'
+                       for i in range(10000))
+        report = ('ticker,quantity,price,date\n' + rows + 'XXXX,1,1,2024-01-10\n').encode()
+
+        started = time.perf_counter()
+        result = await import_report(42, io.BytesIO(report), 'trades.csv')
+        self.assertLess(time.perf_counter() - started, 5)
+
+        # Tickers are validated with one batched call
+        mock_check.assert_awaited_once_with({'SBER', 'GAZP', 'XXXX'})
+        self.assertEqual(result.imported, 10000)
+        self.assertEqual(result.errors, [RowError(10002, 'тикер XXXX не найден на Московской бирже')])
+        positions = database.select_user_positions(self.db.connection, 42)
+        self.assertEqual([(stock_id, lot_count) for stock_id, _, _, lot_count in positions],
+                         [('GAZP', 5000), ('SBER', 5000)])
+        self.assertIn('Импортировано лотов: 10000', format_report(result))
+
+
+    @patch('importer.check_stocks_existence', new_callable=AsyncMock)
+    async def test_write_failure_is_reported(self, mock_check):
+        mock_check.return_value = {'SBER'}
+        report = b'ticker,quantity,price\nSBER,1,250\n'
+        with patch('database.insert_stocks', side_effect=OverflowError('too large')):
+            result = await import_report(42, io.BytesIO(report), 'trades.csv')
+        self.assertEqual((result.imported, result.failure), (0, 'OverflowError: too large'))
+        self.assertIn('портфель не изменен', format_report(result))
+        self.assertEqual(database.select_user_positions(self.db.connection, 42), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,7 +1,7 @@
+import socket
 import sqlite3
 import unittest
-from unittest import mock
-from unittest.mock import MagicMock
+from unittest.mock import AsyncMock, MagicMock
 from unittest.mock import patch
 from main import check_stock_existence
 from main import get_stock_price
@@ -9,6 +9,7 @@ from main import get_current_usd_rub
 from main import convert_rub_to_dol
 import main as bot
 from typing import List, Tuple, Text
+from datetime import datetime
 
 
 # Class Test for User Class
@@ -17,10 +18,10 @@ class UserTestCase(unittest.TestCase):
     create_telegram_id = 4444444
 
     def setUp(self) -> None:
+        # Opening the bot's connection applies the schema migrations
+        bot.db.connection
         conn = sqlite3.connect('./app_data/database.db')
         cursor = conn.cursor()
-        cursor.execute('CREATE TABLE IF NOT EXISTS users '
-                       '(telegram_id INTEGER PRIMARY KEY)')
         cursor.execute('INSERT INTO users (telegram_id) VALUES (?)',
                        (self.check_telegram_id,))
         conn.commit()
@@ -54,16 +55,15 @@ class StockTestCase(unittest.TestCase):
 
     create_stock = bot.Stock(create_telegram_id, 'SBER', 100, 10, '2024-10-10 03:09:21.123454')
 
-    test_stock_values = (check_telegram_id, 'SBER', 100, 10, '2024-10-10 03:09:21.123454')
+    test_stock_values = (check_telegram_id, 'SBER', 100, 1000, '2024-10-10T03:09:21.123454')
 
     def setUp(self) -> None:
+        bot.db.connection
         conn = sqlite3.connect('./app_data/database.db')
         cursor = conn.cursor()
-        cursor.execute('''CREATE TABLE IF NOT EXISTS users (telegram_id INTEGER PRIMARY KEY)''')
-        cursor.execute('''CREATE TABLE IF NOT EXISTS stocks
-                          (owner_id INTEGER, stock_id TEXT, quantity INTEGER, unit_price REAL, purchase_date TIMESTAMP, FOREIGN KEY (owner_id) REFERENCES users(telegram_id) ON DELETE CASCADE)''')
         cursor.execute('INSERT INTO users (telegram_id) VALUES (?)', (self.check_telegram_id,))
-        cursor.execute('INSERT INTO stocks VALUES (?, ?, ?, ?, ?)', self.test_stock_values)
+        cursor.execute('INSERT INTO stocks (owner_id, stock_id, quantity, unit_price_minor, purchase_date) '
+                       'VALUES (?, ?, ?, ?, ?)', self.test_stock_values)
         conn.commit()
         conn.close()
 
@@ -90,6 +90,31 @@ class StockTestCase(unittest.TestCase):
     def test_get_user_stocks(self):
         result = bot.Stock.get_user_stocks(self.check_telegram_id)
         self.assertIsNotNone(result)
+        self.assertEqual(result[0].unit_price, 10)
+
+    def test_stored_fields_round_trip(self):
+        stock = bot.Stock.get_user_stocks(self.check_telegram_id)[0]
+        self.assertEqual(stock.purchase_date, datetime(2024, 10, 10, 3, 9, 21, 123454))
+        self.assertEqual(stock, bot.Stock(self.check_telegram_id, 'SBER', 100, 10.0, '2024-10-10T03:09:21.123454'))
+        self.assertFalse(hasattr(stock, '__dict__'))
+
+    def test_lot_without_date(self):
+        # Migration 2 left '' in purchase_date of the lots saved by the first bot versions
+        stock = bot.Stock(self.check_telegram_id, 'SBER', 100, 10.0, '')
+        self.assertIsNone(stock.purchase_date)
+        self.assertEqual(repr(stock), f"Stock({self.check_telegram_id}, 'SBER', 100, 10.0, '')")
+
+    def test_iter_user_stocks(self):
+        bot.Stock(self.check_telegram_id, 'GAZP', 5, 130, '2024-10-11T10:00:00').add_stock()
+        bot.Stock(self.check_telegram_id, 'LKOH', 1, 7000, '2024-10-12T10:00:00').add_stock()
+        streamed = list(bot.Stock.iter_user_stocks(self.check_telegram_id, chunk_size=2))
+        self.assertEqual([stock.stock_id for stock in streamed], ['SBER', 'GAZP', 'LKOH'])
+
+    def test_get_user_positions(self):
+        result = bot.Position.get_user_positions(self.check_telegram_id)
+        self.assertEqual(len(result), 1)
+        self.assertEqual((result[0].stock_id, result[0].quantity, result[0].lot_count), ('SBER', 100, 1))
+        self.assertEqual(result[0].average_price, 10)
 
 
 # class Test for Currency class
@@ -98,14 +123,12 @@ class CurrencyTestClass(unittest.TestCase):
     dollar_transaction: float = 450.98
 
     def setUp(self) -> None:
+        bot.db.connection
         conn = sqlite3.connect('./app_data/database.db')
         cursor = conn.cursor()
-        cursor.execute('''CREATE TABLE IF NOT EXISTS currency (
-                          owner_id INTEGER,
-                          dollar_purchase REAL,
-                          FOREIGN KEY (owner_id) REFERENCES users(telegram_id) ON DELETE CASCADE)  
-                      ''')
-        cursor.execute('INSERT INTO currency VALUES (?, ?)', (self.create_telegram_id, self.dollar_transaction))
+        cursor.execute('INSERT OR IGNORE INTO users (telegram_id) VALUES (?)', (self.create_telegram_id,))
+        cursor.execute('INSERT INTO currency (owner_id, amount_minor) VALUES (?, ?)',
+                       (self.create_telegram_id, round(self.dollar_transaction * 100)))
         conn.commit()
         conn.close()
 
@@ -114,8 +137,8 @@ class CurrencyTestClass(unittest.TestCase):
         cursor = conn.cursor()
         cursor.execute('DELETE FROM currency WHERE owner_id = ?',
                        (self.create_telegram_id,))
-        cursor.execute('DELETE FROM currency WHERE dollar_purchase = ?',
-                       (self.dollar_transaction,))
+        cursor.execute('DELETE FROM users WHERE telegram_id = ?',
+                       (self.create_telegram_id,))
         conn.commit()
         conn.close()
 
@@ -125,66 +148,125 @@ class CurrencyTestClass(unittest.TestCase):
         self.assertIsInstance(result, int)
 
 
-class TestFunctions(unittest.TestCase):
+class HandlerMetricsTestCase(unittest.TestCase):
+
+    def test_every_handler_is_timed_under_its_own_name(self):
+        names = []
+        for router in (bot.dp, bot.router):
+            for event_name in ('message', 'callback_query', 'inline_query'):
+                names.extend(handler.callback.__name__ for handler in router.observers[event_name].handlers)
+        self.assertEqual(len(names), len(set(names)))
+        # Inner middlewares of the dispatcher also wrap the handlers of included routers
+        for event_name in ('message', 'callback_query', 'inline_query'):
+            self.assertTrue(any(isinstance(middleware, bot.HandlerMetricsMiddleware)
+                                for middleware in bot.dp.observers[event_name].middleware))
+
+
+# TestFunctions talks to the real services; offline (e.g. in a sandboxed CI runner) it is skipped
+UPSTREAM_HOSTS = ('iss.moex.com', 'www.cbr-xml-daily.ru')
+
+
+def upstreams_reachable() -> bool:
+    try:
+        for host in UPSTREAM_HOSTS:
+            socket.create_connection((host, 443), timeout=3).close()
+    except OSError:
+        return False
+    return True
+
 
-    def set_up(self) -> None:
-        pass
+class TestFunctions(unittest.IsolatedAsyncioTestCase):
 
-    def test_check_stock_existence(self):
+    @classmethod
+    def setUpClass(cls) -> None:
+        if not upstreams_reachable():
+            raise unittest.SkipTest('MOEX ISS or CBR is unreachable')
+
+    async def asyncTearDown(self) -> None:
+        await bot.market_data.client.close()
+
+    async def test_check_stock_existence(self):
         ticker_name = 'SBER'
         expected = True
-        actual = check_stock_existence(ticker_name)
+        actual = await check_stock_existence(ticker_name)
         self.assertEqual(expected, actual)
         # --------------------------------
         ticker_name = 'GTTUGI'
         expected = False
-        actual = check_stock_existence(ticker_name)
+        actual = await check_stock_existence(ticker_name)
         self.assertEqual(expected, actual)
 
-    def test_get_stock_price(self):
-        result: Tuple[float, str] = get_stock_price('SBER')
+    async def test_get_stock_price(self):
+        result: Tuple[float, str] = await get_stock_price('SBER')
         expected = True
         actual = isinstance(result[0], float) and isinstance(result[1], str)
         self.assertEqual(expected, actual)
 
-        result: Tuple[float, str] = get_stock_price('GHGYFTVK')
+        result: Tuple[float, str] = await get_stock_price('GHGYFTVK')
         expected = True
         actual = result[0] is None and result[1] is None
         self.assertEqual(expected, actual)
 
-    def test_get_current_usd_rub(self):
-        result: float = get_current_usd_rub()
+    async def test_get_current_usd_rub(self):
+        result: float = await get_current_usd_rub()
         self.assertIsInstance(result, float)
 
-    def test_convert_rub_to_dol(self):
+    async def test_convert_rub_to_dol(self):
         amount_in_rubles = 15000
-        result: float = convert_rub_to_dol(amount_in_rubles)
+        result: float = await convert_rub_to_dol(amount_in_rubles)
         self.assertIsInstance(result, float)
 
 
-class CheckStockExistence(unittest.TestCase):
+class CheckStockExistence(unittest.IsolatedAsyncioTestCase):
     test_stock_id = 'GAZP'
     test_url = f'https://iss.moex.com/iss/securities/{test_stock_id}.json'
     test_response = {'boards': {'data': [['GAZP']]}}
 
-    @patch('main.requests')
-    def test_check_stock_existence(self, mock_requests):
-        mock_response = MagicMock()
-        mock_response.status_code = 200
-        mock_response.json.return_value = self.test_response
-
-        mock_response_fail = mock.Mock()
-        mock_response_fail.status_code = 404
-        mock_response_fail.json.return_value = None
-
-        mock_requests.get.return_value = mock_response
-        result_success = check_stock_existence(self.test_stock_id)
+    def setUp(self) -> None:
+        bot.security_index.clear()
+        bot.market_data.quote_cache.clear()
+
+    @patch('market_data.client.get_json', new_callable=AsyncMock)
+    async def test_check_stock_existence(self, mock_get_json):
+        # get_json returns the decoded body on 200 and None on any failure
+        mock_get_json.return_value = self.test_response
+        result_success = await check_stock_existence(self.test_stock_id)
         self.assertTrue(result_success)
+        mock_get_json.assert_awaited_with(self.test_url)
 
-        mock_requests.get.return_value = mock_response_fail
-        fail_success = check_stock_existence(self.test_stock_id)
+        # Forget the ticker confirmed above, otherwise it is answered from the local index
+        bot.security_index.clear()
+        bot.market_data.quote_cache.clear()
+        mock_get_json.return_value = None
+        fail_success = await check_stock_existence(self.test_stock_id)
         self.assertFalse(fail_success)
 
+    @patch('market_data.client.get_json', new_callable=AsyncMock)
+    async def test_known_ticker_is_answered_locally(self, mock_get_json):
+        bot.security_index.load([('GAZP', 'ГАЗПРОМ ао')])
+        self.assertTrue(await check_stock_existence('gazp'))
+        mock_get_json.assert_not_awaited()
+
+
+class HistoryCommandTestCase(unittest.IsolatedAsyncioTestCase):
+
+    @patch('main.db_executor.read', new_callable=AsyncMock)
+    async def test_period_out_of_range(self, mock_read):
+        for args in ('800000', '0', 'abc', '²'):
+            message = MagicMock()
+            message.reply = AsyncMock()
+            await bot.portfolio_history_command(message, bot.CommandObject(command='history', args=args))
+            self.assertIn('Период', message.reply.await_args.args[0])
+        mock_read.assert_not_awaited()
+
+
+class MiddlewareOrderTestCase(unittest.TestCase):
+
+    def test_fsm_state_is_read_inside_the_user_queue(self):
+        # FSMContextMiddleware reads raw_state, so it has to run after the per-user lock is taken
+        middlewares = bot.dp.update.outer_middleware
+        self.assertLess(middlewares.index(bot.throttling), middlewares.index(bot.dp.fsm))
+
 
 
 
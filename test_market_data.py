@@ -0,0 +1,119 @@
+import unittest
+from unittest.mock import AsyncMock
+from unittest.mock import patch
+
+from aiohttp import web
+from aiohttp.test_utils import TestServer
+
+import market_data
+from market_data import MarketDataClient
+
+
+class MarketDataClientTestCase(unittest.IsolatedAsyncioTestCase):
+
+    async def asyncSetUp(self) -> None:
+        self.calls = 0
+        app = web.Application()
+        app.router.add_get('/flaky', self.flaky)
+        app.router.add_get('/missing', self.missing)
+        app.router.add_get('/rates', self.rates)
+        self.server = TestServer(app)
+        await self.server.start_server()
+        self.client = MarketDataClient(retries=2, backoff=0)
+
+    async def asyncTearDown(self) -> None:
+        await self.client.close()
+        await self.server.close()
+
+    async def flaky(self, request):
+        self.calls += 1
+        if self.calls < 3:
+            return web.Response(status=503)
+        return web.json_response({'ok': True})
+
+    async def missing(self, request):
+        self.calls += 1
+        return web.Response(status=404)
+
+    async def rates(self, request):
+        return web.Response(text='{"Valute": {"USD": {"Value": 95.5}}}',
+                            content_type='application/javascript')
+
+    async def test_retries_unavailable_upstream(self):
+        result = await self.client.get_json(str(self.server.make_url('/flaky')))
+        self.assertEqual(result, {'ok': True})
+        self.assertEqual(self.calls, 3)
+
+    async def test_does_not_retry_client_errors(self):
+        result = await self.client.get_json(str(self.server.make_url('/missing')))
+        self.assertIsNone(result)
+        self.assertEqual(self.calls, 1)
+
+    async def test_decodes_javascript_content_type(self):
+        result = await self.client.get_json(str(self.server.make_url('/rates')))
+        self.assertEqual(result['Valute']['USD']['Value'], 95.5)
+
+    async def test_reuses_session(self):
+        session = self.client.session
+        await self.client.get_json(str(self.server.make_url('/rates')))
+        self.assertIs(self.client.session, session)
+
+
+class GetStockPricesTestCase(unittest.IsolatedAsyncioTestCase):
+    test_response = {'securities': {'columns': ['SECID', 'PREVPRICE', 'CURRENCYID'],
+                                    'data': [['SBER', 255.5, 'SUR'], ['GAZP', 136.1, 'SUR']]}}
+
+    def setUp(self) -> None:
+        market_data.quote_cache.clear()
+
+    @patch('market_data.client.get_json', new_callable=AsyncMock)
+    async def test_dedupes_tickers_into_one_request(self, mock_get_json):
+        mock_get_json.return_value = self.test_response
+        result = await market_data.get_stock_prices(['SBER', 'gazp', 'SBER', 'NOSUCH'])
+        self.assertEqual(mock_get_json.await_count, 1)
+        params = mock_get_json.await_args.args[1]
+        self.assertEqual(params['securities'], 'SBER,GAZP,NOSUCH')
+        self.assertEqual(result, {'SBER': (255.5, 'RUB'), 'GAZP': (136.1, 'RUB'), 'NOSUCH': (None, None)})
+
+    @patch('market_data.QUOTES_CHUNK_SIZE', 2)
+    @patch('market_data.client.get_json', new_callable=AsyncMock)
+    async def test_splits_large_portfolios_into_chunks(self, mock_get_json):
+        mock_get_json.return_value = self.test_response
+        await market_data.get_stock_prices(['SBER', 'GAZP', 'LKOH', 'YNDX', 'MGNT'])
+        self.assertEqual(mock_get_json.await_count, 3)
+
+    @patch('market_data.client.get_json', new_callable=AsyncMock)
+    async def test_serves_repeated_requests_from_cache(self, mock_get_json):
+        mock_get_json.return_value = self.test_response
+        await market_data.get_stock_prices(['SBER', 'GAZP'])
+        result = await market_data.get_stock_price('sber')
+        self.assertEqual(result, (255.5, 'RUB'))
+        self.assertEqual(mock_get_json.await_count, 1)
+
+
+
+class GetLastPricesTestCase(unittest.IsolatedAsyncioTestCase):
+    test_response = {'securities': {'columns': ['SECID', 'PREVPRICE', 'CURRENCYID'],
+                                    'data': [['SBER', 255.5, 'SUR'], ['GAZP', 136.1, 'SUR']]},
+                     'marketdata': {'columns': ['SECID', 'LAST'], 'data': [['SBER', 258.2], ['GAZP', None]]}}
+
+    def setUp(self) -> None:
+        market_data.quote_cache.clear()
+
+    @patch('market_data.client.get_json', new_callable=AsyncMock)
+    async def test_last_trade_with_previous_close_fallback(self, mock_get_json):
+        mock_get_json.return_value = self.test_response
+        result = await market_data.fetch_last_prices(['SBER', 'gazp', 'NOSUCH'])
+        self.assertEqual(mock_get_json.await_count, 1)
+        params = mock_get_json.await_args.args[1]
+        self.assertEqual(params['marketdata.columns'], 'SECID,LAST')
+        # GAZP has not traded yet in this session
+        self.assertEqual(result, {'SBER': (258.2, 'RUB'), 'GAZP': (136.1, 'RUB'), 'NOSUCH': (None, None)})
+        # Intraday prices are cached apart from the previous close
+        self.assertEqual(await market_data.get_last_price('sber'), (258.2, 'RUB'))
+        self.assertEqual(mock_get_json.await_count, 1)
+        self.assertIsNone(market_data.quote_cache.get(('price', 'SBER')))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,88 @@
+import json
+import logging
+import unittest
+from unittest.mock import AsyncMock, MagicMock
+
+from aiohttp.test_utils import TestClient, TestServer
+from aiohttp import web
+from aiogram.methods import SendMessage
+
+import metrics
+from metrics import HandlerMetricsMiddleware, JsonFormatter, Registry, TelegramMetricsMiddleware
+
+
+class RegistryTestCase(unittest.IsolatedAsyncioTestCase):
+
+    def test_render(self):
+        registry = Registry()
+        registry.observe('handler_seconds', 0.003, handler='check_portfolio')
+        registry.observe('handler_seconds', 0.2, handler='check_portfolio')
+        registry.inc('upstream_errors_total', upstream='iss', error=503)
+        registry.gauge('quote_cache', lambda: {'hits': 7}, label='stat')
+        text = registry.render()
+        self.assertIn('upstream_errors_total{error="503",upstream="iss"} 1', text)
+        self.assertIn('quote_cache{stat="hits"} 7', text)
+        self.assertIn('handler_seconds_bucket{handler="check_portfolio",le="0.005"} 1', text)
+        self.assertIn('handler_seconds_bucket{handler="check_portfolio",le="+Inf"} 2', text)
+        self.assertIn('handler_seconds_count{handler="check_portfolio"} 2', text)
+
+    async def test_timed(self):
+        registry = Registry()
+
+        @registry.timed('model_seconds')
+        async def load():
+            return 42
+
+        self.assertEqual(await load(), 42)
+        histogram, = registry.histograms['model_seconds'].values()
+        self.assertEqual(histogram.count, 1)
+        self.assertIn(('function', 'RegistryTestCase.test_timed.<locals>.load'),
+                      next(iter(registry.histograms['model_seconds'])))
+
+
+class MiddlewareTestCase(unittest.IsolatedAsyncioTestCase):
+
+    def setUp(self) -> None:
+        self.registry = Registry()
+        metrics.registry, self.saved = self.registry, metrics.registry
+
+    def tearDown(self) -> None:
+        metrics.registry = self.saved
+
+    async def test_handler_failure_is_counted(self):
+        async def check_portfolio(event, data):
+            raise ValueError('boom')
+
+        handler = MagicMock()
+        handler.callback.__name__ = 'check_portfolio'
+        with self.assertRaises(ValueError):
+            await HandlerMetricsMiddleware()(check_portfolio, MagicMock(), {'handler': handler})
+        self.assertEqual(self.registry.counters['handler_errors_total'],
+                         {(('error', 'ValueError'), ('handler', 'check_portfolio')): 1})
+        self.assertEqual(self.registry.histograms['handler_seconds'][(('handler', 'check_portfolio'),)].count, 1)
+
+    async def test_telegram_requests_are_timed(self):
+        make_request = AsyncMock(return_value='ok')
+        await TelegramMetricsMiddleware()(make_request, MagicMock(), SendMessage(chat_id=1, text='hi'))
+        self.assertIn((('method', 'SendMessage'),), self.registry.histograms['telegram_request_seconds'])
+
+    async def test_endpoint(self):
+        self.registry.inc('upstream_errors_total', upstream='cbr', error='TimeoutError')
+        app = web.Application()
+        app.router.add_get('/metrics', metrics.handle_metrics)
+        async with TestClient(TestServer(app)) as client:
+            response = await client.get('/metrics')
+            self.assertEqual(response.status, 200)
+            self.assertIn('upstream_errors_total{error="TimeoutError",upstream="cbr"} 1', await response.text())
+
+
+class JsonFormatterTestCase(unittest.TestCase):
+
+    def test_format(self):
+        record = logging.LogRecord('market_data', logging.WARNING, __file__, 1, 'GET %s failed', ('url',), None)
+        entry = json.loads(JsonFormatter().format(record))
+        self.assertEqual((entry['level'], entry['logger'], entry['message']), ('WARNING', 'market_data', 'GET url failed'))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,75 @@
+import os
+import sqlite3
+import tempfile
+import unittest
+
+from migrations import MIGRATIONS, migrate, schema_version
+
+
+class MigrationsTestCase(unittest.TestCase):
+
+    def setUp(self) -> None:
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.conn = sqlite3.connect(os.path.join(self.tmp_dir.name, 'test.db'))
+
+    def tearDown(self) -> None:
+        self.conn.close()
+        self.tmp_dir.cleanup()
+
+    def create_legacy_database(self):
+        # Tables as the first versions of the bot created them, with a stray currency file owner
+        self.conn.executescript('''
+            CREATE TABLE users (telegram_id INTEGER PRIMARY KEY);
+            CREATE TABLE stocks (owner_id INTEGER, stock_id TEXT, quantity INTEGER, unit_price REAL,
+                                 purchase_date TIMESTAMP);
+            CREATE TABLE currency (owner_id INTEGER, dollar_purchase REAL);
+            INSERT INTO users VALUES (1);
+            INSERT INTO stocks VALUES (1, 'sber', 15, '255.42', '2024-10-23 21:36:42.590344');
+            INSERT INTO currency VALUES (2, 792.65);
+        ''')
+
+    def test_fresh_database_gets_latest_schema(self):
+        self.assertEqual(migrate(self.conn), MIGRATIONS[-1][0])
+        self.assertEqual(schema_version(self.conn), MIGRATIONS[-1][0])
+
+    def test_legacy_data_is_converted(self):
+        self.create_legacy_database()
+        migrate(self.conn)
+        stock = self.conn.execute('SELECT owner_id, stock_id, quantity, unit_price_minor, purchase_date '
+                                  'FROM stocks').fetchone()
+        self.assertEqual(stock, (1, 'SBER', 15, 25542, '2024-10-23T21:36:42.590344'))
+        self.assertEqual(self.conn.execute('SELECT owner_id, amount_minor FROM currency').fetchone(), (2, 79265))
+        # Owners missing from users are created, so the foreign keys hold
+        self.assertEqual(self.conn.execute('PRAGMA foreign_key_check').fetchall(), [])
+
+    def test_migrate_is_idempotent(self):
+        migrate(self.conn)
+        self.assertEqual(migrate(self.conn), MIGRATIONS[-1][0])
+
+    def test_owner_lookups_use_index(self):
+        migrate(self.conn)
+        for table in ('stocks', 'currency'):
+            plan = self.conn.execute(f'EXPLAIN QUERY PLAN SELECT * FROM {table} WHERE owner_id = ?', (1,)).fetchall()
+            self.assertIn('USING INDEX', plan[0][-1])
+
+    def test_positions_follow_stock_lots(self):
+        self.create_legacy_database()
+        migrate(self.conn)
+        # The legacy lot is aggregated by the migration, new lots by the triggers
+        self.conn.execute('INSERT INTO stocks (owner_id, stock_id, quantity, unit_price_minor, purchase_date) '
+                          "VALUES (1, 'SBER', 5, 26000, '2024-10-24T10:00:00')")
+        position = self.conn.execute("SELECT quantity, cost_minor, lot_count FROM positions "
+                                     "WHERE owner_id = 1 AND stock_id = 'SBER'").fetchone()
+        self.assertEqual(position, (20, 15 * 25542 + 5 * 26000, 2))
+
+        self.conn.execute("DELETE FROM stocks WHERE owner_id = 1 AND quantity = 15")
+        position = self.conn.execute("SELECT quantity, cost_minor, lot_count FROM positions "
+                                     "WHERE owner_id = 1 AND stock_id = 'SBER'").fetchone()
+        self.assertEqual(position, (5, 5 * 26000, 1))
+
+        self.conn.execute("DELETE FROM stocks WHERE owner_id = 1")
+        self.assertEqual(self.conn.execute('SELECT COUNT(*) FROM positions').fetchone()[0], 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,110 @@
+import asyncio
+import unittest
+from unittest.mock import AsyncMock, MagicMock
+
+from aiogram.exceptions import TelegramRetryAfter
+from aiogram.methods import GetUpdates, SendMessage
+
+import outbox
+from outbox import BULK, INTERACTIVE, Outbox, OutboxMetrics, RateLimiter, RateLimitMiddleware, TokenBucket
+
+
+class TokenBucketTestCase(unittest.TestCase):
+
+    def test_refills_at_rate_up_to_capacity(self):
+        bucket = TokenBucket(rate=2, capacity=3, now=0)
+        for _ in range(3):
+            self.assertEqual(bucket.wait_time(0), 0)
+            bucket.take()
+        self.assertAlmostEqual(bucket.wait_time(0), 0.5)
+        self.assertEqual(bucket.wait_time(0.5), 0)
+        bucket.wait_time(100)
+        self.assertEqual(bucket.tokens, 3)
+
+
+class RateLimiterTestCase(unittest.IsolatedAsyncioTestCase):
+
+    async def test_chat_burst_then_paced(self):
+        limiter = RateLimiter(global_rate=1000, chat_rate=20, chat_burst=2)
+        waited = [await limiter.acquire(1) for _ in range(3)]
+        self.assertLess(max(waited[:2]), 0.01)
+        self.assertGreater(waited[2], 0.02)
+        # Другой чат не ждет
+        self.assertLess(await limiter.acquire(2), 0.01)
+
+    async def test_pause_delays_everyone(self):
+        limiter = RateLimiter(global_rate=1000, chat_rate=1000, chat_burst=10)
+        limiter.pause(0.05)
+        self.assertGreaterEqual(await limiter.acquire(1), 0.04)
+
+    async def test_interactive_goes_first(self):
+        limiter = RateLimiter(global_rate=20, chat_rate=1000, chat_burst=1000)
+        limiter.global_bucket.tokens = 0
+        order = []
+
+        async def send(lane, name):
+            await limiter.acquire(name, lane)
+            order.append(name)
+
+        bulk = [asyncio.create_task(send(BULK, f'bulk{i}')) for i in range(3)]
+        await asyncio.sleep(0)
+        await send(INTERACTIVE, 'reply')
+        await asyncio.gather(*bulk)
+        self.assertEqual(order[0], 'reply')
+
+
+class RateLimitMiddlewareTestCase(unittest.IsolatedAsyncioTestCase):
+
+    def setUp(self):
+        self.limiter = RateLimiter(global_rate=1000, chat_rate=1000, chat_burst=1000)
+        self.metrics = OutboxMetrics()
+        self.middleware = RateLimitMiddleware(self.limiter, self.metrics, max_retries=2)
+        self.method = SendMessage(chat_id=1, text='hi')
+
+    async def test_retry_after_pauses_and_repeats(self):
+        make_request = AsyncMock(side_effect=[TelegramRetryAfter(self.method, 'Flood', 0), 'ok'])
+        self.assertEqual(await self.middleware(make_request, MagicMock(), self.method), 'ok')
+        self.assertEqual(make_request.await_count, 2)
+        self.assertEqual(self.metrics.retried, 1)
+        self.assertEqual(self.metrics.sent[INTERACTIVE], 1)
+
+    async def test_gives_up_after_max_retries(self):
+        make_request = AsyncMock(side_effect=TelegramRetryAfter(self.method, 'Flood', 0))
+        with self.assertRaises(TelegramRetryAfter):
+            await self.middleware(make_request, MagicMock(), self.method)
+        self.assertEqual(make_request.await_count, 3)
+        self.assertEqual(self.metrics.failed, 1)
+
+    async def test_requests_without_chat_pass_through(self):
+        make_request = AsyncMock(return_value=[])
+        await self.middleware(make_request, MagicMock(), GetUpdates())
+        self.assertEqual(self.limiter.chat_buckets, {})
+        self.assertEqual(self.metrics.sent, {INTERACTIVE: 0, BULK: 0})
+
+
+class OutboxTestCase(unittest.IsolatedAsyncioTestCase):
+
+    async def test_messages_are_sent_in_bulk_lane(self):
+        lanes = []
+
+        async def send_message(chat_id, text, **kwargs):
+            lanes.append((chat_id, text, outbox._priority.get()))
+
+        async def edit_message_text(chat_id, message_id, text, **kwargs):
+            lanes.append((chat_id, message_id, text, outbox._priority.get()))
+
+        bot = MagicMock()
+        bot.send_message = send_message
+        bot.edit_message_text = edit_message_text
+        box = Outbox(workers=2)
+        box.start(bot)
+        await box.send(1, 'a')
+        box.submit(2, 'b')
+        await box.edit(3, 30, 'c')
+        await box.stop()
+        self.assertCountEqual(lanes, [(1, 'a', BULK), (2, 'b', BULK), (3, 30, 'c', BULK)])
+        self.assertEqual(box.pending, 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
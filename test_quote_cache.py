@@ -0,0 +1,99 @@
+import asyncio
+import unittest
+
+from quote_cache import QuoteCache
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+class QuoteCacheTestCase(unittest.IsolatedAsyncioTestCase):
+
+    def setUp(self) -> None:
+        self.clock = FakeClock()
+        self.cache = QuoteCache(maxsize=2, clock=self.clock)
+        self.calls = 0
+
+    async def fetch(self):
+        self.calls += 1
+        await asyncio.sleep(0.01)
+        return 255.5
+
+    async def test_entries_expire_after_ttl(self):
+        self.cache.set('SBER', 255.5, ttl=10)
+        self.clock.now = 9
+        self.assertEqual(self.cache.get('SBER'), 255.5)
+        self.clock.now = 10
+        self.assertIsNone(self.cache.get('SBER'))
+
+    async def test_evicts_least_recently_used(self):
+        self.cache.set('SBER', 1, ttl=10)
+        self.cache.set('GAZP', 2, ttl=10)
+        self.cache.get('SBER')
+        self.cache.set('LKOH', 3, ttl=10)
+        self.assertIsNone(self.cache.get('GAZP'))
+        self.assertEqual(self.cache.get('SBER'), 1)
+        self.assertEqual(self.cache.stats()['evictions'], 1)
+
+    async def test_concurrent_requests_share_one_fetch(self):
+        results = await asyncio.gather(*(self.cache.get_or_fetch('SBER', self.fetch, ttl=10) for _ in range(500)))
+        self.assertEqual(set(results), {255.5})
+        self.assertEqual(self.calls, 1)
+        stats = self.cache.stats()
+        self.assertEqual((stats['misses'], stats['coalesced']), (1, 499))
+
+        await self.cache.get_or_fetch('SBER', self.fetch, ttl=10)
+        self.assertEqual(self.cache.stats()['hits'], 1)
+
+    async def test_failed_fetch_is_not_cached(self):
+        async def failing():
+            raise RuntimeError('upstream is down')
+
+        with self.assertRaises(RuntimeError):
+            await self.cache.get_or_fetch('SBER', failing, ttl=10)
+        self.assertEqual(await self.cache.get_or_fetch('SBER', self.fetch, ttl=10), 255.5)
+
+    async def test_cancelled_caller_does_not_cancel_the_others(self):
+        first = asyncio.create_task(self.cache.get_or_fetch('SBER', self.fetch, ttl=10))
+        await asyncio.sleep(0)
+        second = asyncio.create_task(self.cache.get_or_fetch('SBER', self.fetch, ttl=10))
+        await asyncio.sleep(0)
+        # The caller that started the fetch goes away, e.g. on a timeout
+        first.cancel()
+        self.assertEqual(await second, 255.5)
+        self.assertTrue(first.cancelled())
+        self.assertEqual(self.calls, 1)
+        self.assertEqual(self.cache.get('SBER'), 255.5)
+
+        async def fetch_many(keys):
+            await asyncio.sleep(0.01)
+            return {key: key.lower() for key in keys}
+
+        first = asyncio.create_task(self.cache.get_many_or_fetch(['GAZP', 'LKOH'], fetch_many, ttl=10))
+        await asyncio.sleep(0)
+        second = asyncio.create_task(self.cache.get_or_fetch('LKOH', self.fetch, ttl=10))
+        await asyncio.sleep(0)
+        first.cancel()
+        self.assertEqual(await second, 'lkoh')
+        self.assertEqual(self.calls, 1)
+
+    async def test_batch_fetches_only_missing_keys(self):
+        requested = []
+
+        async def fetch_many(keys):
+            requested.append(keys)
+            return {key: key.lower() for key in keys}
+
+        self.cache.set('SBER', 'cached', ttl=10)
+        result = await self.cache.get_many_or_fetch(['SBER', 'GAZP', 'GAZP'], fetch_many, ttl=10)
+        self.assertEqual(result, {'SBER': 'cached', 'GAZP': 'gazp'})
+        self.assertEqual(requested, [['GAZP']])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,100 @@
+import time
+import unittest
+from datetime import date, datetime, timezone
+from unittest.mock import AsyncMock, MagicMock
+from unittest.mock import patch
+
+from fx import FxTable
+from refresher import MarketSnapshot, Quote, QuoteRefresher, is_trading_time
+from watch import WatchHub
+
+
+class IsTradingTimeTestCase(unittest.TestCase):
+
+    def test_trading_hours(self):
+        # 12:00 MSK on a Wednesday
+        self.assertTrue(is_trading_time(datetime(2024, 10, 23, 9, 0, tzinfo=timezone.utc)))
+        # 03:00 MSK on a Wednesday
+        self.assertFalse(is_trading_time(datetime(2024, 10, 23, 0, 0, tzinfo=timezone.utc)))
+        # Saturday
+        self.assertFalse(is_trading_time(datetime(2024, 10, 26, 9, 0, tzinfo=timezone.utc)))
+
+
+class MarketSnapshotTestCase(unittest.IsolatedAsyncioTestCase):
+
+    @patch('market_data.get_stock_prices', new_callable=AsyncMock)
+    async def test_only_missing_tickers_are_fetched(self, mock_get_stock_prices):
+        snapshot = MarketSnapshot()
+        snapshot.update({'SBER': (255.5, 'RUB')})
+        mock_get_stock_prices.return_value = {'GAZP': (136.1, 'RUB')}
+        quotes = await snapshot.get_quotes(['sber', 'GAZP'])
+        mock_get_stock_prices.assert_awaited_once_with(['GAZP'])
+        self.assertEqual((quotes['SBER'].price, quotes['GAZP'].price), (255.5, 136.1))
+        self.assertIsNotNone(snapshot.get('GAZP'))
+
+    @patch('market_data.get_stock_price', new_callable=AsyncMock)
+    async def test_stale_entries_are_looked_up_again(self, mock_get_stock_price):
+        snapshot = MarketSnapshot(max_age=60)
+        snapshot.quotes['SBER'] = Quote(250.0, 'RUB', time.time() - 120)
+        mock_get_stock_price.return_value = (255.5, 'RUB')
+        quote = await snapshot.get_quote('SBER')
+        self.assertEqual(quote.price, 255.5)
+        self.assertLess(quote.age, 60)
+
+
+class QuoteRefresherTestCase(unittest.IsolatedAsyncioTestCase):
+
+    @patch('market_data.fetch_stock_prices', new_callable=AsyncMock)
+    async def test_refresh_fills_snapshot(self, mock_fetch_stock_prices):
+        mock_fetch_stock_prices.return_value = {'SBER': (255.5, 'RUB'), 'NOSUCH': (None, None)}
+        fx = MagicMock()
+        fx.latest = AsyncMock(return_value=FxTable(date(2024, 10, 23), {'USD': 95.5}))
+        snapshot = MarketSnapshot(fx=fx)
+        refresher = QuoteRefresher(snapshot)
+        refresher.tracked_tickers = AsyncMock(return_value=['SBER', 'NOSUCH'])
+        await refresher.refresh_once()
+        self.assertEqual(snapshot.get('SBER').price, 255.5)
+        self.assertIsNone(snapshot.get('NOSUCH'))
+        fx.latest.assert_awaited_once_with(force=True)
+        self.assertEqual((await snapshot.get_usd_rub()).price, 95.5)
+
+        # Other workers do not force the CBR download on every cycle
+        fx.latest.reset_mock()
+        refresher.worker_index, refresher.worker_count = 1, 2
+        await refresher.refresh_once()
+        fx.latest.assert_awaited_once_with(force=False)
+
+    @patch('market_data.fetch_last_prices', new_callable=AsyncMock)
+    @patch('market_data.fetch_stock_prices', new_callable=AsyncMock)
+    async def test_watch_and_alerts_follow_intraday_prices(self, mock_fetch_stock_prices, mock_fetch_last_prices):
+        # The previous close stays the same all day, the last trade moves
+        mock_fetch_stock_prices.return_value = {'SBER': (255.5, 'RUB')}
+        mock_fetch_last_prices.side_effect = [{'SBER': (256.0, 'RUB')}, {'SBER': (257.3, 'RUB')}]
+        fx = MagicMock()
+        fx.latest = AsyncMock(return_value=None)
+        refresher = QuoteRefresher(MarketSnapshot(fx=fx))
+        refresher.tracked_tickers = AsyncMock(return_value=[])
+        portfolio = AsyncMock()
+        refresher.listeners.append(portfolio)
+        alerts = AsyncMock()
+        refresher.live_listeners.append(alerts)
+        edit = AsyncMock()
+        hub = WatchHub(edit)
+        refresher.live_ticker_sources.append(hub.tickers)
+        refresher.live_listeners.append(hub.check)
+        hub.watch(1, 10, 'SBER', 256.0, 'RUB')
+
+        await refresher.refresh_once()
+        edit.assert_not_awaited()
+        await refresher.refresh_once()
+        mock_fetch_last_prices.assert_awaited_with(['SBER'])
+        chat_id, message_id, text = edit.await_args.args
+        self.assertEqual((chat_id, message_id), (1, 10))
+        self.assertIn('SBER: 257.30 RUB', text)
+        # Alerts follow the same intraday prices, the snapshot keeps the previous close
+        self.assertEqual(alerts.await_args.args[0]['SBER'].price, 257.3)
+        self.assertEqual(portfolio.await_args.args[0]['SBER'].price, 255.5)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,94 @@
+import unittest
+from unittest.mock import AsyncMock
+from unittest.mock import patch
+
+import market_data
+import securities
+from securities import SecurityIndex, check_stocks_existence
+
+
+class SecurityIndexTestCase(unittest.IsolatedAsyncioTestCase):
+    test_response = {'securities': {'columns': ['SECID', 'SHORTNAME'],
+                                    'data': [['SBER', 'Сбербанк'], ['GAZP', 'ГАЗПРОМ ао']]}}
+
+    @patch('market_data.client.get_json', new_callable=AsyncMock)
+    async def test_refresh_loads_tqbr_list(self, mock_get_json):
+        mock_get_json.return_value = self.test_response
+        index = SecurityIndex()
+        self.assertTrue(await index.refresh())
+        self.assertIn('sber', index)
+        self.assertNotIn('LKOH', index)
+        self.assertEqual(index.name('GAZP'), 'ГАЗПРОМ ао')
+
+    @patch('market_data.client.get_json', new_callable=AsyncMock)
+    async def test_failed_refresh_keeps_previous_list(self, mock_get_json):
+        index = SecurityIndex()
+        index.load([('SBER', 'Сбербанк')])
+        mock_get_json.return_value = None
+        self.assertFalse(await index.refresh())
+        self.assertIn('SBER', index)
+
+    def test_add_confirmed_ticker(self):
+        index = SecurityIndex()
+        index.add('yndx')
+        self.assertIn('YNDX', index)
+        self.assertEqual([security.secid for security in index.search('yn')], ['YNDX'])
+
+
+class SearchTestCase(unittest.TestCase):
+
+    def setUp(self) -> None:
+        self.index = SecurityIndex()
+        self.index.load([('SBER', 'Сбербанк', 255.5), ('SBERP', 'Сбербанк-п', 254.1), ('GAZP', 'ГАЗПРОМ ао', None),
+                         ('SGZH', 'Сегежа', 1.5), ('BSPB', 'БСП ао', 380.0)])
+
+    def search(self, query, limit=20):
+        return [security.secid for security in self.index.search(query, limit)]
+
+    def test_ticker_and_name_prefixes(self):
+        self.assertEqual(self.search('sb'), ['SBER', 'SBERP'])
+        self.assertEqual(self.search('газ'), ['GAZP'])
+        # Every word of the name is a key
+        self.assertEqual(self.search('ао'), ['BSPB', 'GAZP'])
+        self.assertEqual(self.search('XYZ'), [])
+
+    def test_exact_ticker_and_ticker_matches_come_first(self):
+        self.assertEqual(self.search('SBER'), ['SBER', 'SBERP'])
+        # Tickers confirmed later are searchable too
+        self.index.add('SBP', 'SPB Биржа')
+        self.assertEqual(self.search('sb'), ['SBER', 'SBERP', 'SBP'])
+        self.assertEqual(self.search('с'), ['SBER', 'SBERP', 'SGZH'])
+        self.assertEqual(self.search('s'), ['SBER', 'SBERP', 'SBP', 'SGZH'])
+        self.assertEqual(self.search('s', limit=1), ['SBER'])
+
+    def test_result_fields(self):
+        security, = self.index.search('gazp')
+        self.assertEqual(security, ('GAZP', 'ГАЗПРОМ ао', None))
+        self.assertEqual(self.index.search('SBER')[0].price, 255.5)
+        self.assertEqual(len(self.index.search('')), 5)
+
+
+class CheckStocksExistenceTestCase(unittest.IsolatedAsyncioTestCase):
+
+    def setUp(self) -> None:
+        securities.security_index.clear()
+        market_data.quote_cache.clear()
+
+    def tearDown(self) -> None:
+        securities.security_index.clear()
+        market_data.quote_cache.clear()
+
+    @patch('securities._fetch_stock_existence', new_callable=AsyncMock)
+    @patch('market_data.client.get_json', new_callable=AsyncMock)
+    async def test_only_unlisted_tickers_go_to_the_exchange(self, mock_get_json, mock_fetch):
+        mock_get_json.return_value = SecurityIndexTestCase.test_response
+        mock_fetch.side_effect = lambda stock_id: stock_id == 'SU26238RMFS4'
+        found = await check_stocks_existence(['sber', 'SBER', 'GAZP', 'SU26238RMFS4', 'XXXX'])
+        self.assertEqual(found, {'SBER', 'GAZP', 'SU26238RMFS4'})
+        # One download of the TQBR list, then one check per unlisted ticker
+        mock_get_json.assert_awaited_once()
+        self.assertEqual(sorted(call.args[0] for call in mock_fetch.await_args_list), ['SU26238RMFS4', 'XXXX'])
+
+
+if __name__ == '__main__':
+    unittest.main()
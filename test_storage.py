@@ -0,0 +1,124 @@
+import unittest
+
+from aiogram.fsm.state import State, StatesGroup
+from aiogram.fsm.storage.base import StorageKey
+from aiogram.fsm.storage.redis import RedisStorage
+
+from db_executor import DatabaseExecutor
+from storage import SQLiteStorage, TTLMemoryStorage
+from test_db_executor import TemporaryDatabase
+
+
+class AddStockStates(StatesGroup):
+    StockID = State()
+    StockPrice = State()
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+class FakeRedis:
+    """In-process stand-in for the subset of the redis client RedisStorage uses."""
+
+    def __init__(self, clock):
+        self.clock = clock
+        self.values = {}
+
+    async def set(self, name, value, ex=None):
+        expires_at = self.clock() + ex if ex else None
+        self.values[name] = (value.encode() if isinstance(value, str) else value, expires_at)
+
+    async def get(self, name):
+        value, expires_at = self.values.get(name, (None, None))
+        if expires_at is not None and expires_at <= self.clock():
+            del self.values[name]
+            return None
+        return value
+
+    async def delete(self, *names):
+        for name in names:
+            self.values.pop(name, None)
+
+    async def aclose(self, close_connection_pool=True):
+        pass
+
+
+class StorageContract:
+    """Behaviour every FSM backend of the bot has to provide."""
+
+    key = StorageKey(bot_id=1, chat_id=10, user_id=10)
+
+    async def test_state_and_data_round_trip(self):
+        await self.storage.set_state(self.key, AddStockStates.StockPrice)
+        await self.storage.update_data(self.key, {'StockID': 'SBER'})
+        self.assertEqual(await self.storage.get_state(self.key), AddStockStates.StockPrice.state)
+        self.assertEqual(await self.storage.get_data(self.key), {'StockID': 'SBER'})
+
+    async def test_abandoned_dialogue_expires(self):
+        await self.storage.set_state(self.key, AddStockStates.StockID)
+        await self.storage.set_data(self.key, {'usd_amount': 12.5})
+        self.clock.now += 3601
+        self.assertIsNone(await self.storage.get_state(self.key))
+        self.assertEqual(await self.storage.get_data(self.key), {})
+
+    async def test_clear(self):
+        await self.storage.set_state(self.key, AddStockStates.StockID)
+        await self.storage.set_data(self.key, {'StockID': 'SBER'})
+        await self.storage.set_state(self.key, None)
+        await self.storage.set_data(self.key, {})
+        self.assertIsNone(await self.storage.get_state(self.key))
+        self.assertEqual(await self.storage.get_data(self.key), {})
+
+
+class TTLMemoryStorageTestCase(StorageContract, unittest.IsolatedAsyncioTestCase):
+
+    def setUp(self) -> None:
+        self.clock = FakeClock()
+        self.storage = TTLMemoryStorage(ttl=3600, clock=self.clock)
+
+    async def test_reads_do_not_allocate_records(self):
+        await self.storage.get_state(self.key)
+        self.assertEqual(self.storage.records, {})
+
+    async def test_sweep_removes_expired_records(self):
+        await self.storage.set_state(self.key, AddStockStates.StockID)
+        self.clock.now += 3601
+        self.assertEqual(await self.storage.sweep(), 1)
+        self.assertEqual(self.storage.records, {})
+
+
+class SQLiteStorageTestCase(TemporaryDatabase, StorageContract, unittest.IsolatedAsyncioTestCase):
+
+    def setUp(self) -> None:
+        super().setUp()
+        self.clock = FakeClock()
+        self.storage = SQLiteStorage(self.executor, ttl=3600, clock=self.clock)
+
+    async def test_sweep_removes_expired_records(self):
+        await self.storage.set_state(self.key, AddStockStates.StockID)
+        self.clock.now += 3601
+        self.assertEqual(await self.storage.sweep(), 1)
+
+    async def test_state_is_shared_between_storage_instances(self):
+        await self.storage.set_state(self.key, AddStockStates.StockID)
+        other = SQLiteStorage(DatabaseExecutor(self.db), ttl=3600, clock=self.clock)
+        try:
+            self.assertEqual(await other.get_state(self.key), AddStockStates.StockID.state)
+        finally:
+            other.executor.stop()
+
+
+class RedisStorageTestCase(StorageContract, unittest.IsolatedAsyncioTestCase):
+
+    def setUp(self) -> None:
+        self.clock = FakeClock()
+        self.storage = RedisStorage(FakeRedis(self.clock), state_ttl=3600, data_ttl=3600)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,95 @@
+import asyncio
+import unittest
+from unittest.mock import AsyncMock, MagicMock
+
+from aiogram.types import Message, Update
+
+from throttling import THROTTLED_TEXT, ThrottlingMiddleware
+
+
+def message_update(update_id, text, user_id=1):
+    return Update.model_validate({
+        'update_id': update_id,
+        'message': {'message_id': update_id, 'date': 0, 'text': text,
+                    'chat': {'id': user_id, 'type': 'private'},
+                    'from': {'id': user_id, 'is_bot': False, 'first_name': 'Test'}},
+    })
+
+
+class ThrottlingMiddlewareTestCase(unittest.IsolatedAsyncioTestCase):
+
+    def setUp(self) -> None:
+        self.now = 0.0
+        self.bot = MagicMock()
+        self.bot.send_message = AsyncMock()
+        self.bot.copy_message = AsyncMock()
+        self.middleware = ThrottlingMiddleware(rate=1, burst=2, coalesce=('CheckPortfolio',), clock=lambda: self.now)
+
+    def call(self, handler, update):
+        return self.middleware(handler, update, {'event_from_user': update.message.from_user, 'bot': self.bot})
+
+    async def test_burst_then_one_polite_reply(self):
+        handler = AsyncMock(return_value='ok')
+        results = [await self.call(handler, message_update(i, str(i))) for i in range(4)]
+        self.assertEqual(results, ['ok', 'ok', None, None])
+        self.assertEqual(handler.await_count, 2)
+        self.bot.send_message.assert_awaited_once_with(1, THROTTLED_TEXT)
+        self.assertEqual(self.middleware.stats['throttled'], 2)
+
+        # Tokens come back with time; other users are not affected
+        self.now += 1
+        self.assertEqual(await self.call(handler, message_update(5, '5')), 'ok')
+        self.assertEqual(await self.call(handler, message_update(6, '6', user_id=2)), 'ok')
+
+    async def test_updates_of_a_user_are_serialized(self):
+        self.middleware.burst = 10
+        running, peak = 0, 0
+
+        async def handler(event, data):
+            nonlocal running, peak
+            running += 1
+            peak = max(peak, running)
+            await asyncio.sleep(0.01)
+            running -= 1
+
+        await asyncio.gather(*(self.call(handler, message_update(i, str(i))) for i in range(3)),
+                             self.call(handler, message_update(9, '9', user_id=2)))
+        self.assertEqual(peak, 2)
+
+    async def test_repeated_press_is_coalesced(self):
+        release = asyncio.Event()
+        calls = 0
+        # Coalesced handlers return the reply they sent, like message.reply does
+        reply = Message.model_validate({'message_id': 100, 'date': 0, 'text': 'portfolio',
+                                        'chat': {'id': 1, 'type': 'private'}})
+
+        async def handler(event, data):
+            nonlocal calls
+            calls += 1
+            await release.wait()
+            return reply
+
+        first = asyncio.create_task(self.call(handler, message_update(1, 'CheckPortfolio')))
+        await asyncio.sleep(0)
+        second = asyncio.create_task(self.call(handler, message_update(2, 'CheckPortfolio')))
+        await asyncio.sleep(0)
+        release.set()
+        self.assertEqual(await asyncio.gather(first, second), [reply, reply])
+        self.assertEqual(calls, 1)
+        # The duplicate press gets the same portfolio as a reply of its own
+        self.bot.copy_message.assert_awaited_once_with(1, 1, 100, reply_to_message_id=2)
+        self.assertEqual(self.middleware.stats['coalesced'], 1)
+        self.assertEqual(self.middleware.users[1].in_flight, {})
+
+    async def test_idle_users_are_forgotten(self):
+        self.middleware.max_users = 2
+        handler = AsyncMock()
+        for user_id in range(3):
+            await self.call(handler, message_update(user_id, 'x', user_id=user_id))
+        self.now += 10
+        await self.call(handler, message_update(3, 'x', user_id=3))
+        self.assertEqual(list(self.middleware.users), [3])
+
+
+if __name__ == '__main__':
+    unittest.main()
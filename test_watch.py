@@ -0,0 +1,60 @@
+import unittest
+from unittest.mock import AsyncMock
+
+from watch import WatchHub
+
+
+class WatchHubTestCase(unittest.IsolatedAsyncioTestCase):
+
+    def setUp(self) -> None:
+        self.now = 1000.0
+        self.edit = AsyncMock()
+        self.hub = WatchHub(self.edit, ttl=60, max_per_chat=2, clock=lambda: self.now)
+
+    async def test_fan_out_and_change_detection(self):
+        self.hub.watch(1, 10, 'SBER', 250.0, 'RUB')
+        self.hub.watch(2, 20, 'SBER', 251.0, 'RUB')
+        self.hub.watch(1, 11, 'GAZP', 130.0, 'RUB')
+        # One subscription per ticker, however many chats watch it
+        self.assertEqual(sorted(self.hub.tickers()), ['GAZP', 'SBER'])
+        self.assertEqual(len(self.hub), 3)
+
+        self.assertEqual(await self.hub.check({'SBER': (251.0, 'RUB'), 'GAZP': (130.0, 'RUB')}), 1)
+        chat_id, message_id, text = self.edit.await_args.args
+        self.assertEqual((chat_id, message_id), (1, 10))
+        self.assertIn('SBER: 251.00 RUB (+0.40%', text)
+
+        # Nothing moved: no edits
+        self.assertEqual(await self.hub.check({'SBER': (251.0, 'RUB'), 'GAZP': (None, None)}), 0)
+        self.assertEqual(self.edit.await_count, 1)
+
+    async def test_expiry(self):
+        self.hub.watch(1, 10, 'SBER', 250.0)
+        self.now += 30
+        self.hub.watch(2, 20, 'SBER', 250.0)
+        self.now += 31
+        self.assertEqual(await self.hub.check({}), 1)
+        self.assertEqual(self.edit.await_args.args[:2], (1, 10))
+        self.assertIn('Наблюдение завершено', self.edit.await_args.args[2])
+        self.assertEqual([watch.chat_id for watch in self.hub.subscriptions['SBER'].values()], [2])
+        self.now += 30
+        await self.hub.check({})
+        self.assertEqual(self.hub.subscriptions, {})
+
+    def test_limits_and_unwatch(self):
+        self.hub.watch(1, 10, 'SBER', 250.0)
+        self.hub.watch(1, 11, 'GAZP', 130.0)
+        self.assertFalse(self.hub.can_watch(1, 'LKOH'))
+        # Watching the same ticker again only moves the watch to the new message
+        self.assertTrue(self.hub.can_watch(1, 'SBER'))
+        self.hub.watch(1, 12, 'SBER', 251.0)
+        self.assertEqual(self.hub.subscriptions['SBER'][1].message_id, 12)
+
+        self.assertEqual([watch.stock_id for watch in self.hub.unwatch(1, 'GAZP')], ['GAZP'])
+        self.assertEqual(self.hub.tickers(), ['SBER'])
+        self.assertEqual(len(self.hub.unwatch(1)), 1)
+        self.assertEqual(self.hub.unwatch(1), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
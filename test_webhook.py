@@ -0,0 +1,64 @@
+import asyncio
+import unittest
+
+from aiogram import Bot, Dispatcher
+from aiohttp.test_utils import TestClient, TestServer
+
+from webhook import build_app
+
+
+class WebhookAppTestCase(unittest.IsolatedAsyncioTestCase):
+    secret = 'test-secret'
+
+    async def asyncSetUp(self) -> None:
+        self.dp = Dispatcher()
+        self.updates = []
+        self.release = asyncio.Event()
+
+        @self.dp.message()
+        async def collect(message):
+            if message.text == 'slow':
+                await self.release.wait()
+            self.updates.append(message.text)
+
+        self.bot = Bot(token='123:abc')
+        self.client = TestClient(TestServer(build_app(self.dp, self.bot, '/webhook', self.secret)))
+        await self.client.start_server()
+
+    async def asyncTearDown(self) -> None:
+        await self.client.close()
+
+    def update(self, text):
+        return {'update_id': 1, 'message': {'message_id': 1, 'date': 0, 'text': text,
+                                            'chat': {'id': 1, 'type': 'private'}}}
+
+    async def test_rejects_wrong_secret(self):
+        response = await self.client.post('/webhook', json=self.update('start'),
+                                           headers={'X-Telegram-Bot-Api-Secret-Token': 'wrong'})
+        self.assertEqual(response.status, 401)
+        self.assertEqual(self.updates, [])
+
+    async def test_feeds_update_to_dispatcher(self):
+        response = await self.client.post('/webhook', json=self.update('start'),
+                                           headers={'X-Telegram-Bot-Api-Secret-Token': self.secret})
+        self.assertEqual(response.status, 200)
+        # Updates are processed in the background; shutting down waits for them
+        await self.client.close()
+        self.assertEqual(self.updates, ['start'])
+
+    async def test_shutdown_waits_for_updates_in_progress(self):
+        for text in ('slow', 'fast'):
+            await self.client.post('/webhook', json=self.update(text),
+                                   headers={'X-Telegram-Bot-Api-Secret-Token': self.secret})
+        self.assertNotIn('slow', self.updates)
+        asyncio.get_running_loop().call_later(0.05, self.release.set)
+        await self.client.close()
+        self.assertEqual(self.updates, ['fast', 'slow'])
+
+    async def test_health_check(self):
+        response = await self.client.get('/healthz')
+        self.assertEqual(await response.text(), 'ok')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,98 @@
+import multiprocessing
+import os
+import time
+import unittest
+from functools import partial
+
+from workers import WorkerPool, owns_user, shard_key, used_update_types
+
+
+def message(update_id, user_id, chat_id=None):
+    return {'update_id': update_id,
+            'message': {'message_id': update_id, 'date': 0, 'text': str(update_id),
+                        'chat': {'id': chat_id or user_id, 'type': 'private'},
+                        'from': {'id': user_id, 'is_bot': False, 'first_name': 'Test'}}}
+
+
+def echo_worker(results, index, env, queue, heartbeats):
+    while True:
+        raw_update = queue.get()
+        if raw_update is None:
+            return
+        if raw_update.get('crash'):
+            os._exit(1)
+        heartbeats[index] = time.time()
+        results.put((index, env['WORKER_INDEX'], shard_key(raw_update), raw_update['update_id']))
+
+
+class ShardingTestCase(unittest.TestCase):
+
+    def test_shard_key(self):
+        self.assertEqual(shard_key(message(1, 42, chat_id=-100)), 42)
+        self.assertEqual(shard_key({'update_id': 2, 'callback_query': {'id': 'x', 'from': {'id': 7}}}), 7)
+        self.assertEqual(shard_key({'update_id': 3, 'poll_answer': {'poll_id': 'p', 'user': {'id': 8}}}), 8)
+        self.assertEqual(shard_key({'update_id': 4, 'channel_post': {'chat': {'id': -5}}}), -5)
+        self.assertEqual(shard_key({'update_id': 5}), 5)
+
+    def test_owns_user(self):
+        self.assertTrue(owns_user(12345))
+        self.assertEqual([user_id for user_id in range(6) if owns_user(user_id, index=1, count=3)], [1, 4])
+
+
+class UpdateTypesTestCase(unittest.TestCase):
+
+    def test_ingress_asks_for_the_bot_update_types(self):
+        import main as bot_app
+        update_types = used_update_types()
+        self.assertEqual(update_types, bot_app.dp.resolve_used_update_types())
+        self.assertIn('callback_query', update_types)
+
+
+class WorkerPoolTestCase(unittest.TestCase):
+
+    def setUp(self) -> None:
+        context = multiprocessing.get_context('fork')
+        self.results = context.Queue()
+        self.pool = WorkerPool(3, target=partial(echo_worker, self.results), start_method='fork',
+                               heartbeat_timeout=5, env=lambda index, count: {'WORKER_INDEX': str(index)})
+        self.pool.start()
+
+    def tearDown(self) -> None:
+        self.pool.stop(timeout=1)
+        self.results.close()
+
+    def collect(self, count):
+        return [self.results.get(timeout=5) for _ in range(count)]
+
+    def test_users_stick_to_one_worker_in_order(self):
+        updates = [message(update_id, user_id) for update_id in range(30) for user_id in (10, 11, 12, 13)
+                   if update_id % 4 == user_id % 4]
+        for raw_update in updates:
+            self.pool.dispatch(raw_update)
+        by_user = {}
+        for index, env_index, user_id, update_id in self.collect(len(updates)):
+            self.assertEqual(str(index), env_index)
+            self.assertEqual(index, user_id % 3)
+            by_user.setdefault(user_id, []).append(update_id)
+        for user_id, update_ids in by_user.items():
+            self.assertEqual(update_ids, sorted(update_ids))
+        self.assertEqual(sum(self.pool.dispatched), len(updates))
+
+    def test_dead_and_hung_workers_are_restarted(self):
+        self.pool.dispatch({'update_id': 1, 'crash': True, 'message': {'from': {'id': 1}}})
+        self.pool.workers[1].process.join(5)
+        # Worker 2 stopped reporting
+        self.pool.heartbeats[2] = time.time() - 60
+        self.assertFalse(self.pool.healthy())
+        self.assertEqual(self.pool.check(), [1, 2])
+        self.assertEqual([worker.restarts for worker in self.pool.workers], [0, 1, 1])
+        self.assertTrue(self.pool.healthy())
+
+        # The new processes take updates again
+        self.pool.dispatch(message(2, 1))
+        self.pool.dispatch(message(3, 2))
+        self.assertEqual(sorted(index for index, *_ in self.collect(2)), [1, 2])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,144 @@
+import asyncio
+import logging
+import os
+import time
+from typing import Any, Awaitable, Callable, Dict, Hashable, Iterable, Optional
+
+from aiogram import BaseMiddleware, Bot
+from aiogram.types import Message, Update
+
+from outbox import TokenBucket
+
+
+logger = logging.getLogger(__name__)
+
+# Updates one user may send: a sustained rate and a burst for quick dialogue answers
+USER_RATE = float(os.getenv('USER_RATE', 1))
+USER_BURST = float(os.getenv('USER_BURST', 5))
+THROTTLED_TEXT = 'Слишком много запросов, подождите пару секунд и повторите'
+# State of idle users is dropped once there are more users than this
+MAX_TRACKED_USERS = 10000
+
+
+class UserState:
+    __slots__ = ('bucket', 'lock', 'in_flight', 'warned', 'active')
+
+    def __init__(self, bucket: TokenBucket):
+        self.bucket = bucket
+        # One update of the user is processed at a time, so FSM data is never updated concurrently
+        self.lock = asyncio.Lock()
+        # Coalesce key -> future with the result of the update being processed
+        self.in_flight: Dict[Hashable, asyncio.Future] = {}
+        # The throttling reply was sent and nothing got through since
+        self.warned = False
+        # Updates of the user currently inside the middleware
+        self.active = 0
+
+
+class ThrottlingMiddleware(BaseMiddleware):
+    """Outer update middleware: per-user token bucket, serialization and coalescing.
+
+    Updates over the user's rate are dropped with one polite reply per burst.
+    Accepted updates of a user run one after another. A repeated press of a
+    read-only button or command (``coalesce``) while the same one is still
+    being processed waits for it instead of running the handler again; such
+    handlers return the message they sent and the duplicate gets a copy of it.
+    Inline queries are answered from memory and are not limited.
+    """
+
+    def __init__(self, rate: float = USER_RATE, burst: float = USER_BURST, coalesce: Iterable[str] = (),
+                 clock: Callable[[], float] = time.monotonic, max_users: int = MAX_TRACKED_USERS):
+        self.rate = rate
+        self.burst = burst
+        self.coalesce = frozenset(coalesce)
+        self.clock = clock
+        self.max_users = max_users
+        self.users: Dict[int, UserState] = {}
+        self.stats = {'throttled': 0, 'coalesced': 0}
+
+    def _user(self, user_id: int, now: float) -> UserState:
+        state = self.users.get(user_id)
+        if state is None:
+            if len(self.users) >= self.max_users:
+                self._forget_idle_users(now)
+            state = self.users[user_id] = UserState(TokenBucket(self.rate, self.burst, now))
+        return state
+
+    def _forget_idle_users(self, now: float) -> None:
+        # A full bucket with nothing in flight behaves exactly like a new user
+        for user_id, state in list(self.users.items()):
+            state.bucket.refill(now)
+            if not state.active and state.bucket.tokens >= state.bucket.capacity:
+                del self.users[user_id]
+
+    def _coalesce_key(self, event: Update) -> Optional[Hashable]:
+        if event.message is not None and event.message.text in self.coalesce:
+            return 'message', event.message.text
+        if event.callback_query is not None and event.callback_query.data in self.coalesce:
+            return 'callback_query', event.callback_query.data
+        return None
+
+    async def _reply_throttled(self, event: Update, bot: Optional[Bot]) -> None:
+        if bot is None:
+            return
+        try:
+            if event.message is not None:
+                await bot.send_message(event.message.chat.id, THROTTLED_TEXT)
+            elif event.callback_query is not None:
+                await bot.answer_callback_query(event.callback_query.id, text=THROTTLED_TEXT)
+        except Exception:
+            logger.exception('Failed to send the throttling reply')
+
+    async def _reply_coalesced(self, event: Update, bot: Optional[Bot], result: Any) -> None:
+        if bot is None or not isinstance(result, Message):
+            return
+        try:
+            if event.message is not None:
+                await bot.copy_message(event.message.chat.id, result.chat.id, result.message_id,
+                                       reply_to_message_id=event.message.message_id)
+            elif event.callback_query is not None:
+                await bot.answer_callback_query(event.callback_query.id)
+                if event.callback_query.message is not None:
+                    await bot.copy_message(event.callback_query.message.chat.id, result.chat.id, result.message_id)
+        except Exception:
+            logger.exception('Failed to send the coalesced reply')
+
+    async def __call__(self, handler: Callable[[Update, Dict[str, Any]], Awaitable[Any]], event: Update,
+                       data: Dict[str, Any]) -> Any:
+        user = data.get('event_from_user')
+        if user is None or event.inline_query is not None:
+            return await handler(event, data)
+
+        now = self.clock()
+        state = self._user(user.id, now)
+        key = self._coalesce_key(event)
+        if key is not None and key in state.in_flight:
+            self.stats['coalesced'] += 1
+            result = await asyncio.shield(state.in_flight[key])
+            await self._reply_coalesced(event, data.get('bot'), result)
+            return result
+
+        if state.bucket.wait_time(now) > 0:
+            self.stats['throttled'] += 1
+            if not state.warned:
+                state.warned = True
+                await self._reply_throttled(event, data.get('bot'))
+            return None
+        state.bucket.take()
+        state.warned = False
+
+        future = None
+        if key is not None:
+            future = state.in_flight[key] = asyncio.get_running_loop().create_future()
+        state.active += 1
+        result = None
+        try:
+            async with state.lock:
+                result = await handler(event, data)
+            return result
+        finally:
+            state.active -= 1
+            if future is not None:
+                del state.in_flight[key]
+                # Duplicates get the same result; a failure is reported once, by the original update
+                future.set_result(result)
@@ -0,0 +1,128 @@
+import logging
+import os
+import time
+from typing import Awaitable, Callable, Dict, Iterable, List, Optional
+
+logger = logging.getLogger(__name__)
+
+# A watch stops updating this long after /watch; repeating the command renews it
+WATCH_TTL = float(os.getenv('WATCH_TTL', 3600))
+WATCH_MAX_PER_CHAT = int(os.getenv('WATCH_MAX_PER_CHAT', 10))
+
+
+class Watch:
+    """One live quote message: the bot keeps editing ``message_id`` in ``chat_id``."""
+
+    __slots__ = ('chat_id', 'message_id', 'stock_id', 'start_price', 'price', 'currency', 'expires_at')
+
+    def __init__(self, chat_id: int, message_id: int, stock_id: str, price: float, currency: Optional[str],
+                 expires_at: float):
+        self.chat_id = chat_id
+        self.message_id = message_id
+        self.stock_id = stock_id
+        self.start_price = price
+        # Price currently shown in the message
+        self.price = price
+        self.currency = currency or 'RUB'
+        self.expires_at = expires_at
+
+
+def format_quote(stock_id: str, price: float, currency: Optional[str], start_price: float) -> str:
+    change = (price / start_price - 1) * 100 if start_price else 0.0
+    return (f'👁 {stock_id}: {price:.2f} {currency or "RUB"} ({change:+.2f}% с начала наблюдения)\n'
+            f'Обновлено в {time.strftime("%H:%M:%S")}')
+
+
+def format_watch(watch: Watch, finished: bool = False) -> str:
+    text = format_quote(watch.stock_id, watch.price, watch.currency, watch.start_price)
+    if finished:
+        text += f'\nНаблюдение завершено, продлить: /watch {watch.stock_id}'
+    return text
+
+
+class WatchHub:
+    """Live quote messages grouped by ticker.
+
+    Every watched ticker is polled once per refresh for its intraday (last
+    trade) price, however many chats watch it; each fresh batch of prices is
+    fanned out to the watchers and a message is edited only when its price moved.
+    """
+
+    def __init__(self, edit: Optional[Callable[[int, int, str], Awaitable]] = None, ttl: float = WATCH_TTL,
+                 max_per_chat: int = WATCH_MAX_PER_CHAT, clock: Callable[[], float] = time.monotonic):
+        self.edit = edit
+        self.ttl = ttl
+        self.max_per_chat = max_per_chat
+        self.clock = clock
+        # stock_id -> chat_id -> watch
+        self.subscriptions: Dict[str, Dict[int, Watch]] = {}
+
+    def __len__(self) -> int:
+        return sum(len(watchers) for watchers in self.subscriptions.values())
+
+    def tickers(self) -> List[str]:
+        return list(self.subscriptions)
+
+    def chat_watches(self, chat_id: int) -> List[Watch]:
+        return [watchers[chat_id] for watchers in self.subscriptions.values() if chat_id in watchers]
+
+    def can_watch(self, chat_id: int, stock_id: str) -> bool:
+        watching = self.chat_watches(chat_id)
+        return len(watching) < self.max_per_chat or any(watch.stock_id == stock_id for watch in watching)
+
+    def watch(self, chat_id: int, message_id: int, stock_id: str, price: float,
+              currency: Optional[str] = None) -> Watch:
+        """Start updating ``message_id``; a chat's previous message for the ticker stays as it is."""
+        watch = Watch(chat_id, message_id, stock_id, price, currency, self.clock() + self.ttl)
+        self.subscriptions.setdefault(stock_id, {})[chat_id] = watch
+        return watch
+
+    def unwatch(self, chat_id: int, stock_id: Optional[str] = None) -> List[Watch]:
+        """Stop the chat's watch of ``stock_id``, or all of them."""
+        stopped = []
+        for ticker in [stock_id] if stock_id is not None else self.tickers():
+            watchers = self.subscriptions.get(ticker, {})
+            if chat_id in watchers:
+                stopped.append(watchers.pop(chat_id))
+                if not watchers:
+                    del self.subscriptions[ticker]
+        return stopped
+
+    def expire(self) -> List[Watch]:
+        now = self.clock()
+        expired = []
+        for stock_id in self.tickers():
+            watchers = self.subscriptions[stock_id]
+            for chat_id in [chat_id for chat_id, watch in watchers.items() if watch.expires_at <= now]:
+                expired.append(watchers.pop(chat_id))
+            if not watchers:
+                del self.subscriptions[stock_id]
+        return expired
+
+    async def check(self, prices: Dict[str, Iterable]) -> int:
+        """Quote listener: edit the messages whose price changed, finish expired ones.
+
+        Returns the number of edits sent.
+        """
+        edits = []
+        for watch in self.expire():
+            edits.append((watch, format_watch(watch, finished=True)))
+        for stock_id, (price, currency, *_) in prices.items():
+            watchers = self.subscriptions.get(stock_id)
+            if not watchers or price is None:
+                continue
+            for watch in watchers.values():
+                if price == watch.price:
+                    continue
+                watch.price = price
+                watch.currency = currency or watch.currency
+                edits.append((watch, format_watch(watch)))
+        for watch, text in edits:
+            try:
+                await self.edit(watch.chat_id, watch.message_id, text)
+            except Exception:
+                logger.exception('Failed to update the %s watch in chat %s', watch.stock_id, watch.chat_id)
+        return len(edits)
+
+
+watch_hub = WatchHub()
@@ -0,0 +1,94 @@
+import asyncio
+import hmac
+import logging
+import os
+import signal
+from typing import Any, Dict, Set
+
+from aiogram import Bot, Dispatcher
+from aiogram.methods import TelegramMethod
+from aiogram.webhook.aiohttp_server import setup_application
+from aiohttp import web
+
+
+logger = logging.getLogger(__name__)
+
+# polling | webhook
+BOT_MODE = os.getenv('BOT_MODE', 'polling')
+# Public HTTPS address Telegram sends updates to, e.g. https://bot.example.com
+WEBHOOK_BASE_URL = os.getenv('WEBHOOK_BASE_URL', '')
+WEBHOOK_PATH = os.getenv('WEBHOOK_PATH', '/webhook')
+WEBHOOK_SECRET = os.getenv('WEBHOOK_SECRET', '')
+WEBHOOK_HOST = os.getenv('WEBHOOK_HOST', '0.0.0.0')
+WEBHOOK_PORT = int(os.getenv('WEBHOOK_PORT', 8000))
+# How long in-flight updates may take to finish on shutdown
+WEBHOOK_SHUTDOWN_TIMEOUT = float(os.getenv('WEBHOOK_SHUTDOWN_TIMEOUT', 10))
+
+
+def build_app(dp: Dispatcher, bot: Bot, path: str = WEBHOOK_PATH, secret: str = WEBHOOK_SECRET) -> web.Application:
+    """aiohttp application that feeds webhook updates into ``dp``.
+
+    Requests without the matching X-Telegram-Bot-Api-Secret-Token header are
+    rejected with 401. Updates are answered immediately and processed in the
+    background; on shutdown the app waits for them before closing the bot.
+    """
+    app = web.Application()
+    # Updates being processed; our own set, so draining does not rely on aiogram internals
+    in_flight: Set[asyncio.Task] = set()
+
+    async def feed_update(update: Dict[str, Any]) -> None:
+        result = await dp.feed_raw_update(bot, update)
+        # A handler may answer with a method, as in a webhook reply; send it as a request
+        if isinstance(result, TelegramMethod):
+            await dp.silent_call_request(bot, result)
+
+    async def receive_update(request: web.Request) -> web.Response:
+        if not hmac.compare_digest(request.headers.get('X-Telegram-Bot-Api-Secret-Token', ''), secret):
+            return web.Response(text='Unauthorized', status=401)
+        task = asyncio.create_task(feed_update(await request.json(loads=bot.session.json_loads)))
+        in_flight.add(task)
+        task.add_done_callback(in_flight.discard)
+        return web.json_response({})
+
+    async def drain_updates(app: web.Application) -> None:
+        if in_flight:
+            logger.info('Waiting for %s updates in progress', len(in_flight))
+            await asyncio.wait(set(in_flight), timeout=WEBHOOK_SHUTDOWN_TIMEOUT)
+        await bot.session.close()
+
+    async def health(request: web.Request) -> web.Response:
+        return web.Response(text='ok')
+
+    # Updates finish before the bot session is closed
+    app.on_shutdown.append(drain_updates)
+    app.router.add_post(path, receive_update)
+    app.router.add_get('/healthz', health)
+    setup_application(app, dp, bot=bot)
+    return app
+
+
+async def run_webhook(dp: Dispatcher, bot: Bot) -> None:
+    """Serve webhook updates until SIGINT/SIGTERM."""
+    if not WEBHOOK_BASE_URL or not WEBHOOK_SECRET:
+        raise RuntimeError('WEBHOOK_BASE_URL and WEBHOOK_SECRET must be set in webhook mode')
+
+    app = build_app(dp, bot)
+    runner = web.AppRunner(app, handle_signals=False)
+    await runner.setup()
+    site = web.TCPSite(runner, WEBHOOK_HOST, WEBHOOK_PORT)
+    await site.start()
+    logger.info('Listening for webhook updates on %s:%s%s', WEBHOOK_HOST, WEBHOOK_PORT, WEBHOOK_PATH)
+
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop.set)
+    try:
+        await bot.set_webhook(f'{WEBHOOK_BASE_URL.rstrip("/")}{WEBHOOK_PATH}', secret_token=WEBHOOK_SECRET,
+                              allowed_updates=dp.resolve_used_update_types())
+        await stop.wait()
+    finally:
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            loop.remove_signal_handler(sig)
+        # The webhook is left registered: other replicas behind the balancer keep serving it
+        await runner.cleanup()
@@ -0,0 +1,347 @@
+"""Multi-process mode: one ingress process, N bot worker processes sharded by user.
+
+Run ``python workers.py`` instead of ``python main.py``. The ingress receives
+updates (long polling or webhook, see ``BOT_MODE``) as raw JSON and sends each
+to worker ``user_id % WORKERS``, so a user's updates always reach the same
+process in the order Telegram delivered them and in-memory FSM state stays
+consistent. Every worker runs the full bot from ``main``; its quote refresher
+polls only the tickers of its own users, and jobs shared by all users (daily
+candles, forced CBR downloads) run on worker 0 only.
+
+Nothing in this module imports the bot at module level: a spawned worker
+re-imports it before its per-worker environment (WORKER_INDEX, metrics port,
+rate limits) is in place.
+"""
+import asyncio
+import logging
+import multiprocessing
+import os
+import signal
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from typing import Any, Callable, Dict, List, Optional
+
+import aiohttp
+from aiohttp import web
+from dotenv import load_dotenv
+
+from webhook import BOT_MODE, WEBHOOK_BASE_URL, WEBHOOK_HOST, WEBHOOK_PATH, WEBHOOK_PORT, WEBHOOK_SECRET
+
+
+load_dotenv()
+logger = logging.getLogger(__name__)
+
+# Number of worker processes; 0 means one per CPU core
+WORKERS = int(os.getenv('WORKERS', 0))
+# Set by the ingress for each worker; a single-process bot is worker 0 of 1
+WORKER_INDEX = int(os.getenv('WORKER_INDEX', 0))
+WORKER_COUNT = int(os.getenv('WORKER_COUNT', 1))
+# A worker whose event loop has not reported for HEARTBEAT_TIMEOUT seconds is restarted
+HEARTBEAT_INTERVAL = float(os.getenv('WORKER_HEARTBEAT_INTERVAL', 5))
+HEARTBEAT_TIMEOUT = float(os.getenv('WORKER_HEARTBEAT_TIMEOUT', 60))
+HEALTH_CHECK_INTERVAL = float(os.getenv('WORKER_HEALTH_CHECK_INTERVAL', 5))
+# How long workers may finish in-flight updates on shutdown
+WORKER_SHUTDOWN_TIMEOUT = float(os.getenv('WORKER_SHUTDOWN_TIMEOUT', 10))
+# Long polling timeout of getUpdates, seconds
+POLLING_TIMEOUT = 30
+
+
+def owns_user(user_id: int, index: int = WORKER_INDEX, count: int = WORKER_COUNT) -> bool:
+    """Whether this worker serves ``user_id`` (always true in a single process)."""
+    return user_id % count == index
+
+
+def shard_key(update: Dict[str, Any]) -> int:
+    """User id of a raw update; the chat id for updates without a user, e.g. channel posts."""
+    for name, event in update.items():
+        if name == 'update_id' or not isinstance(event, dict):
+            continue
+        # Messages, callback and inline queries have 'from'; poll answers and reactions have 'user'
+        user = event.get('from') or event.get('user')
+        if isinstance(user, dict) and 'id' in user:
+            return user['id']
+        chat = event.get('chat')
+        if isinstance(chat, dict) and 'id' in chat:
+            return chat['id']
+    return update.get('update_id', 0)
+
+
+def worker_env(index: int, count: int) -> Dict[str, str]:
+    """Environment of worker ``index``: its shard, its metrics port and its share of the Telegram limit."""
+    from metrics import METRICS_PORT
+    from outbox import GLOBAL_RATE
+    return {
+        'WORKER_INDEX': str(index),
+        'WORKER_COUNT': str(count),
+        # The ingress itself answers on METRICS_PORT
+        'METRICS_PORT': str(METRICS_PORT + 1 + index if METRICS_PORT else 0),
+        # Telegram's ~30 messages/s are for the whole bot, not per process
+        'OUTBOX_GLOBAL_RATE': str(GLOBAL_RATE / count),
+    }
+
+
+def worker_main(index: int, env: Dict[str, str], queue, heartbeats) -> None:
+    """Entry point of a worker process."""
+    os.environ.update(env)
+    # Ctrl+C reaches the whole process group; the ingress stops the workers itself
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    import main as bot_app
+    bot_app.setup_logging()
+    asyncio.run(run_worker(bot_app, index, queue, heartbeats))
+
+
+async def run_worker(bot_app: Any, index: int, queue, heartbeats) -> None:
+    from aiogram.types import Update
+
+    bot, dp = bot_app.bot, bot_app.dp
+    dp.startup.register(bot_app.on_startup)
+    dp.shutdown.register(bot_app.on_shutdown)
+    await dp.emit_startup(bot=bot)
+
+    async def beat() -> None:
+        # Written from the event loop: a blocked loop stops beating
+        while True:
+            heartbeats[index] = time.time()
+            await asyncio.sleep(HEARTBEAT_INTERVAL)
+
+    heartbeat_task = asyncio.create_task(beat())
+    loop = asyncio.get_running_loop()
+    tasks = set()
+    # queue.get blocks, so it waits in its own thread
+    with ThreadPoolExecutor(1, thread_name_prefix='worker-queue') as reader:
+        logger.info('Worker %s is ready', index)
+        while True:
+            raw_update = await loop.run_in_executor(reader, queue.get)
+            if raw_update is None:
+                break
+            update = Update.model_validate(raw_update, context={'bot': bot})
+            # Tasks start in arrival order; ThrottlingMiddleware then runs a user's updates one by one
+            task = asyncio.create_task(dp.feed_update(bot, update))
+            tasks.add(task)
+            task.add_done_callback(tasks.discard)
+
+    if tasks:
+        logger.info('Worker %s is finishing %s updates', index, len(tasks))
+        await asyncio.wait(set(tasks), timeout=WORKER_SHUTDOWN_TIMEOUT)
+    heartbeat_task.cancel()
+    await dp.emit_shutdown(bot=bot)
+    await bot.session.close()
+
+
+class Worker:
+    __slots__ = ('index', 'process', 'queue', 'restarts', 'started_at')
+
+    def __init__(self, index: int):
+        self.index = index
+        self.process = None
+        self.queue = None
+        self.restarts = 0
+        self.started_at = 0.0
+
+
+class WorkerPool:
+    """Worker processes with one update queue each, restarted when they die or hang."""
+
+    def __init__(self, count: int, target: Callable = worker_main, start_method: str = 'spawn',
+                 heartbeat_timeout: float = HEARTBEAT_TIMEOUT, env: Optional[Callable[[int, int], Dict]] = None):
+        self.count = count
+        self.target = target
+        self.context = multiprocessing.get_context(start_method)
+        self.heartbeat_timeout = heartbeat_timeout
+        self.env = env or worker_env
+        self.heartbeats = self.context.Array('d', count, lock=False)
+        self.workers = [Worker(index) for index in range(count)]
+        self.dispatched = [0] * count
+
+    def start(self) -> None:
+        for worker in self.workers:
+            self._spawn(worker)
+
+    def _spawn(self, worker: Worker) -> None:
+        # A fresh queue: a killed process may have left the old one locked
+        worker.queue = self.context.Queue()
+        worker.process = self.context.Process(
+            target=self.target, name=f'bot-worker-{worker.index}', daemon=True,
+            args=(worker.index, self.env(worker.index, self.count), worker.queue, self.heartbeats))
+        worker.started_at = time.time()
+        # Startup (imports, DB, first downloads) counts as alive
+        self.heartbeats[worker.index] = worker.started_at
+        worker.process.start()
+        logger.info('Started worker %s (pid %s)', worker.index, worker.process.pid)
+
+    def dispatch(self, raw_update: Dict[str, Any]) -> int:
+        index = shard_key(raw_update) % self.count
+        self.workers[index].queue.put(raw_update)
+        self.dispatched[index] += 1
+        return index
+
+    def health(self) -> List[Dict[str, Any]]:
+        now = time.time()
+        return [{
+            'worker': worker.index,
+            'pid': worker.process.pid if worker.process else None,
+            'alive': bool(worker.process and worker.process.is_alive()),
+            'heartbeat_age': round(now - self.heartbeats[worker.index], 3),
+            'restarts': worker.restarts,
+            'dispatched': self.dispatched[worker.index],
+        } for worker in self.workers]
+
+    def healthy(self) -> bool:
+        return all(item['alive'] and item['heartbeat_age'] < self.heartbeat_timeout for item in self.health())
+
+    def check(self) -> List[int]:
+        """Restart dead and hung workers; returns their indices."""
+        restarted = []
+        now = time.time()
+        for worker in self.workers:
+            if not worker.process.is_alive():
+                logger.error('Worker %s exited with code %s, restarting', worker.index, worker.process.exitcode)
+            elif now - self.heartbeats[worker.index] > self.heartbeat_timeout:
+                logger.error('Worker %s has not responded for %.0f s, restarting', worker.index,
+                             now - self.heartbeats[worker.index])
+                worker.process.kill()
+                worker.process.join(5)
+            else:
+                continue
+            # Updates still queued for the old process are lost with it
+            worker.queue.close()
+            worker.restarts += 1
+            self._spawn(worker)
+            restarted.append(worker.index)
+        return restarted
+
+    async def run_health_checks(self, interval: float = HEALTH_CHECK_INTERVAL) -> None:
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                self.check()
+            except Exception:
+                logger.exception('Worker health check failed')
+
+    def stop(self, timeout: float = WORKER_SHUTDOWN_TIMEOUT) -> None:
+        for worker in self.workers:
+            if worker.process.is_alive():
+                worker.queue.put(None)
+        deadline = time.monotonic() + timeout + 5
+        for worker in self.workers:
+            worker.process.join(max(0.0, deadline - time.monotonic()))
+            if worker.process.is_alive():
+                logger.warning('Worker %s did not stop in time, terminating', worker.index)
+                worker.process.terminate()
+                worker.process.join(5)
+
+
+def _resolve_update_types() -> List[str]:
+    import main as bot_app
+    return bot_app.dp.resolve_used_update_types()
+
+
+def used_update_types(start_method: str = 'spawn') -> List[str]:
+    """Update types the bot's handlers use, resolved in a short-lived process that imports ``main``."""
+    with ProcessPoolExecutor(1, mp_context=multiprocessing.get_context(start_method)) as executor:
+        return executor.submit(_resolve_update_types).result()
+
+
+async def poll_updates(bot: Any, pool: WorkerPool, allowed_updates: Optional[List[str]] = None) -> None:
+    """Long-poll getUpdates and hand the raw updates to the workers without parsing them."""
+    url = bot.session.api.api_url(token=bot.token, method='getUpdates')
+    offset: Optional[int] = None
+    backoff = 1.0
+    timeout = aiohttp.ClientTimeout(total=POLLING_TIMEOUT + 10)
+    async with aiohttp.ClientSession(timeout=timeout) as session:
+        while True:
+            params: Dict[str, Any] = {'timeout': POLLING_TIMEOUT}
+            if allowed_updates is not None:
+                params['allowed_updates'] = allowed_updates
+            if offset is not None:
+                params['offset'] = offset
+            try:
+                async with session.post(url, json=params) as response:
+                    body = await response.json(content_type=None)
+            except (aiohttp.ClientError, asyncio.TimeoutError, ValueError) as error:
+                logger.warning('getUpdates failed: %r, retrying in %s s', error, backoff)
+                await asyncio.sleep(backoff)
+                backoff = min(backoff * 2, 30.0)
+                continue
+            if not body.get('ok'):
+                retry_after = body.get('parameters', {}).get('retry_after', backoff)
+                logger.warning('getUpdates failed: %s, retrying in %s s', body.get('description'), retry_after)
+                await asyncio.sleep(retry_after)
+                backoff = min(backoff * 2, 30.0)
+                continue
+            backoff = 1.0
+            for raw_update in body.get('result', []):
+                offset = raw_update['update_id'] + 1
+                pool.dispatch(raw_update)
+
+
+def build_ingress_app(pool: WorkerPool, webhook: bool, path: str = WEBHOOK_PATH,
+                      secret: str = WEBHOOK_SECRET) -> web.Application:
+    """``/healthz`` with the state of every worker and, in webhook mode, the webhook endpoint."""
+    app = web.Application()
+
+    async def health(request: web.Request) -> web.Response:
+        return web.json_response({'workers': pool.health()}, status=200 if pool.healthy() else 503)
+
+    async def receive_update(request: web.Request) -> web.Response:
+        if request.headers.get('X-Telegram-Bot-Api-Secret-Token') != secret:
+            return web.Response(status=401)
+        pool.dispatch(await request.json())
+        return web.Response()
+
+    app.router.add_get('/healthz', health)
+    if webhook:
+        app.router.add_post(path, receive_update)
+    return app
+
+
+async def run_ingress(pool: WorkerPool, mode: str = BOT_MODE) -> None:
+    """Receive updates and feed the worker pool until SIGINT/SIGTERM."""
+    from aiogram import Bot
+    from metrics import METRICS_HOST, METRICS_PORT
+
+    webhook = mode == 'webhook'
+    if webhook and (not WEBHOOK_BASE_URL or not WEBHOOK_SECRET):
+        raise RuntimeError('WEBHOOK_BASE_URL and WEBHOOK_SECRET must be set in webhook mode')
+    # Telegram keeps allowed_updates between calls, so pass the same types as a single-process bot
+    allowed_updates = await asyncio.to_thread(used_update_types)
+    bot = Bot(token=os.getenv('API_TOKEN'))
+    pool.start()
+    runner = web.AppRunner(build_ingress_app(pool, webhook), handle_signals=False, access_log=None)
+    await runner.setup()
+    host, port = (WEBHOOK_HOST, WEBHOOK_PORT) if webhook else (METRICS_HOST, METRICS_PORT)
+    if port:
+        await web.TCPSite(runner, host, port).start()
+        logger.info('Ingress listening on %s:%s', host, port)
+
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop.set)
+    tasks = [asyncio.create_task(pool.run_health_checks())]
+    try:
+        if webhook:
+            await bot.set_webhook(f'{WEBHOOK_BASE_URL.rstrip("/")}{WEBHOOK_PATH}', secret_token=WEBHOOK_SECRET,
+                                  allowed_updates=allowed_updates)
+        else:
+            # Telegram does not deliver updates to getUpdates while a webhook is set
+            await bot.delete_webhook()
+            tasks.append(asyncio.create_task(poll_updates(bot, pool, allowed_updates)))
+        logger.info('Dispatching updates to %s workers', pool.count)
+        await stop.wait()
+    finally:
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            loop.remove_signal_handler(sig)
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        await runner.cleanup()
+        await bot.session.close()
+        await asyncio.to_thread(pool.stop)
+
+
+if __name__ == '__main__':
+    from metrics import setup_logging
+
+    setup_logging()
+    asyncio.run(run_ingress(WorkerPool(WORKERS or os.cpu_count() or 1)))